@@ -7,6 +7,9 @@ Driver for the Keithley 2182 Nano-Voltmeter
 # import visa
 
 import logging
+import time
+
+import numpy as np
 
 from drivers import AbstractGPIBDeviceDriver
 
@@ -30,8 +33,14 @@ class Keithley2182(AbstractGPIBDeviceDriver):
     The Keithley 2182 is a nano-voltmeter.
     """
 
+    # maximum number of readings in the buffer
+    buffer_size = 1024
+    # bit 9 of the measurement event register: buffer full
+    buffer_full = 512
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.nplc = 1
         self.setRate(num=3)
         self.go(":INIT:CONT OFF")
 
@@ -56,6 +65,79 @@ class Keithley2182(AbstractGPIBDeviceDriver):
             answer = answer[1:]
         return float(answer)
 
+    def armBuffer(self, count):
+        """prepare and start a buffered acquisition of count readings
+
+        The readings are triggered immediately, one after the other,
+        and stored in the buffer of the device, from where they can
+        be fetched in one transfer (fetchBuffer).
+
+        :param count: number of readings, 2 to 1024
+        """
+        if not 2 <= count <= self.buffer_size:
+            raise AssertionError(
+                "Keithley2182:armBuffer: the number of readings"
+                " needs to be between 2 and {}".format(self.buffer_size)
+            )
+        self.go(":TRAC:CLE")
+        self.go(":TRAC:POIN {:d}".format(count))
+        self.go(":TRAC:FEED SENS")
+        self.go(":TRAC:FEED:CONT NEXT")
+        self.go(":TRIG:SOUR IMM")
+        self.go(":TRIG:COUN 1")
+        self.go(":SAMP:COUN {:d}".format(count))
+        # clear the measurement event register
+        self.query(":STAT:MEAS?")
+        self.go(":INIT")
+
+    def bufferFull(self):
+        """check whether the armed acquisition is finished"""
+        return bool(int(float(self.query(":STAT:MEAS?")[0])) & self.buffer_full)
+
+    def fetchBuffer(self):
+        """read all readings of the buffer in one transfer,
+        and set the device back to single readings
+
+        :return: voltages in V
+        :return type: numpy array
+        """
+        answer = self.query(":TRAC:DATA?")
+        self.singleReadings()
+        return np.array(
+            [float(x[1:] if x[0:2] == "--" else x) for x in answer if x.strip()]
+        )
+
+    def singleReadings(self):
+        """set the device back to single readings, as for measureVoltage"""
+        self.go(":TRAC:FEED:CONT NEV")
+        self.go(":SAMP:COUN 1")
+
+    def measureVoltageBlock(self, count, timeout=None):
+        """measure a block of count voltages, fetched in one transfer
+
+        :param count: number of readings, 2 to 1024
+        :param timeout: maximum waiting time for the readings [s],
+            default: estimated from the number of readings and the rate
+        :return: voltages in V
+        :return type: numpy array
+        """
+        if timeout is None:
+            # two conversions per reading with front autozero, at 50Hz
+            timeout = 2 + count * 2 * self.nplc / 50.0
+        self.armBuffer(count)
+        start = time.time()
+        while not self.bufferFull():
+            if time.time() - start > timeout:
+                self.go(":ABOR")
+                self.singleReadings()
+                raise AssertionError(
+                    "Keithley2182:measureVoltageBlock: buffer not full after {} s".format(
+                        timeout
+                    )
+                )
+            time.sleep(min(max(count * self.nplc / 50.0 / 10, 0.01), 0.2))
+        return self.fetchBuffer()
+
     def DisplayOn(self):
         self.go(":DISPlay:ENABle ON")
 
@@ -78,12 +160,8 @@ class Keithley2182(AbstractGPIBDeviceDriver):
                        [200μsec to 1 sec (50Hz)]
             """
         if num is None:
-            if value == "FAS":
-                self.go(":SENSe:VOLTage:DC:NPLC 0.1")
-            if value == "MED":
-                self.go(":SENSe:VOLTage:DC:NPLC 1")
-            if value == "SLO":
-                self.go(":SENSe:VOLTage:DC:NPLC 5")
+            num = dict(FAS=0.1, MED=1, SLO=5).get(value, self.nplc)
+            self.go(":SENSe:VOLTage:DC:NPLC {}".format(num))
         else:
             if 0.01 > num > 50:
                 raise AssertionError(
@@ -93,6 +171,7 @@ class Keithley2182(AbstractGPIBDeviceDriver):
                     "(at a 50Hz powerline - europe)"
                 )
             self.go(":SENSe:VOLTage:DC:NPLC {}".format(num))
+        self.nplc = num
 
     def FrontAutozeroOn(self):
         """
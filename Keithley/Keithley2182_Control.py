@@ -1,6 +1,7 @@
 from PyQt5.QtCore import pyqtSlot
 
 import Keithley
+import numpy as np
 
 from copy import deepcopy
 from importlib import reload
@@ -32,14 +33,38 @@ class Keithley2182_Updater(AbstractLoopThread):
 
         self.Keithley2182 = K_2182.Keithley2182(InstrumentAddress=InstrumentAddress)
         self.__name__ = "Keithley2182_Updater " + InstrumentAddress
+        # number of readings averaged per loop, 1: single readings
+        self.block_size = 1
 
     # @control_checks
     @ExceptionHandling
     def running(self):
-        """Measure Voltage, send the data"""
-        self.sensors["Voltage_V"] = self.Keithley2182.measureVoltage()
+        """Measure Voltage, send the data
 
-        self.sig_Infodata.emit(deepcopy(self.sensors))
+        with a block size larger than one, a block of readings is measured
+        in one go, and their mean and standard deviation are sent
+        """
+        if self.block_size > 1:
+            block = self.Keithley2182.measureVoltageBlock(self.block_size)
+            self.sensors["Voltage_V"] = np.mean(block)
+            data = dict(self.sensors, Voltage_std_V=np.std(block, ddof=1))
+        else:
+            self.sensors["Voltage_V"] = self.Keithley2182.measureVoltage()
+            data = self.sensors
+
+        self.sig_Infodata.emit(deepcopy(data))
+
+    @pyqtSlot(int)
+    @ExceptionHandling
+    def setBlockSize(self, value):
+        """set the number of readings averaged per loop"""
+        if not 1 <= value <= self.Keithley2182.buffer_size:
+            raise AssertionError(
+                "Keithley2182: block size needs to be between 1 and {}".format(
+                    self.Keithley2182.buffer_size
+                )
+            )
+        self.block_size = value
 
     @pyqtSlot()
     @ExceptionHandling
@@ -47,6 +72,23 @@ class Keithley2182_Updater(AbstractLoopThread):
         """read a Voltage from instrument. return value should be float"""
         return self.Keithley2182.measureVoltage()
 
+    @ExceptionHandling
+    def read_Voltage_block(self, count):
+        """read a block of count voltages from the instrument, in one transfer
+
+        return value is a numpy array
+        """
+        if count == 1:
+            return np.array([self.Keithley2182.measureVoltage()])
+        return self.Keithley2182.measureVoltageBlock(count)
+
+    @ExceptionHandling
+    def read_Voltage_mean(self, count):
+        """read the mean of count voltages from the instrument"""
+        if count == 1:
+            return self.Keithley2182.measureVoltage()
+        return float(np.mean(self.Keithley2182.measureVoltageBlock(count)))
+
     @pyqtSlot()
     @ExceptionHandling
     def speed_up(self):
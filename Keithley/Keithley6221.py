@@ -118,6 +118,108 @@ class Keithley6221(AbstractGPIBDeviceDriver):
         self.go("SOUR:SWE:ARM")
         self.go("INIT")
 
+    def nanovoltmeterPresent(self):
+        """Check whether a 2182(A) is connected via RS-232 and trigger link,
+        which is necessary for the Delta and Differential Conductance modes
+
+        :return: True if the nanovoltmeter was found
+        """
+        return bool(int(self.query("SOUR:DELT:NVPR?")[0]))
+
+    def setupDelta(self, high, low=None, delay=0.002, count=10, cab=True):
+        """Configures the Delta mode
+
+        The current alternates between high and low, the 2182 connected by
+        RS-232 and trigger link measures at each step. Each delta reading
+        combines three consecutive voltage readings, cancelling
+        thermoelectric offsets (and their linear drift).
+        The readings end up in the buffer of the 6221, to be read in one
+        transfer with readBuffer().
+
+        :param high: high source value [A]
+        :param low: low source value [A], default: -high
+        :param delay: delay between current step and measurement [s]
+        :param count: number of delta readings
+        :param cab: abort the mode on compliance
+        """
+        if low is None:
+            low = -high
+        for current in (high, low):
+            if not -0.105 <= current <= 0.105:
+                raise AssertionError(
+                    "Keithley6221:setupDelta: high and low values need to be between -0.105 and 0.105 A"
+                )
+        if not 0 < count <= 65536:
+            raise AssertionError(
+                "Keithley6221:setupDelta: count needs to be between 1 and 65536"
+            )
+        self.abortDelta()
+        self.go("FORM:ELEM READ")
+        self.go("TRAC:CLE")
+        self.go("TRAC:POIN {0:d}".format(count))
+        self.go("SOUR:DELT:HIGH {0:e}".format(high))
+        self.go("SOUR:DELT:LOW {0:e}".format(low))
+        self.go("SOUR:DELT:DEL {0:e}".format(delay))
+        self.go("SOUR:DELT:COUN {0:d}".format(count))
+        self.go("SOUR:DELT:CAB {}".format("ON" if cab else "OFF"))
+
+    def setupDifferentialConductance(
+        self, start, step, stop, delta, delay=0.002, cab=True
+    ):
+        """Configures the Differential Conductance mode
+
+        The current is swept from start to stop, alternating by +/- delta
+        around each point, the 2182 measures the corresponding voltages.
+        The readings end up in the buffer of the 6221, to be read in one
+        transfer with readBuffer().
+
+        :param start: start current [A]
+        :param step: step current [A]
+        :param stop: stop current [A]
+        :param delta: current delta [A]
+        :param delay: delay between current step and measurement [s]
+        :param cab: abort the mode on compliance
+        """
+        count = int(round(abs(stop - start) / abs(step))) + 1
+        self.abortDelta()
+        self.go("FORM:ELEM READ")
+        self.go("TRAC:CLE")
+        self.go("TRAC:POIN {0:d}".format(count))
+        self.go("SOUR:DCON:STAR {0:e}".format(start))
+        self.go("SOUR:DCON:STEP {0:e}".format(step))
+        self.go("SOUR:DCON:STOP {0:e}".format(stop))
+        self.go("SOUR:DCON:DELT {0:e}".format(delta))
+        self.go("SOUR:DCON:DEL {0:e}".format(delay))
+        self.go("SOUR:DCON:CAB {}".format("ON" if cab else "OFF"))
+        return count
+
+    def armDelta(self):
+        """Arms the Delta mode"""
+        self.go("SOUR:DELT:ARM")
+
+    def armDifferentialConductance(self):
+        """Arms the Differential Conductance mode"""
+        self.go("SOUR:DCON:ARM")
+
+    def startDelta(self):
+        """Starts the armed Delta or Differential Conductance mode"""
+        self.go("INIT:IMM")
+
+    def abortDelta(self):
+        """Stops (and disarms) the Delta or Differential Conductance mode"""
+        self.go("SOUR:SWE:ABOR")
+
+    def bufferPoints(self):
+        """number of readings currently stored in the buffer"""
+        return int(self.query("TRAC:POIN:ACT?")[0])
+
+    def readBuffer(self):
+        """read all readings from the buffer in one transfer
+
+        :return: list of readings
+        """
+        return [float(x) for x in self.query("TRAC:DATA?") if x.strip()]
+
     def more(self):
         """
         OUTPut Source output control:
@@ -7,6 +7,7 @@ from Keithley.Keithley6221 import Keithley6221
 from pyvisa.errors import VisaIOError
 
 from copy import deepcopy
+import time
 
 # from util import AbstractThread
 from util import AbstractEventhandlingThread
@@ -98,6 +99,69 @@ class Keithley6221_Updater(AbstractEventhandlingThread):
     def startSweep(self):
         self.Keithley6221.StartSweep()
 
+    @ExceptionHandling
+    def measure_Delta(self, high, count=10, delay=0.002, timeout=None):
+        """run the Delta mode with the connected 2182 and return the readings
+
+        The readings are taken by the 6221 and the 2182 on their own,
+        synchronised by the trigger link. They are polled for completion
+        and read back from the buffer in one transfer.
+
+        :param high: excitation current [A], low is -high
+        :param count: number of delta readings
+        :param delay: delay between current step and measurement [s]
+        :param timeout: maximum waiting time for the readings [s],
+            default: estimated from count and delay
+        :return: list of delta readings [V]
+        """
+        if not self.Keithley6221.nanovoltmeterPresent():
+            raise AssertionError(
+                "Keithley6221: Delta mode: no 2182 connected via RS-232 and trigger link"
+            )
+        self.Keithley6221.setupDelta(high, delay=delay, count=count)
+        self.Keithley6221.armDelta()
+        self.Keithley6221.startDelta()
+        return self._collect_buffer(count, delay, timeout)
+
+    @ExceptionHandling
+    def measure_DifferentialConductance(
+        self, start, step, stop, delta, delay=0.002, timeout=None
+    ):
+        """run the Differential Conductance mode with the connected 2182
+
+        :return: list of readings [V], one per current point of the sweep
+        """
+        if not self.Keithley6221.nanovoltmeterPresent():
+            raise AssertionError(
+                "Keithley6221: Differential Conductance mode: no 2182 connected via RS-232 and trigger link"
+            )
+        count = self.Keithley6221.setupDifferentialConductance(
+            start, step, stop, delta, delay=delay
+        )
+        self.Keithley6221.armDifferentialConductance()
+        self.Keithley6221.startDelta()
+        return self._collect_buffer(count, delay, timeout)
+
+    def _collect_buffer(self, count, delay, timeout):
+        """wait for count readings in the buffer, read them in one transfer"""
+        if timeout is None:
+            # every reading needs at least two current steps and
+            # one 2182 conversion (at most a few power line cycles)
+            timeout = 5 + count * 2 * (delay + 0.2)
+        start = time.time()
+        try:
+            while self.Keithley6221.bufferPoints() < count:
+                if time.time() - start > timeout:
+                    raise AssertionError(
+                        "Keithley6221: Delta mode: only {} of {} readings after {} s".format(
+                            self.Keithley6221.bufferPoints(), count, timeout
+                        )
+                    )
+                time.sleep(max(delay, 0.02))
+            return self.Keithley6221.readBuffer()[:count]
+        finally:
+            self.Keithley6221.abortDelta()
+
     @pyqtSlot(float)
     def gettoset_Current_A(self, value):
         self.Current_A_value = value
@@ -40,6 +40,29 @@ class LakeShore350(AbstractGPIBDeviceDriver):
         self.__init__()
     """
 
+    # queries which can be combined in one transaction by BatchQuery:
+    # name of the single query method: (command, parsing of the answer)
+    batch_queries = dict(
+        KelvinReadingQuery=("KRDG? {0:1}", lambda answer: [float(x) for x in answer]),
+        SensorUnitsInputReadingQuery=(
+            "SRDG? {0:1}",
+            lambda answer: [float(x) for x in answer],
+        ),
+        ControlSetpointQuery=("SETP? {0:1d}", lambda answer: float(answer[0])),
+        ControlSetpointRampParameterQuery=(
+            "RAMP? {0:1d}",
+            lambda answer: [float(x) for x in answer],
+        ),
+        ControlSetpointRampStatusQuery=("RAMPST? {0:1d}", lambda answer: answer),
+        OutputModeQuery=("OUTMODE? {0:1d}", lambda answer: [int(x) for x in answer]),
+        ControlLoopPIDValuesQuery=(
+            "PID? {0:1d}",
+            lambda answer: [float(x) for x in answer],
+        ),
+        HeaterRangeQuery=("RANGE? {0:1d}", lambda answer: int(answer[0])),
+        HeaterOutputQuery=("HTR? {0:1d}", lambda answer: float(answer[0].strip("+"))),
+    )
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -51,6 +74,36 @@ class LakeShore350(AbstractGPIBDeviceDriver):
         """write a command to the instrument and return its answer"""
         return super().query(command)
 
+    def BatchQuery(self, *queries):
+        """Sends several queries in one transaction, instead of one transaction per query
+
+        :param queries: tuples (name, argument), where name is the name of a query
+            method listed in batch_queries, argument its parameter
+        :type queries: tuple
+
+        :return: list of the results, in the order of the queries,
+            each as returned by the corresponding single query method
+
+        Example:
+            BatchQuery(("ControlSetpointQuery", 1), ("KelvinReadingQuery", 0))
+                sends 'SETP? 1;KRDG? 0' and returns [<setpoint>, [<A>, <B>, <C>, <D>]]
+        """
+        try:
+            commands = [
+                self.batch_queries[name][0].format(argument)
+                for name, argument in queries
+            ]
+        except KeyError as e:
+            raise AssertionError("BatchQuery: query {} cannot be batched".format(e))
+        answers = self.query_batch(commands)
+        try:
+            return [
+                self.batch_queries[name][1](answer)
+                for (name, __), answer in zip(queries, answers)
+            ]
+        except (ValueError, IndexError) as e:
+            raise AssertionError("BatchQuery: invalid answer: {}".format(e))
+
     def ClearInterfaceCommand(self):
         """Clears the bits in the Status Register, Standard Event Status Register, and Operation Event Register,
         and terminates all pending operations. Clears the interface, but not the controller. The related
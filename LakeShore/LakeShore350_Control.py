@@ -14,6 +14,7 @@ import LakeShore
 
 from util import AbstractLoopThread
 from util import ExceptionHandling
+from util import GainSchedule
 
 
 class LakeShore350_Updater(AbstractLoopThread):
@@ -54,6 +55,31 @@ class LakeShore350_Updater(AbstractLoopThread):
         OutputMode=None,
     )
 
+    # queries of one poll cycle, sent together in one transaction
+    poll_queries = (
+        ("ControlSetpointQuery", 1),
+        ("ControlSetpointRampParameterQuery", 1),
+        ("OutputModeQuery", 1),
+        ("KelvinReadingQuery", 0),
+        ("ControlLoopPIDValuesQuery", 1),
+        ("HeaterRangeQuery", 1),
+        ("HeaterOutputQuery", 1),
+        ("SensorUnitsInputReadingQuery", 0),
+    )
+
+    # settings only change when set, see poll_invalidate
+    polling_schedule = dict(
+        ControlSetpointRampParameterQuery="medium",
+        OutputModeQuery="medium",
+        ControlLoopPIDValuesQuery="medium",
+        HeaterRangeQuery="medium",
+        SensorUnitsInputReadingQuery="medium",
+    )
+
+    # gain schedule options for the auto-PID, see GainSchedule
+    PID_interpolate = False
+    PID_hysteresis = 0.1  # K
+
     def __init__(self, InstrumentAddress="", **kwargs):
         super().__init__(**kwargs)
 
@@ -89,6 +115,9 @@ class LakeShore350_Updater(AbstractLoopThread):
         self.initiating_PID()
 
         self.Ramp_status_internal = int(False)
+        # auto-PID, from a PID configuration file, see setPIDFile
+        self.useAutoPID = False
+        self.PID_schedule = None
 
     #        self.setControlLoopZone()
     #        self.startHeater()
@@ -110,31 +139,39 @@ class LakeShore350_Updater(AbstractLoopThread):
         and emit signal, sending the data
         """
 
-        self.sensors["Temp_K"] = self.LakeShore350.ControlSetpointQuery(1)
-        self.sensors[
-            "Ramp_Rate_Status"
-        ] = self.LakeShore350.ControlSetpointRampParameterQuery(1)[0]
-
-        self.sensors["Input_Sensor"] = self.LakeShore350.OutputModeQuery(1)[1]
-        temp_list = self.LakeShore350.KelvinReadingQuery(0)
+        # one transaction for all values due in this cycle
+        queries = [query for query in self.poll_queries if self.poll_due(query[0])]
+        if queries:
+            for (name, __), answer in zip(
+                queries, self.LakeShore350.BatchQuery(*queries)
+            ):
+                self.poll_done(name, answer)
+        (
+            self.sensors["Temp_K"],
+            ramp_parameters,
+            output_mode,
+            temp_list,
+            temp_list2,
+            self.sensors["Heater_Range"],
+            self.sensors["Heater_Output_percentage"],
+            temp_list3,
+        ) = [self.poll_last(name) for name, __ in self.poll_queries]
+        self.sensors["Ramp_Rate_Status"] = ramp_parameters[0]
+
+        self.sensors["Input_Sensor"] = output_mode[1]
         self.sensors["Sensor_1_K"] = temp_list[0]
         self.sensors["Sensor_2_K"] = temp_list[1]
         self.sensors["Sensor_3_K"] = temp_list[2]
         self.sensors["Sensor_4_K"] = temp_list[3]
-        ramp_rate = self.LakeShore350.ControlSetpointRampParameterQuery(1)[1]
+        ramp_rate = ramp_parameters[1]
         self.sensors["Ramp_Rate"] = (
             ramp_rate if self.Temp_K_value > self.sensors["Temp_K"] else -ramp_rate
         )
-        temp_list2 = self.LakeShore350.ControlLoopPIDValuesQuery(1)
         self.sensors["Loop_P_Param"] = temp_list2[0]
         self.sensors["Loop_I_Param"] = temp_list2[1]
         self.sensors["Loop_D_Param"] = temp_list2[2]
 
-        self.sensors["Heater_Range"] = self.LakeShore350.HeaterRangeQuery(1)
         self.sensors["Heater_Range_times_10"] = self.sensors["Heater_Range"] * 10
-        self.sensors["Heater_Output_percentage"] = self.LakeShore350.HeaterOutputQuery(
-            1
-        )
         self.sensors["Heater_Output_mW"] = (
             self.sensors["Heater_Output_percentage"]
             / 100
@@ -143,15 +180,52 @@ class LakeShore350_Updater(AbstractLoopThread):
             * 10 ** (-(5 - self.sensors["Heater_Range"]))
         )
 
-        temp_list3 = self.LakeShore350.SensorUnitsInputReadingQuery(0)
         self.sensors["Sensor_1_Ohm"] = temp_list3[0]
         self.sensors["Sensor_2_Ohm"] = temp_list3[1]
         self.sensors["Sensor_3_Ohm"] = temp_list3[2]
         self.sensors["Sensor_4_Ohm"] = temp_list3[3]
-        self.sensors["OutputMode"] = self.LakeShore350.OutputModeQuery(1)[1]
+        self.sensors["OutputMode"] = output_mode[1]
+
+        if self.useAutoPID and self.PID_schedule is not None:
+            if 1 <= output_mode[1] <= 4:
+                # the temperature of the control input
+                self.set_PID(temp_list[output_mode[1] - 1])
 
         self.sig_Infodata.emit(deepcopy(self.sensors))
 
+    @pyqtSlot(bool)
+    @ExceptionHandling
+    def setCheckAutoPID(self, boolean):
+        """reaction to signal: set AutoPID behaviour"""
+        self.useAutoPID = boolean
+        if boolean and self.PID_schedule is not None:
+            # send the values of the schedule right away
+            self.PID_schedule.reset()
+
+    @pyqtSlot(str)
+    @ExceptionHandling
+    def setPIDFile(self, file):
+        """reaction to signal: set AutoPID lookup file"""
+        self.PIDFile = file
+        self.PID_schedule = GainSchedule.from_file(
+            self.PIDFile,
+            interpolate=self.PID_interpolate,
+            hysteresis=self.PID_hysteresis,
+        )
+
+    @ExceptionHandling
+    def set_PID(self, temperature):
+        """set the PID values of Output 1 according to the configuration,
+        if they changed - see GainSchedule"""
+        PID_conf = self.PID_schedule.update(temperature)
+        if PID_conf is None:
+            return
+        self.LakeShore350.ControlLoopPIDValuesCommand(
+            1, PID_conf["p"], PID_conf["i"], int(round(PID_conf["d"]))
+        )
+        self.poll_invalidate("ControlLoopPIDValuesQuery")
+        self.PID_schedule.commit(PID_conf)
+
     @ExceptionHandling
     def configSensor(self):
         """configures sensor inputs to Cerox
@@ -189,6 +263,7 @@ class LakeShore350_Updater(AbstractLoopThread):
         self.LakeShore350.ControlSetpointRampParameterCommand(
             1, self.Ramp_status_internal, self.Ramp_Rate_value
         )
+        self.poll_invalidate("ControlSetpointRampParameterQuery")
 
     @ExceptionHandling
     def read_Temperatures(self):
@@ -224,6 +299,7 @@ class LakeShore350_Updater(AbstractLoopThread):
             1, self.Ramp_status_internal, self.Ramp_Rate_value
         )
         # the lone '1' here is the output
+        self.poll_invalidate("ControlSetpointRampParameterQuery")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -231,6 +307,7 @@ class LakeShore350_Updater(AbstractLoopThread):
         """(1,1,value,1) configure Output 1 for Closed Loop PID, using Input "value" and set powerup enable to On.
         """
         self.LakeShore350.OutputModeCommand(1, 1, Input_value, 1)
+        self.poll_invalidate("OutputModeQuery")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -241,6 +318,7 @@ class LakeShore350_Updater(AbstractLoopThread):
             self.sensors["Loop_I_Param"],
             self.sensors["Loop_D_Param"],
         )
+        self.poll_invalidate("ControlLoopPIDValuesQuery")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -251,6 +329,7 @@ class LakeShore350_Updater(AbstractLoopThread):
             self.LoopI_value,
             self.sensors["Loop_D_Param"],
         )
+        self.poll_invalidate("ControlLoopPIDValuesQuery")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -261,6 +340,7 @@ class LakeShore350_Updater(AbstractLoopThread):
             self.sensors["Loop_I_Param"],
             self.LoopD_value,
         )
+        self.poll_invalidate("ControlLoopPIDValuesQuery")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -275,6 +355,7 @@ class LakeShore350_Updater(AbstractLoopThread):
         """set Heater Range for Output 1
         """
         self.LakeShore350.HeaterRangeCommand(1, self.Heater_Range_value)
+        self.poll_invalidate("HeaterRangeQuery")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -20,6 +20,7 @@ from copy import deepcopy
 
 from pymeasure.instruments.srs import SR830
 
+import drivers
 from util import AbstractLoopThread
 from util import ExceptionHandling
 
@@ -33,7 +34,13 @@ class SR830_Updater(AbstractLoopThread):
         """init: get the driver connection to the Lock-In, set up default conf"""
         super().__init__(**kwargs)
 
-        self.lockin = SR830(InstrumentAddress)
+        if drivers.simulation:
+            # the simulated resource doubles as pymeasure adapter
+            self.lockin = SR830(
+                drivers.SIMULATED_RESOURCE_MANAGER.open_resource(InstrumentAddress)
+            )
+        else:
+            self.lockin = SR830(InstrumentAddress)
         self.__name__ = "SR830_Updater " + InstrumentAddress
 
         # self.interval = 0.05
@@ -4,13 +4,17 @@ Classes:
     IPS_Updater: a class for interfacing with a IPS 120-10 Power Supply
             inherits from AbstractLoopThread
                 there, the looping behaviour of this thread is defined
+    FieldSweep: a multi-segment field sweep, driven by the poll data of IPS_Updater
 Author(s):
     bklebel (Benjamin Klebel)
 """
 import time
 from copy import deepcopy
 from importlib import reload
+from threading import Lock
+from concurrent.futures import Future
 
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import pyqtSlot
 
 from pyvisa.errors import VisaIOError
@@ -21,6 +25,235 @@ from util import AbstractLoopThread
 from util import ExceptionHandling
 
 
+class FieldSweep(object):
+    """multi-segment field sweep of an IPS 120-10
+
+    The sweep is a state machine, advanced by step() with the poll data of
+    the IPS_Updater, so it never blocks the poller. For each segment, the
+    sweep rate ($T) and set point ($J) are set and the activity is set to
+    'To set point' ($A1). Once the output is at the target and at rest,
+    the field is held for the hold time, then the next segment starts.
+    If the magnet is persistent (switch heater off, magnet at field), the
+    leads are first brought to the persistent field, then the switch heater
+    is opened. With persistent, the switch heater is closed after the last
+    segment, and the leads are run down to zero.
+    Events are handed to emit as dicts with event, segment, target, field:
+        leads_matching, heater_on, segment_started, target_reached,
+        segment_finished, heater_off, leads_to_zero, finished,
+        stopped, aborted
+    A quench aborts the sweep.
+
+    Args:
+        updater: the IPS_Updater
+        segments: list of dicts with target [T], rate [T/min], hold [s]
+        persistent: leave the magnet persistent at the end
+        emit: function receiving the events
+        tolerance: [T] to consider a field reached
+        heater_switch_time: [s] to wait for the switch heater to open or close
+    """
+
+    def __init__(
+        self,
+        updater,
+        segments,
+        persistent=False,
+        emit=None,
+        tolerance=1e-3,
+        heater_switch_time=20,
+    ):
+        super().__init__()
+        for segment in segments:
+            if not abs(segment["target"]) < 8:
+                raise AssertionError("IPS: FieldSweep: targets must be below 8 T")
+            if not segment["rate"] > 0:
+                raise AssertionError("IPS: FieldSweep: rates must be positive")
+        self.updater = updater
+        self.PS = updater.PS
+        self.segments = [
+            dict(
+                target=segment["target"],
+                rate=segment["rate"],
+                hold=segment.get("hold", 0),
+            )
+            for segment in segments
+        ]
+        self.persistent = persistent
+        self.emit = emit if emit is not None else (lambda event: None)
+        self.tolerance = tolerance
+        self.heater_switch_time = heater_switch_time
+        self.state = "start"
+        self.segment = -1
+        self.progress = 0.0
+        self.field = None
+        self._start_field = None
+        self._since = None
+        self._paused_at = None
+        self._switch_fitted = True
+
+    @property
+    def done(self):
+        return self.state in ("finished", "aborted", "stopped")
+
+    def _event(self, event, target=None):
+        self.emit(
+            dict(
+                event=event,
+                segment=self.segment,
+                target=target,
+                field=self.field,
+                time=time.time(),
+            )
+        )
+
+    def _arrived(self, data, target):
+        return abs(data["FIELD_output"] - target) <= self.tolerance and data[
+            "status_mode2"
+        ].startswith("at rest")
+
+    def _ramp(self, target, rate):
+        """sweep the output to target with rate"""
+        self.PS.setFieldSweepRate(rate)
+        self.PS.setFieldSetpoint(target)
+        self.PS.setActivity(1)
+        self.updater.poll_invalidate(
+            "FIELD_set_point",
+            "CURRENT_set_point",
+            "FIELD_sweep_rate",
+            "CURRENT_sweep_rate",
+        )
+
+    def _start_segment(self, data, now):
+        self.segment += 1
+        if self.segment >= len(self.segments):
+            self._finish(now)
+            return
+        segment = self.segments[self.segment]
+        self._start_field = data["FIELD_output"]
+        self.progress = 0.0
+        self._ramp(segment["target"], segment["rate"])
+        self.state = "sweeping"
+        self._event("segment_started", segment["target"])
+
+    def _finish(self, now):
+        self.progress = 1.0
+        if self.persistent and self._switch_fitted:
+            self.PS.setSwitchHeater(0)
+            self.updater.poll_invalidate(
+                "persistent_magnet_current", "persistent_magnet_field"
+            )
+            self.state = "heater_off"
+            self._since = now
+            self._event("heater_off")
+        else:
+            self.state = "finished"
+            self._event("finished")
+
+    def step(self, data, now=None):
+        """advance the sweep with the poll data"""
+        if self.done or self._paused_at is not None:
+            return
+        now = time.monotonic() if now is None else now
+        self.field = data["FIELD_output"]
+        if data["status_magnet"] == "quenched":
+            self.PS.setActivity(0)
+            self.state = "aborted"
+            self._event("aborted")
+            return
+
+        if self.state == "start":
+            heater = data["status_switchheater"]
+            self._switch_fitted = heater != "no switch fitted"
+            if heater.startswith("Off"):
+                # persistent, or at zero: match the leads to the magnet
+                target = data["persistent_magnet_field"]
+                self._ramp(target, self.segments[0]["rate"])
+                self.state = "leads_matching"
+                self._event("leads_matching", target)
+            else:
+                self._start_segment(data, now)
+
+        elif self.state == "leads_matching":
+            if self._arrived(data, data["persistent_magnet_field"]):
+                self.PS.setSwitchHeater(1)
+                self.updater.poll_invalidate(
+                    "persistent_magnet_current", "persistent_magnet_field"
+                )
+                self.state = "heater_on"
+                self._since = now
+                self._event("heater_on")
+
+        elif self.state == "heater_on":
+            if now - self._since >= self.heater_switch_time and data[
+                "status_switchheater"
+            ].startswith("On"):
+                self._start_segment(data, now)
+
+        elif self.state == "sweeping":
+            target = self.segments[self.segment]["target"]
+            if target != self._start_field:
+                fraction = (self.field - self._start_field) / (
+                    target - self._start_field
+                )
+                self.progress = min(max(fraction, 0), 1)
+            if self._arrived(data, target):
+                self.progress = 1.0
+                self.state = "holding"
+                self._since = now
+                self._event("target_reached", target)
+
+        elif self.state == "holding":
+            segment = self.segments[self.segment]
+            if now - self._since >= segment["hold"]:
+                self._event("segment_finished", segment["target"])
+                self._start_segment(data, now)
+
+        elif self.state == "heater_off":
+            if now - self._since >= self.heater_switch_time:
+                self.PS.setActivity(2)
+                self.state = "leads_to_zero"
+                self._event("leads_to_zero", 0)
+
+        elif self.state == "leads_to_zero":
+            if self._arrived(data, 0):
+                self.state = "finished"
+                self._event("finished")
+
+    def pause(self):
+        """hold the output where it is"""
+        if self.done or self._paused_at is not None:
+            return
+        self.PS.setActivity(0)
+        self._paused_at = time.monotonic()
+
+    def resume(self):
+        """continue a paused sweep, waiting times continue where they were"""
+        if self._paused_at is None:
+            return
+        if self._since is not None:
+            self._since += time.monotonic() - self._paused_at
+        self._paused_at = None
+        self.PS.setActivity(2 if self.state == "leads_to_zero" else 1)
+
+    def stop(self):
+        """stop the sweep, holding the output where it is"""
+        if self.done:
+            return
+        self.PS.setActivity(0)
+        self.state = "stopped"
+        self._event("stopped")
+
+    def status(self):
+        """state, segment, progress of the segment and field of the sweep"""
+        return dict(
+            state=self.state,
+            paused=self._paused_at is not None,
+            segment=self.segment,
+            segments=len(self.segments),
+            progress=self.progress,
+            field=self.field,
+        )
+
+
 class IPS_Updater(AbstractLoopThread):
     """Updater class for the Intelligent Power Supply (IPS) 120-10
 
@@ -34,8 +267,27 @@ class IPS_Updater(AbstractLoopThread):
     The information from the device is collected in regular intervals (method "running"),
     and subsequently sent to the main thread. It is packed in a dict,
     the keys of which are displayed in the "sensors" dict in this class.
+
+    The arrival of the field at the set point is watched in the same data:
+    sig_field_reached is emitted once the field is within field_tolerance,
+    sig_field_stable once it stayed there for field_settle_time, with the
+    output at rest. wait_for_field() returns a Future for the same events,
+    without blocking any thread.
+
+    A multi-segment field sweep (see FieldSweep) is started with
+    startFieldSweep, and advanced with each poll, its events are
+    emitted with sig_field_sweep.
     """
 
+    sig_field_reached = pyqtSignal(float)
+    sig_field_stable = pyqtSignal(float)
+    sig_field_sweep = pyqtSignal(dict)
+
+    field_tolerance = 0.01  # T
+    field_settle_time = 5  # s
+    # time for the switch heater to open or close
+    heater_switch_time = 20  # s
+
     sensors = dict(
         # demand_current_to_psu_= 0,#     output_current
         measured_power_supply_voltage=1,
@@ -62,6 +314,22 @@ class IPS_Updater(AbstractLoopThread):
         safe_current_limit_most_positive=22,
     )
 
+    # limits and settings only change when set, see poll_invalidate
+    polling_schedule = dict(
+        CURRENT_set_point="medium",
+        CURRENT_sweep_rate="medium",
+        FIELD_set_point="medium",
+        FIELD_sweep_rate="medium",
+        lead_resistance="medium",
+        persistent_magnet_current="medium",
+        persistent_magnet_field="medium",
+        software_voltage_limit="slow",
+        trip_current="slow",
+        trip_field="slow",
+        safe_current_limit_most_negative="slow",
+        safe_current_limit_most_positive="slow",
+    )
+
     statusdict = dict(
         magnetstatus={
             "0": "normal",
@@ -140,7 +408,13 @@ class IPS_Updater(AbstractLoopThread):
         self.PS = ips120(InstrumentAddress=InstrumentAddress)
         self.__name__ = "IPS_Updater " + InstrumentAddress
         self.field_setpoint = 0
+        self.field_rate = 0
+        self.field_sweep = None
         self.first = True
+        self._field_within_since = None
+        self._field_stable = False
+        self._field_waiters = []
+        self._field_waiters_lock = Lock()
 
     @pyqtSlot()
     def running(self):
@@ -148,14 +422,18 @@ class IPS_Updater(AbstractLoopThread):
         if self.first:
             time.sleep(1)
             self.first = False
+        started = time.monotonic()
         try:
             data = dict()
             # get key-value pairs of the sensors dict,
             # so I can then transmit one single dict
             for key, idx_sensor in self.sensors.items():
                 # key_f_timeout = key
-                data[key] = self.PS.getValue(idx_sensor)
+                data[key] = self.poll(key, self.PS.getValue, idx_sensor)
             data.update(self.getStatus())
+            self.check_field(data, started)
+            if self.field_sweep is not None:
+                self.field_sweep.step(data)
             self.sig_Infodata.emit(deepcopy(data))
         except AssertionError as e_ass:
             self.sig_assertion.emit(e_ass.args[0])
@@ -170,6 +448,8 @@ class IPS_Updater(AbstractLoopThread):
                 # data[key_f_timeout] = self.read_buffer()
             else:
                 self.sig_visaerror.emit(e_visa.args[0])
+        finally:
+            self._expire_field_waiters()
 
     # def read_buffer(self):
     #     """read the instrument buffers"""
@@ -233,12 +513,14 @@ class IPS_Updater(AbstractLoopThread):
     def setSwitchHeater(self, state):
         """set the Switchheater state"""
         self.PS.setSwitchHeater(state)
+        self.poll_invalidate("persistent_magnet_current", "persistent_magnet_field")
 
     @pyqtSlot()
     @ExceptionHandling
     def setFieldSetpoint(self):
         """setthe Field Setpoint"""
         self.PS.setFieldSetpoint(self.field_setpoint)
+        self.poll_invalidate("FIELD_set_point", "CURRENT_set_point")
 
     @pyqtSlot(float)
     def gettoset_FieldSetpoint(self, value):
@@ -252,12 +534,62 @@ class IPS_Updater(AbstractLoopThread):
     def setFieldSweepRate(self):
         """set the Field SweepRate"""
         self.PS.setFieldSweepRate(self.field_rate)
+        self.poll_invalidate("FIELD_sweep_rate", "CURRENT_sweep_rate")
 
-    @pyqtSlot(int)
+    @pyqtSlot(float)
     @ExceptionHandling
     def gettoset_FieldSweepRate(self, value):
         """receive and store the value to set the Field sweep rate"""
-        self.field_setpoint = value
+        self.field_rate = value
+
+    @pyqtSlot(list)
+    @ExceptionHandling
+    def startFieldSweep(self, segments, persistent=False):
+        """start a multi-segment field sweep, replacing a running one
+
+        segments: list of dicts with target [T], rate [T/min], hold [s]
+        persistent: leave the magnet persistent at the end
+        """
+        with self.lock:
+            if self.field_sweep is not None:
+                self.field_sweep.stop()
+            self.field_sweep = FieldSweep(
+                self,
+                segments,
+                persistent=persistent,
+                emit=lambda event: self.sig_field_sweep.emit(deepcopy(event)),
+                heater_switch_time=self.heater_switch_time,
+            )
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def pauseFieldSweep(self):
+        """hold the field sweep"""
+        with self.lock:
+            if self.field_sweep is not None:
+                self.field_sweep.pause()
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def resumeFieldSweep(self):
+        """continue a paused field sweep"""
+        with self.lock:
+            if self.field_sweep is not None:
+                self.field_sweep.resume()
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def stopFieldSweep(self):
+        """stop the field sweep, holding the field where it is"""
+        with self.lock:
+            if self.field_sweep is not None:
+                self.field_sweep.stop()
+
+    def field_sweep_status(self):
+        """state and progress of the field sweep, None if there is none"""
+        if self.field_sweep is None:
+            return None
+        return self.field_sweep.status()
 
     @pyqtSlot()
     @ExceptionHandling
@@ -265,8 +597,114 @@ class IPS_Updater(AbstractLoopThread):
         """set the Display"""
         self.PS.setDisplay(display)
 
-    @pyqtSlot()
     @ExceptionHandling
     def waitForField(self, timeout, error_margin):
-        """wait For the Field"""
-        return self.PS.waitForField()
+        """wait For the Field, without blocking: see wait_for_field
+
+        not a slot: the future it returns would be lost with a signal,
+        use wait_for_field, or sig_field_reached / sig_field_stable
+        """
+        return self.wait_for_field(
+            tolerance=error_margin, stable=False, timeout=timeout
+        )
+
+    def wait_for_field(
+        self, target=None, tolerance=None, settle_time=None, stable=True, timeout=None
+    ):
+        """Future for the arrival of the field, resolved by the poll data
+
+        The result is True, once the field is within tolerance of the
+        target (and, if stable, stayed there for settle_time, with the output
+        at rest), or False after timeout seconds (also if the polls fail).
+        Waiting for the result (future.result()) only blocks the caller,
+        the future can be cancelled.
+
+        Args:
+            target: field [T], default: the field set point
+            tolerance: [T], default: field_tolerance
+            settle_time: [s], default: field_settle_time
+            stable: wait for the field to settle, not only to arrive
+            timeout: [s], default: no timeout
+        """
+        future = Future()
+        waiter = dict(
+            future=future,
+            target=target,
+            tolerance=self.field_tolerance if tolerance is None else tolerance,
+            settle_time=self.field_settle_time if settle_time is None else settle_time,
+            stable=stable,
+            deadline=None if timeout is None else time.monotonic() + timeout,
+            since=None,
+            created=time.monotonic(),
+        )
+        with self._field_waiters_lock:
+            self._field_waiters.append(waiter)
+        return future
+
+    def check_field(self, data, started):
+        """check the arrival of the field in the poll data,
+        emit the signals and resolve the futures of wait_for_field
+
+        started: time.monotonic() at the start of the poll, data read
+            before a waiter was created does not count for it
+        """
+        now = time.monotonic()
+        field = data["FIELD_output"]
+        at_rest = data["status_mode2"].startswith("at rest")
+        if abs(field - data["FIELD_set_point"]) <= self.field_tolerance:
+            if self._field_within_since is None:
+                self._field_within_since = now
+                self.sig_field_reached.emit(field)
+            if (
+                not self._field_stable
+                and at_rest
+                and now - self._field_within_since >= self.field_settle_time
+            ):
+                self._field_stable = True
+                self.sig_field_stable.emit(field)
+        else:
+            self._field_within_since = None
+            self._field_stable = False
+
+        with self._field_waiters_lock:
+            for waiter in list(self._field_waiters):
+                future = waiter["future"]
+                if future.cancelled():
+                    self._field_waiters.remove(waiter)
+                    continue
+                if waiter["created"] > started:
+                    continue
+                if self._field_arrived(waiter, field, data["FIELD_set_point"], at_rest):
+                    self._resolve_field_waiter(waiter, True)
+
+    def _expire_field_waiters(self):
+        """resolve the futures of wait_for_field which timed out,
+        after every poll, whether it worked or not"""
+        now = time.monotonic()
+        with self._field_waiters_lock:
+            for waiter in list(self._field_waiters):
+                if waiter["future"].cancelled():
+                    self._field_waiters.remove(waiter)
+                elif waiter["deadline"] is not None and now >= waiter["deadline"]:
+                    self._resolve_field_waiter(waiter, False)
+
+    def _resolve_field_waiter(self, waiter, result):
+        """set the result of a waiter, with _field_waiters_lock held"""
+        # a future cancelled in the meantime stays cancelled
+        if waiter["future"].set_running_or_notify_cancel():
+            waiter["future"].set_result(result)
+        self._field_waiters.remove(waiter)
+
+    @staticmethod
+    def _field_arrived(waiter, field, set_point, at_rest):
+        """whether the field arrived, as the waiter of wait_for_field wants it"""
+        now = time.monotonic()
+        target = set_point if waiter["target"] is None else waiter["target"]
+        if abs(field - target) > waiter["tolerance"]:
+            waiter["since"] = None
+            return False
+        if not waiter["stable"]:
+            return True
+        if waiter["since"] is None:
+            waiter["since"] = now
+        return at_rest and now - waiter["since"] >= waiter["settle_time"]
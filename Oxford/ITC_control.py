@@ -20,7 +20,7 @@ import numpy as np
 
 from util import AbstractLoopThread
 from util import ExceptionHandling
-from util import readPID_fromFile
+from util import GainSchedule
 
 
 class ITC_Updater(AbstractLoopThread):
@@ -52,6 +52,17 @@ class ITC_Updater(AbstractLoopThread):
         derivative_action_time=10,
     )
 
+    # the PID parameters only change when set, see poll_invalidate
+    polling_schedule = dict(
+        proportional_band="medium",
+        integral_action_time="medium",
+        derivative_action_time="medium",
+    )
+
+    # gain schedule options for the auto-PID, see GainSchedule
+    PID_interpolate = False
+    PID_hysteresis = 0.1  # K
+
     def __init__(self, mainthreadSignals, InstrumentAddress="", **kwargs):
         super().__init__(**kwargs)
         global Oxford
@@ -80,6 +91,8 @@ class ITC_Updater(AbstractLoopThread):
         self.interval = 0.05
         # self.__isRunning = True
 
+        # None, if the PID file cannot be read
+        self.PID_schedule = None
         self.setPIDFile("configurations\\PID_conf\\P1C1.conf")
         self.mainthreadSignals = mainthreadSignals
         self.mainthreadSignals["useAutocheck"].connect(self.setCheckAutoPID)
@@ -107,9 +120,12 @@ class ITC_Updater(AbstractLoopThread):
         data["set_temperature"] = self.ITC.getValue(self.sensors["set_temperature"])
 
         for key in self.sensors.keys():
+            if key in data:
+                # already read above
+                continue
             try:
 
-                value = self.ITC.getValue(self.sensors[key])
+                value = self.poll(key, self.ITC.getValue, self.sensors[key])
                 data[key] = value
 
             except AssertionError as e_ass:
@@ -130,7 +146,7 @@ class ITC_Updater(AbstractLoopThread):
         # with "calc" in name it would not enter calculations!
         data["Sensor_1_calerr_K"] = data["set_temperature"] - data["temperature_error"]
 
-        if self.useAutoPID:
+        if self.useAutoPID and self.PID_schedule is not None:
             self.set_PID(temperature=data["Sensor_1_K"])
 
         self.sig_Infodata.emit(deepcopy(data))
@@ -152,12 +168,19 @@ class ITC_Updater(AbstractLoopThread):
     def setCheckAutoPID(self, boolean):
         """reaction to signal: set AutoPID behaviour"""
         self.useAutoPID = boolean
+        if boolean and self.PID_schedule is not None:
+            # send the values of the schedule right away
+            self.PID_schedule.reset()
 
     @ExceptionHandling
     def setPIDFile(self, file):
         """reaction to signal: set AutoPID lookup file"""
         self.PIDFile = file
-        self.PID_configuration = readPID_fromFile(self.PIDFile)
+        self.PID_schedule = GainSchedule.from_file(
+            self.PIDFile,
+            interpolate=self.PID_interpolate,
+            hysteresis=self.PID_hysteresis,
+        )
 
     @ExceptionHandling
     def read_status(self, run=True):
@@ -171,22 +194,23 @@ class ITC_Updater(AbstractLoopThread):
 
     @ExceptionHandling
     def set_PID(self, temperature):
-        """set the PID values acorrding to the configuration
-        configuration should be stored in self.PID_configuration:
-        a tuple, with
-            the first entry being a list of temperatures
-            the second entry being a list of dicts with p, i, d values"""
-        try:
-            PID_id = np.where(self.PID_configuration[0] > temperature)[0][0]
-        except IndexError:
-            PID_id = -1
-        PID_conf = self.PID_configuration[1][PID_id]
+        """set the PID values according to the configuration,
+        if they changed - see GainSchedule
+        the configuration is stored in self.PID_schedule"""
+        PID_conf = self.PID_schedule.update(temperature)
+        if PID_conf is None:
+            return
         self.set_prop = PID_conf["p"]
         self.set_integral = PID_conf["i"]
         self.set_derivative = PID_conf["d"]
-        self.setProportional()
-        self.setIntegral()
-        self.setDerivative()
+        # not with setProportional() etc, which would swallow the errors
+        if self.ITC.setProportional(self.set_prop):
+            self.poll_invalidate("proportional_band")
+        if self.ITC.setIntegral(self.set_integral):
+            self.poll_invalidate("integral_action_time")
+        if self.ITC.setDerivative(self.set_derivative):
+            self.poll_invalidate("derivative_action_time")
+        self.PID_schedule.commit(PID_conf)
 
     @pyqtSlot(bool)
     @ExceptionHandling
@@ -207,7 +231,8 @@ class ITC_Updater(AbstractLoopThread):
                 sweep_time = 0.1
             if sweep_time > 20e3:
                 raise AssertionError(
-                    "A sweep can be maximal 15 * 23h long (about 20 000 minutes, about 205K at 0.01 K/min)!"
+                    "A sweep can be maximal 15 * 23h long (about 20 000 minutes, about 205K at 0.01 K/min)! "
+                    "Longer ramps can be done in software, see ramping.SetpointRamp"
                 )
             if sweep_time > 23.5 * 60:
                 # not only one step suffices, as the maximum time for one step
@@ -353,7 +378,8 @@ class ITC_Updater(AbstractLoopThread):
 
             prop: Proportional band, in steps of 0.0001K.
         """
-        self.ITC.setProportional(self.set_prop)
+        if self.ITC.setProportional(self.set_prop):
+            self.poll_invalidate("proportional_band")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -363,7 +389,8 @@ class ITC_Updater(AbstractLoopThread):
             integral: Integral action time, in steps of 0.1 minute.
                         Ranges from 0 to 140 minutes.
         """
-        self.ITC.setIntegral(self.set_integral)
+        if self.ITC.setIntegral(self.set_integral):
+            self.poll_invalidate("integral_action_time")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -373,7 +400,8 @@ class ITC_Updater(AbstractLoopThread):
             derivative: Derivative action time.
             Ranges from 0 to 273 minutes.
         """
-        self.ITC.setDerivative(self.set_derivative)
+        if self.ITC.setDerivative(self.set_derivative):
+            self.poll_invalidate("derivative_action_time")
 
     @pyqtSlot()
     @ExceptionHandling
@@ -8,7 +8,6 @@ Author(s):
     bklebel (Benjamin Klebel)
 """
 
-from pyvisa.errors import VisaIOError
 
 from drivers import AbstractSerialDeviceDriver
 
@@ -18,6 +17,8 @@ class ilm211(AbstractSerialDeviceDriver):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # learn the minimal delay, starting from the default one
+        self.enable_adaptive_pacing(delay_min=0.01, delay_max=0.5)
 
     def setControl(self, state=3):
         """Set the LOCAL / REMOTE control state of the Oxford controller
@@ -59,38 +60,11 @@ class ilm211(AbstractSerialDeviceDriver):
         if variable not in range(0, 11):
             raise AssertionError("ILM: getValue: Argument is not a valid number.")
 
-        # self.clear_buffers()
-
-        value = self.query("R{}".format(variable))
-        # value = self._visa_resource.read()
-
-        if value == "" or None:
-            # raise AssertionError('ILM: getValue: bad reply: empty string')
-            # print('ILM: Assertion: empty')
-            try:
-                self.read()
-            except VisaIOError as e_visa:
-                if (
-                    isinstance(e_visa, type(self.timeouterror))
-                    and e_visa.args == self.timeouterror.args
-                ):
-                    pass
-            return self.getValue(variable)
-            # return None
-        if value[0] != "R":
-            # raise AssertionError('ILM: getValue: bad reply: {}'.format(value))
-            # print('ILM: Assertion: {}'.format(value))
-            try:
-                self.read()
-            except VisaIOError as e_visa:
-                if (
-                    isinstance(e_visa, type(self.timeouterror))
-                    and e_visa.args == self.timeouterror.args
-                ):
-                    pass
-            return self.getValue(variable)
-
-        return float(value.strip("R+"))
+        # a bad reply is followed by flushing the input buffer and retrying,
+        # a limited number of times, see query_checked
+        return self.query_checked(
+            "R{}".format(variable), "R", lambda value: float(value.strip("R+"))
+        )
 
     def _converting_status_channel(self, i):
         i = int(i)
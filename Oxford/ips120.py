@@ -7,7 +7,6 @@ Classes:
 Author(s):
     bklebel (Benjamin Klebel)
 """
-from datetime import datetime
 import time
 
 from drivers import AbstractSerialDeviceDriver
@@ -23,6 +22,8 @@ class ips120(AbstractSerialDeviceDriver):
             adress(str): RS232 address of the IPS 120-10 (at the local machine)
         """
         super().__init__(**kwargs)
+        # learn the minimal delay, starting from the default one
+        self.enable_adaptive_pacing(delay_min=0.01, delay_max=0.5)
         # self.setControl() # done in thread
 
     def read_buffer(self):
@@ -81,14 +82,11 @@ class ips120(AbstractSerialDeviceDriver):
         if variable not in range(0, 23):
             raise AssertionError("IPS: getValue: Argument is not a valid number.")
 
-        value = self.query("R{}".format(variable))
-        # value = self._visa_resource.read()
-
-        if value == "" or None:
-            raise AssertionError("IPS: getValue: bad reply: empty string")
-        if value[0] != "R":
-            raise AssertionError("IPS: getValue: bad reply: {}".format(value))
-        return float(value.strip("R+"))
+        # a bad reply is followed by flushing the input buffer and retrying,
+        # a limited number of times, see query_checked
+        return self.query_checked(
+            "R{}".format(variable), "R", lambda value: float(value.strip("R+"))
+        )
 
     def getStatus(self):
         value = self.query("X")
@@ -96,6 +94,7 @@ class ips120(AbstractSerialDeviceDriver):
         if value == "" or None:
             raise AssertionError("IPS: getValue: bad reply: empty string")
         if value[0] != "X":
+            self.report_bad_reply()
             raise AssertionError("IPS: getStatus: Bad reply: {}".format(value))
         return value
 
@@ -105,14 +104,7 @@ class ips120(AbstractSerialDeviceDriver):
         Returns:
             field(float): current magnetic field in Tesla
         """
-        value = self.query("R7")
-        # self._visa_resource.wait_for_srq()
-        # value_str = self._visa_resource.read()
-        if value == "" or None:
-            raise AssertionError("IPS: getValue: bad reply: empty string")
-        if value[0] != "R":
-            raise AssertionError("IPS: readField: Bad reply: {}".format(value))
-        return float(value.strip("R+"))
+        return self.query_checked("R7", "R", lambda value: float(value.strip("R+")))
 
     def readFieldSetpoint(self):
         """Read the current set point for the magnetic field in Tesla
@@ -120,15 +112,7 @@ class ips120(AbstractSerialDeviceDriver):
         Returns:
             setpoint(float): current set point for the magnetic field in Tesla
         """
-        value = self.query("R8")
-        # self._visa_resource.wait_for_srq()
-        # value_str = self._visa_resource.read()
-        if value == "" or None:
-            raise AssertionError("IPS: getValue: bad reply: empty string")
-        if value[0] != "R":
-            raise AssertionError("IPS: readFieldSetpoint: Bad reply: {}".format(value))
-
-        return float(value.strip("R+"))
+        return self.query_checked("R8", "R", lambda value: float(value.strip("R+")))
 
     def readFieldSweepRate(self):
         """Read the current magnetic field sweep rate in Tesla/min
@@ -136,15 +120,7 @@ class ips120(AbstractSerialDeviceDriver):
         Returns:
             sweep_rate(float): current magnetic field sweep rate in Tesla/min
         """
-        value = self.query("R9")
-        # self._visa_resource.wait_for_srq()
-        # value_str = self._visa_resource.read()
-        if value == "" or None:
-            raise AssertionError("IPS: getValue: bad reply: empty string")
-        if value[0] != "R":
-            raise AssertionError("IPS: readFieldSweepRate: Bad reply: {}".format(value))
-
-        return float(value.strip("R+"))
+        return self.query_checked("R9", "R", lambda value: float(value.strip("R+")))
 
     def setActivity(self, state=1):
         """Set the field activation method
@@ -230,27 +206,27 @@ class ips120(AbstractSerialDeviceDriver):
 
         self.write("$M{}".format(mode_dict[display]))
 
-    def waitForField(self, timeout=600, error_margin=0.01):
+    def waitForField(self, timeout=600, error_margin=0.01, poll_interval=1):
         """Wait for the field to reach the set point
 
+        This blocks, in a running application rather use the non-blocking
+        IPS_Updater.wait_for_field, which watches the regular poll data.
+
         Args:
             timeout(int): maximum time to wait, in seconds
             error_margin(float): how close the field needs to be to the set point, in tesla
+            poll_interval(float): time between two checks, in seconds
 
         Returns:
             (bool): whether the field set point was reached
         """
-
-        start_time = datetime.now()
-        stop_time = start_time + datetime.timedelta(seconds=timeout)
-
-        while datetime.now() < stop_time:
+        stop_time = time.monotonic() + timeout
+        while True:
             field = self.readField()
             set_point = self.readFieldSetpoint()
 
             if abs(field - set_point) < error_margin:
                 return True
-
-            time.sleep(5)
-
-        return False
+            if time.monotonic() + poll_interval > stop_time:
+                return False
+            time.sleep(poll_interval)
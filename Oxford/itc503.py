@@ -9,19 +9,29 @@ Author(s):
 """
 
 from drivers import AbstractSerialDeviceDriver
-from pyvisa.errors import VisaIOError
 
 
 class itc503(AbstractSerialDeviceDriver):
     """class for interfacing with a ITC 503 temperature controller"""
 
+    # parameters of a sweep step, in the order of the y pointer (1-3)
+    sweep_table_keys = ("set_point", "sweep_time", "hold_time")
+    # deviation of a read back sweep step parameter from the written value,
+    # which is accepted as rounding by the device (K, minutes, minutes)
+    sweep_table_tolerance = dict(set_point=0.01, sweep_time=0.1, hold_time=0.1)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # shadow copy of the sweep table in the device: step: parameters,
+        # steps missing here are unknown
+        self._sweep_table = dict()
 
         # set the heater voltage limit to be controlled dynamically according to the temperature
         # self.write('$M0')
         self.delay = 0.06
         self.delay_force = 5e-3
+        # learn the minimal delay, starting from the one above
+        self.enable_adaptive_pacing(delay_min=0.01, delay_max=0.5)
 
         # self.setControl() # done in thread
 
@@ -106,52 +116,23 @@ class itc503(AbstractSerialDeviceDriver):
         if variable not in range(0, 11):
             raise AssertionError("ITC: getValue: Argument is not a valid number.")
 
-        # clear any buffer by reading, ignoring all timeout errors
-        # self.clear_buffers()
-        # retrieve value
-        value = self.query("R{}".format(variable))
-        # value = self._visa_resource.read()
-
-        if value == "" or None:
-            # raise AssertionError('ITC: getValue: bad reply: empty string')
-            # print('ITC: Assertion: empty')
-            try:
-                self.read()
-            except VisaIOError as e_visa:
-                if (
-                    isinstance(e_visa, type(self.timeouterror))
-                    and e_visa.args == self.timeouterror.args
-                ):
-                    pass
-            return self.getValue(variable)
-            # return None
-        if value[0] != "R":
-            # raise AssertionError('ITC: getValue: bad reply: {}'.format(value))
-            # print('ITC: Assertion: {}'.format(value))
-            try:
-                self.read()
-            except VisaIOError as e_visa:
-                if (
-                    isinstance(e_visa, type(self.timeouterror))
-                    and e_visa.args == self.timeouterror.args
-                ):
-                    pass
-            return self.getValue(variable)
-            # return None
-        # if value[0] == 'T':
-        #     print('ITC: Assertion: T')
-        #     self.read()
-        #     value = self.getValue(variable)
-        return float(value.strip("R+"))
+        # a bad reply is followed by flushing the input buffer and retrying,
+        # a limited number of times, see query_checked
+        return self.query_checked(
+            "R{}".format(variable), "R", lambda value: float(value.strip("R+"))
+        )
 
     def setProportional(self, prop=0):
         """Sets the proportional band.
 
         Args:
             prop: Proportional band, in steps of 0.0001K.
+
+        Returns:
+            False if the value was already set, and thus not sent again,
+            see write_cached
         """
-        self.write("$P{}".format(prop))
-        return None
+        return self.write_cached("$P{}".format(prop))
 
     def setIntegral(self, integral=0):
         """Sets the integral action time.
@@ -159,9 +140,12 @@ class itc503(AbstractSerialDeviceDriver):
         Args:
             integral: Integral action time, in steps of 0.1 minute.
                         Ranges from 0 to 140 minutes.
+
+        Returns:
+            False if the value was already set, and thus not sent again,
+            see write_cached
         """
-        self.write("$I{}".format(integral))
-        return None
+        return self.write_cached("$I{}".format(integral))
 
     def setDerivative(self, derivative=0):
         """Sets the derivative action time.
@@ -169,9 +153,12 @@ class itc503(AbstractSerialDeviceDriver):
         Args:
             derivative: Derivative action time.
                         Ranges from 0 to 273 minutes.
+
+        Returns:
+            False if the value was already set, and thus not sent again,
+            see write_cached
         """
-        self.write("$D{}".format(derivative))
-        return None
+        return self.write_cached("$D{}".format(derivative))
 
     def setHeaterSensor(self, sensor=1):
         """Selects the heater sensor.
@@ -224,7 +211,7 @@ class itc503(AbstractSerialDeviceDriver):
         """
         self.write("$A{}".format(auto_manual))
 
-    def setSweeps(self, sweep_parameters):
+    def setSweeps(self, sweep_parameters, verify=True):
         """Sets the parameters for all sweeps.
 
         This fills up a dictionary with all the possible steps in
@@ -236,24 +223,44 @@ class itc503(AbstractSerialDeviceDriver):
         because this would actually set the temperature setpoint to 0.
         Therefore all non-used steps have a low but reachable set point in T(K)
 
+        Only the parameters which differ from the table known to be in the
+        device (the shadow copy, see readSweepTable) are written.
+
         Args:
             sweep_parameters: A dictionary whose keys are the step
                 numbers (keys: 1-16). The value of each key is a
                 dictionary whose keys are the parameters in the
                 sweep table (see _setSweepStep).
+            verify: read back the changed steps, and compare
+        Returns:
+            the list of changed steps
         """
         if not isinstance(sweep_parameters, dict):
             raise AssertionError("ITC: setSweeps: Input should be a dict (of dicts)!")
-        steps = [str(x) for x in range(1, 17)]
-        parameters_keys = sweep_parameters.keys()
         null_parameter = {"set_point": 2, "sweep_time": 0, "hold_time": 0}
-        for step in steps:
-            if str(step) in parameters_keys:
-                print("changing step: ", step, "to ", sweep_parameters[step])
-                self._setSweepStep(step, sweep_parameters[step])
-            else:
-                print("setting step to null_parameter: ", step)
-                self._setSweepStep(step, null_parameter)
+        changed = []
+        with self._comLock:
+            try:
+                for step in range(1, 17):
+                    table = sweep_parameters.get(str(step), null_parameter)
+                    known = self._sweep_table.get(step)
+                    keys = [
+                        key
+                        for key in self.sweep_table_keys
+                        if known is None or known[key] != table[key]
+                    ]
+                    if not keys:
+                        continue
+                    self._writeSweepStep(step, table, keys)
+                    changed.append(step)
+                if verify:
+                    for step in changed:
+                        self._verifySweepStep(
+                            step, sweep_parameters.get(str(step), null_parameter)
+                        )
+            finally:
+                self._resetSweepTablePointers()
+        return changed
 
     def _setSweepStep(self, sweep_step, sweep_table):
         """Sets the parameters for a sweep step.
@@ -269,25 +276,78 @@ class itc503(AbstractSerialDeviceDriver):
                 sweep. Keys: set_point, sweep_time, hold_time.
         """
         with self._comLock:
-            step_setting = "$x{}".format(sweep_step)
-            self.write(step_setting, f=True)
-
-            setpoint_setting = "$s{}".format(sweep_table["set_point"])
-            sweeptime_setting = "$s{}".format(sweep_table["sweep_time"])
-            holdtime_setting = "$s{}".format(sweep_table["hold_time"])
-            self.write(step_setting, f=True)
-            self.write("$y1", f=True)
-            self.write(setpoint_setting, f=True)
+            try:
+                self._writeSweepStep(int(sweep_step), sweep_table)
+            finally:
+                self._resetSweepTablePointers()
 
-            self.write(step_setting, f=True)
-            self.write("$y2", f=True)
-            self.write(sweeptime_setting, f=True)
+    def _writeSweepStep(self, sweep_step, sweep_table, keys=None):
+        """write parameters (keys, default: all) of a sweep step,
+        keeping the shadow copy of the sweep table up to date
 
-            self.write(step_setting, f=True)
-            self.write("$y3", f=True)
-            self.write(holdtime_setting, f=True)
+        the Communication Lock needs to be held by the caller,
+        the table pointers are not reset
+        """
+        keys = self.sweep_table_keys if keys is None else keys
+        # unknown, until all is written
+        known = self._sweep_table.pop(sweep_step, None)
+        self.write("$x{}".format(sweep_step), f=True)
+        for key in keys:
+            self.write("$y{}".format(self.sweep_table_keys.index(key) + 1), f=True)
+            self.write("$s{}".format(sweep_table[key]), f=True)
+        if known is not None or len(keys) == len(self.sweep_table_keys):
+            known = dict(known or {})
+            known.update({key: sweep_table[key] for key in keys})
+            self._sweep_table[sweep_step] = known
+
+    def _readSweepStep(self, sweep_step):
+        """read the parameters of a sweep step
+
+        the Communication Lock needs to be held by the caller,
+        the table pointers are not reset
+        """
+        values = dict()
+        self.write("$x{}".format(sweep_step), f=True)
+        for n, key in enumerate(self.sweep_table_keys, start=1):
+            self.write("$y{}".format(n), f=True)
+            try:
+                # bad replies are flushed and retried, as with any reading
+                values[key] = self.query_checked(
+                    "r", "r", lambda value: float(value.strip("r+")), f=True
+                )
+            except AssertionError as e_ass:
+                self._sweep_table.pop(sweep_step, None)
+                raise AssertionError(
+                    "ITC: readSweepTable: step {}: {}".format(sweep_step, e_ass.args[0])
+                )
+        self._sweep_table[sweep_step] = dict(values)
+        return values
+
+    def _verifySweepStep(self, sweep_step, sweep_table):
+        """read back a sweep step, and compare it to the parameters written
+
+        the Communication Lock needs to be held by the caller,
+        the table pointers are not reset
+        """
+        values = self._readSweepStep(sweep_step)
+        for key in self.sweep_table_keys:
+            if abs(values[key] - sweep_table[key]) > self.sweep_table_tolerance[key]:
+                self._sweep_table.pop(sweep_step, None)
+                raise AssertionError(
+                    "ITC: setSweeps: step {} {} is {}, not {}".format(
+                        sweep_step, key, values[key], sweep_table[key]
+                    )
+                )
+        # keep the values as given, to compare against them next time
+        self._sweep_table[sweep_step] = {
+            key: sweep_table[key] for key in self.sweep_table_keys
+        }
 
-            self._resetSweepTablePointers()
+    def invalidateSweepTable(self):
+        """forget the shadow copy of the sweep table,
+        e.g. if it was changed at the front panel,
+        so that the next setSweeps writes all steps"""
+        self._sweep_table = dict()
 
     def _resetSweepTablePointers(self):
         """Resets the table pointers to x=0 and y=0 to prevent
@@ -313,35 +373,23 @@ class itc503(AbstractSerialDeviceDriver):
         """Stop any sweep which is currently running"""
         self.write("$S31")
 
-    def readSweepTable(self):
+    def readSweepTable(self, steps=None):
         """read the Sweep Table which is stored in the device
-            Not WORKING CURRENTLY
 
+        this also renews the shadow copy of the sweep table
+
+        Args:
+            steps: the steps to read (1-16), default: all
+        Returns:
+            a dictionary whose keys are the step numbers (keys: '1'-'16'),
+            the values are dicts with set_point, sweep_time, hold_time
         """
-        raise NotImplementedError
-        steps = [str(i) for i in range(1, 17)]
-        stepdict = {
-            key: dict(set_point="not read", sweep_time="not read", hold_time="not read")
-            for key in steps
-        }
+        steps = range(1, 17) if steps is None else [int(step) for step in steps]
+        stepdict = dict()
         with self._comLock:
-            for step in steps:
-                step_setting = "$x{}".format(step)
-                self.write(step_setting, f=True)
-                self.write("$y1", f=True)
-                print("written1")
-                try:
-                    stepdict[step]["set_point"] = self.query("r", f=True)
-                except Exception as e:
-                    print(e)
-                print("received 1")
-
-                self.write(step_setting)  # just in cas, f=Truee
-                self.write("$y2", f=True)
-                stepdict[step]["sweep_time"] = self.query("r", f=True)
-
-                self.write(step_setting)  # just in cas, f=Truee
-                self.write("$y3", f=True)
-                stepdict[step]["hold_time"] = self.query("r", f=True)
-        print(stepdict)
+            try:
+                for step in steps:
+                    stepdict[str(step)] = self._readSweepStep(step)
+            finally:
+                self._resetSweepTablePointers()
         return stepdict
@@ -17,6 +17,7 @@ from PyQt5.QtCore import QTimer
 # import re
 import time
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 from numpy.polynomial.polynomial import polyfit
@@ -24,7 +25,9 @@ from itertools import combinations_with_replacement as comb
 
 
 from util import AbstractEventhandlingThread
-from util import loops_off
+from util import loops_paused
+from drivers import bus_priority
+from drivers import PRIORITY_MEASUREMENT
 from util import locking
 from util import ExceptionHandling
 from util import convert_time
@@ -74,7 +77,9 @@ def measure_resistance_singlechannel(
     temps = []
     resistances = []  # pos & neg
 
-    with loops_off(threads):
+    with loops_paused(threads, [threadname_CURR, threadname_RES]), bus_priority(
+        PRIORITY_MEASUREMENT
+    ):
         threads[threadname_CURR][0].enable()
         temps.append(
             threads[threadname_Temp][0].read_Temperatures()[temperature_sensor]
@@ -122,6 +127,8 @@ def measure_resistance_multichannel(
     # temperature_sensor='Sensor_1_K',
     # n_measurements=1,
     current_reversal_time=0.08,
+    n_readings=1,
+    parallel=False,
     **kwargs
 ):
     """conduct one 'full' measurement of resistance:
@@ -133,6 +140,10 @@ def measure_resistance_multichannel(
             n_measurements  = number of measurements (dual polarity) to be averaged over
                             default = 1 (no reason to do much more)
             excitation_currents_A = list of excitations currents for the measurement
+            n_readings = number of voltage readings averaged per current,
+                            taken as one buffered block by the voltmeter
+            parallel = measure the channels (pairs of current source and
+                            voltmeter) at the same time, each in its own thread
         returns: dict data
             T_mean_K : dict of means of temperature readings
                     before and after measurement [K]
@@ -146,63 +157,210 @@ def measure_resistance_multichannel(
     """
     # measured current reversal = 40ms.
     # reversal measured with a DMM 7510 of a 6221 Source (both Keithley)
+
+    def sweep(name_curr, exc_curr, name_volt):
+        currents, voltages = [], []
+        threads[name_curr][0].enable()
+
+        for current_base in iv_characteristic:
+            for currentfactor in [-1, 1]:
+                current = exc_curr * currentfactor * current_base
+                currents.append(current)
+                threads[name_curr][0].gettoset_Current_A(current)
+                threads[name_curr][0].setCurrent_A()
+                # wait for the current to be changed:
+                time.sleep(current_reversal_time)
+                voltage = threads[name_volt][0].read_Voltage_mean(n_readings)
+                voltages.append(voltage)
+
+        threads[name_curr][0].disable()
+        return currents, voltages
+
+    return measure_channels(
+        threads,
+        sweep,
+        excitation_currents_A,
+        threadnames_RES,
+        threadnames_CURR,
+        threadname_Temp,
+        parallel,
+        **kwargs
+    )
+
+
+def measure_resistance_multichannel_delta(
+    threads,
+    excitation_currents_A,
+    threadnames_RES,
+    threadnames_CURR,
+    iv_characteristic,
+    threadname_Temp="control_LakeShore350",
+    n_delta=10,
+    delta_delay=0.002,
+    parallel=False,
+    **kwargs
+):
+    """conduct one 'full' measurement of resistance, using the Delta mode of the 6221
+
+    Instead of reversing the current by single GPIB commands and waiting,
+    each current source runs its Delta mode with the nanovoltmeter
+    connected via RS-232 and trigger link, for every point of the
+    iv characteristic. The readings are read back from the buffer of
+    the 6221 in one transfer.
+    The nanovoltmeters only need to be connected, they are controlled
+    by the current sources.
+
+    A delta reading is the voltage difference between the two
+    polarities, halved, with the thermoelectric offsets removed.
+    It is stored as the pair (-V, -I), (V, I), so that the resulting
+    voltages and currents can be treated like the ones measured
+    with measure_resistance_multichannel.
+
+        arguments: dict conf
+            as for measure_resistance_multichannel, and:
+            n_delta = number of delta readings per point of the iv characteristic
+            delta_delay = delay between current step and measurement [s]
+        returns: dict data
+            as measure_resistance_multichannel
+    """
+
+    def sweep(name_curr, exc_curr, name_volt):
+        currents, voltages = [], []
+        threads[name_curr][0].enable()
+
+        for current_base in iv_characteristic:
+            current = exc_curr * current_base
+            readings = threads[name_curr][0].measure_Delta(
+                current, count=n_delta, delay=delta_delay
+            )
+            if readings is None:
+                raise AssertionError(
+                    "Delta mode measurement failed for {}".format(name_curr)
+                )
+            for voltage in readings:
+                currents.extend([-current, current])
+                voltages.extend([-voltage, voltage])
+
+        threads[name_curr][0].disable()
+        return currents, voltages
+
+    return measure_channels(
+        threads,
+        sweep,
+        excitation_currents_A,
+        threadnames_RES,
+        threadnames_CURR,
+        threadname_Temp,
+        parallel,
+        **kwargs
+    )
+
+
+def measure_channels(
+    threads,
+    sweep,
+    excitation_currents_A,
+    threadnames_RES,
+    threadnames_CURR,
+    threadname_Temp,
+    parallel=False,
+    pause_buses=(),
+    **kwargs
+):
+    """measure all channels between two temperature readings, fit their resistance
+
+    sweep(name_curr, exc_curr, name_volt) measures the iv characteristic of
+    one channel and returns the lists of currents and voltages.
+    The channels are either measured one after the other, or,
+    if they do not share any instrument and parallel is True,
+    all at the same time, each in its own thread.
+    The temperatures are read once before and once after all channels.
+    Only the loops of the current sources and voltmeters, and of the
+    threads on the buses in pause_buses, are paused during the measurement,
+    all other threads keep polling (and logging). The transactions of the
+    sweeps overtake the polls queued on the same bus.
+    """
     lengths = [len(threadnames_CURR), len(threadnames_RES), len(excitation_currents_A)]
     for c in comb(lengths, 2):
         if c[0] != c[1]:
             raise AssertionError(
                 "number of excitation currents, current sources and voltmeters does not coincide!"
             )
-    data = dict()
-    resistances = {
-        key: dict(coeff=0, residuals=0, nonohmic=0) for key in threadnames_RES
-    }
-    voltages = {key: [] for key in threadnames_RES}
-    currents = {key: [] for key in threadnames_CURR}
+    channels = list(zip(threadnames_CURR, excitation_currents_A, threadnames_RES))
+    if parallel and (
+        len(set(threadnames_CURR)) != len(threadnames_CURR)
+        or len(set(threadnames_RES)) != len(threadnames_RES)
+    ):
+        raise AssertionError(
+            "channels sharing an instrument cannot be measured in parallel!"
+        )
+
+    def sweep_measurement(*channel):
+        # the priority holds for the thread the sweep runs in
+        with bus_priority(PRIORITY_MEASUREMENT):
+            return sweep(*channel)
 
-    with loops_off(threads):
+    with loops_paused(
+        threads, list(threadnames_CURR) + list(threadnames_RES), pause_buses
+    ):
 
         temp1 = threads[threadname_Temp][0].read_Temperatures()
         temps = {key: [val] for key, val in zip(temp1.keys(), temp1.values())}
 
-        for ct, (name_curr, exc_curr, name_volt) in enumerate(
-            zip(threadnames_CURR, excitation_currents_A, threadnames_RES)
-        ):
-            threshold_residuals = 1e4
-            # threshold_coefficients = 1e4
-
-            threads[name_curr][0].enable()
-
-            for current_base in iv_characteristic:
-                for currentfactor in [-1, 1]:
-                    current = exc_curr * currentfactor * current_base
-                    # print(current)
-                    currents[name_curr].append(current)
-                    threads[name_curr][0].gettoset_Current_A(current)
-                    threads[name_curr][0].setCurrent_A()
-                    # wait for the current to be changed:
-                    time.sleep(current_reversal_time)
-                    voltage = threads[name_volt][0].read_Voltage()
-                    voltages[name_volt].append(voltage)
-            c, stats = polyfit(
-                currents[name_curr], voltages[name_volt], deg=1, full=True
-            )
-            resistances[name_volt]["coeff"] = c[1]
-            resistances[name_volt]["residuals"] = stats[0][0]
-            # c_wrong = polyfit(currents[name_curr], voltages[
-            #                   name_volt], deg=4)
-            # print(stats[0], c_wrong)
-
-            if stats[0] > threshold_residuals:
-                resistances[name_volt]["nonohmic"] = 1
-            # if np.any(np.array([x > threshold_coefficients for x in stats[2:]])):
-            #     resistances[name_volt]['nonohmic'] = 1
-
-            threads[name_curr][0].disable()
+        if parallel and len(channels) > 1:
+            with ThreadPoolExecutor(max_workers=len(channels)) as pool:
+                futures = [
+                    pool.submit(sweep_measurement, *channel) for channel in channels
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [sweep_measurement(*channel) for channel in channels]
 
         temp2 = threads[threadname_Temp][0].read_Temperatures()
         for key in temps:
             temps[key].append(temp2[key])
 
+    resistances = dict()
+    voltages = dict()
+    currents = dict()
+    for (name_curr, __, name_volt), (channel_currents, channel_voltages) in zip(
+        channels, results
+    ):
+        currents[name_curr] = channel_currents
+        voltages[name_volt] = channel_voltages
+        resistances[name_volt] = fit_resistance(channel_currents, channel_voltages)
+
+    return multichannel_data(temps, resistances, voltages, currents, **kwargs)
+
+
+def fit_resistance(currents, voltages, threshold_residuals=1e4):
+    """linear fit of an iv characteristic
+
+    returns dict:
+        coeff: slope, the resistance [Ohm]
+        residuals: sum of squared residuals of the fit
+        nonohmic: 1 if the residuals exceed threshold_residuals, else 0
+    """
+    resistance = dict(coeff=0, residuals=0, nonohmic=0)
+    c, stats = polyfit(currents, voltages, deg=1, full=True)
+    resistance["coeff"] = c[1]
+    resistance["residuals"] = stats[0][0]
+    # c_wrong = polyfit(currents, voltages, deg=4)
+    # print(stats[0], c_wrong)
+
+    if stats[0] > threshold_residuals:
+        resistance["nonohmic"] = 1
+    # if np.any(np.array([x > threshold_coefficients for x in stats[2:]])):
+    #     resistance['nonohmic'] = 1
+    return resistance
+
+
+def multichannel_data(temps, resistances, voltages, currents, **kwargs):
+    """pack the results of a multichannel measurement into the data dict
+
+    see measure_resistance_multichannel for the keys
+    """
+    data = dict()
     data["T_mean_K"] = {key + "_mean": np.mean(temps[key]) for key in temps}
     data["T_std_K"] = {key + "_std": np.std(temps[key], ddof=1) for key in temps}
 
@@ -229,9 +387,6 @@ def measure_resistance_multichannel(
     data.update(timedict)
 
     data["df"] = df
-    # print(data)
-    # for x in data: print(x)
-    # df = pd.DataFrame.from_dict(data)
     return data
 
 
@@ -447,8 +602,13 @@ class OneShot_Thread_multichannel(AbstractEventhandlingThread):
             excitation_currents_A=[0.0005, 0.0005],
             iv_characteristic=self.iv_curve,
             current_reversal_time=self.current_revtime,
+            n_readings=1,
+            n_delta=10,
+            delta_delay=0.002,
+            parallel=False,
             interval=10,
         )
+        self.measure_multichannel = measure_resistance_multichannel
         # self.timer = QTimer()
         # self.timer.timeout.connect(self.measure_oneshot_once)
         self.__name__ = "OneShot_Thread_multichannel"
@@ -467,6 +627,15 @@ class OneShot_Thread_multichannel(AbstractEventhandlingThread):
         )
         self.update_conf("iv_characteristic", self.iv_curve)
 
+    @pyqtSlot(bool)
+    def use_delta_mode(self, bools):
+        """choose between the Delta mode of the current sources
+        and the current reversal by single commands"""
+        if bools:
+            self.measure_multichannel = measure_resistance_multichannel_delta
+        else:
+            self.measure_multichannel = measure_resistance_multichannel
+
     # @pyqtSlot()
     # def series_start(self):
     #     """start the timer for the series, with the current interval"""
@@ -482,7 +651,7 @@ class OneShot_Thread_multichannel(AbstractEventhandlingThread):
     def measure_oneshot_once(self):
         """invoke a single measurement and send it to saving the data"""
         with locking(self.mainthread.controls_Lock):
-            data = measure_resistance_multichannel(**self.conf)
+            data = self.measure_multichannel(**self.conf)
             data["type"] = "multichannel"
         self.sig_storing.emit(deepcopy(data))
 
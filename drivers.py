@@ -4,11 +4,31 @@ This module requires a National Instruments VISA driver, which can be found at
 https://www.ni.com/visa/
 It also requires an Agilent VISA driver - if there is need for either one
 (at least one VISA driver is required, may depend on your instrumentation)
+For running without any hardware (and without VISA driver),
+a simulated backend can be used, see simulation.py and use_simulated_backend()
+The VISA traffic can be recorded, and replayed later on,
+see recording.py, start_recording() and use_replay_backend()
 
 Attributes:
     logger: a python logger object
 
 Classes:
+        AdaptivePacing: learns the minimal safe delay between two
+            transactions with a device
+
+        BusScheduler: owns one physical bus (a GPIB board, a serial port),
+            executes the transactions of all instruments on it one after
+            the other, by priority
+
+        bus_priority: context manager setting the priority of the
+            transactions of the current thread
+
+        LatencyHistogram: histogram of durations on logarithmic buckets,
+            with percentiles
+
+        IOStatistics: per-command counters and latency histograms
+            of one instrument
+
         AbstractSerialDeviceDriver: used for interactions with a serial connection
             the characteristics of the serial connection can be specified
             defaults are good for connections with "Oxford Instruments" devices
@@ -23,20 +43,42 @@ Author(s):
 import threading
 import logging
 import time
+import math
+import heapq
+import itertools
+import re
+import weakref
+from bisect import bisect_left
+from collections import deque
 import visa
 from pyvisa.errors import VisaIOError
 from visa import constants as vconst
 
+VI_ERROR_TMO = -1073807339
+
+# priorities of transactions on a bus, lower is more urgent
+PRIORITY_MEASUREMENT = 0
+PRIORITY_COMMAND = 1
+PRIORITY_POLL = 2
+PRIORITY_NAMES = {
+    PRIORITY_MEASUREMENT: "measurement",
+    PRIORITY_COMMAND: "command",
+    PRIORITY_POLL: "poll",
+}
+
 # create a logger object for this module
 logger = logging.getLogger(__name__)
 
 keysight = False
 ni = False
+simulation = False
+SIMULATED_RESOURCE_MANAGER = None
+RECORDER = None
 try:
     # the pyvisa manager we'll use to connect to the GPIB resources
     NI_RESOURCE_MANAGER = visa.ResourceManager()
     ni = True
-except OSError:
+except (OSError, ValueError):
     logger.exception(
         "\n\tCould not find the NI VISA library. Is the National Instruments VISA driver installed?\n\n"
     )
@@ -45,7 +87,7 @@ try:
         "C:\\Windows\\System32\\agvisa32.dll"
     )
     keysight = True
-except OSError:
+except (OSError, ValueError):
     logger.exception(
         "\n\tCould not find the keysight VISA library. Is it installed?\n\n"
     )
@@ -56,18 +98,518 @@ if not (ni or keysight):
     logger.exception("I could not find any VISA library! \n\n")
 
 
+def use_simulated_backend(resource_manager=None):
+    """route all drivers created from now on to simulated instruments
+
+    resource_manager: a simulation.SimulatedResourceManager,
+        if None, one with the instruments from simulation.default_instruments()
+    returns the resource manager in use
+    """
+    global simulation, SIMULATED_RESOURCE_MANAGER
+    if resource_manager is None:
+        import simulation as sim
+
+        resource_manager = sim.SimulatedResourceManager(sim.default_instruments())
+    SIMULATED_RESOURCE_MANAGER = resource_manager
+    simulation = True
+    return resource_manager
+
+
+def use_replay_backend(path, speed=1.0, loop=True):
+    """route all drivers created from now on to the instruments
+    recorded in the trace file path, see recording.ReplayResourceManager
+
+    returns the resource manager in use
+    """
+    import recording
+
+    return use_simulated_backend(
+        recording.ReplayResourceManager(path, speed=speed, loop=loop)
+    )
+
+
+def start_recording(path):
+    """record the VISA traffic of all drivers to the trace file path,
+    see recording.TrafficRecorder
+
+    returns the recorder
+    """
+    global RECORDER
+    import recording
+
+    stop_recording()
+    RECORDER = recording.TrafficRecorder(path)
+    return RECORDER
+
+
+def stop_recording():
+    """stop recording the VISA traffic, close the trace file"""
+    global RECORDER
+    if RECORDER is not None:
+        RECORDER.close()
+        RECORDER = None
+
+
+def use_bus_scheduling(enable=True):
+    """route the transactions of all drivers created from now on
+    through the scheduler of their bus, or let every driver
+    access its resource directly (the default)"""
+    global bus_scheduling
+    bus_scheduling = enable
+
+
+def bus_name(InstrumentAddress):
+    """the bus of a VISA resource: 'GPIB0::5::INSTR' -> 'GPIB0', 'ASRL6::INSTR' -> 'ASRL6'"""
+    name = InstrumentAddress.split("::")[0].strip().upper()
+    if name == "GPIB":
+        name = "GPIB0"
+    return name
+
+
+_priority = threading.local()
+
+
+class bus_priority:
+    """Context manager setting the priority of all bus transactions
+    of the current thread, e.g. PRIORITY_MEASUREMENT for a measurement,
+    so that its transactions are executed before queued background polls"""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self._previous = None
+
+    def __enter__(self, *args, **kwargs):
+        self._previous = getattr(_priority, "value", None)
+        _priority.value = self.priority
+
+    def __exit__(self, *args, **kwargs):
+        _priority.value = self._previous
+
+
+def current_priority():
+    """priority of bus transactions of the current thread"""
+    value = getattr(_priority, "value", None)
+    return PRIORITY_COMMAND if value is None else value
+
+
+class _BusJob(object):
+    """one transaction, waiting to be executed by a BusScheduler"""
+
+    def __init__(self, function, args, kwargs, priority):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BusScheduler(object):
+    """Owns one physical bus, executes all transactions on it in its own thread
+
+    The instruments on a bus cannot talk at the same time anyway, so instead
+    of racing for the adapter, every transaction is submitted as a job.
+    Jobs are executed one after the other, the most urgent (lowest)
+    priority first, in order of submission within a priority. A running
+    transaction is never interrupted, but a measurement transaction
+    overtakes all queued polls.
+    The time the bus spends in transactions is recorded, utilization()
+    is the busy fraction of the last 'window' seconds.
+    """
+
+    def __init__(self, name, window=60.0):
+        self.name = name
+        self.window = window
+        self._queue = []
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+        self._busy = deque()
+        self._started = time.monotonic()
+        self.jobs = {priority: 0 for priority in PRIORITY_NAMES}
+        self.waiting = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._thread = threading.Thread(
+            target=self._serve, name="bus " + name, daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, function, *args, priority=None, timeout=None, **kwargs):
+        """execute function(*args, **kwargs) on the bus, return its result
+
+        blocks until the job was executed, exceptions are re-raised here
+        timeout: seconds to wait for the job at most (None: no limit),
+            afterwards a job still queued is dropped, and a VISA timeout
+            is raised, so that a hanging bus does not hang its callers
+        """
+        if threading.current_thread() is self._thread:
+            return function(*args, **kwargs)
+        if priority is None:
+            priority = current_priority()
+        job = _BusJob(function, args, kwargs, priority)
+        entry = (priority, next(self._counter), job)
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            self._condition.notify()
+        if not job.done.wait(timeout):
+            with self._condition:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+            logger.error(
+                "bus %s: no transaction within %.1f s (bus thread %s)",
+                self.name,
+                timeout,
+                "alive" if self._thread.is_alive() else "dead",
+            )
+            raise VisaIOError(VI_ERROR_TMO)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _serve(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                __, __, job = heapq.heappop(self._queue)
+            start = time.monotonic()
+            try:
+                job.result = job.function(*job.args, **job.kwargs)
+            except BaseException as e:
+                job.error = e
+            finally:
+                end = time.monotonic()
+                self._record(job, start, end)
+                job.done.set()
+
+    def _record(self, job, start, end):
+        with self._condition:
+            self.jobs[job.priority] = self.jobs.get(job.priority, 0) + 1
+            self.waiting[job.priority] = (
+                self.waiting.get(job.priority, 0.0) + start - job.submitted
+            )
+            self._busy.append((start, end))
+            while self._busy and self._busy[0][1] < end - self.window:
+                self._busy.popleft()
+
+    def queued(self):
+        """number of jobs waiting for the bus"""
+        with self._condition:
+            return len(self._queue)
+
+    def utilization(self):
+        """fraction of the last 'window' seconds the bus was busy"""
+        now = time.monotonic()
+        begin = max(now - self.window, self._started)
+        if now <= begin:
+            return 0.0
+        with self._condition:
+            busy = sum(end - max(start, begin) for start, end in self._busy if end > begin)
+        return min(busy / (now - begin), 1.0)
+
+    def statistics(self):
+        """utilization, and number of jobs and mean waiting time per priority"""
+        with self._condition:
+            jobs = dict(self.jobs)
+            waiting = dict(self.waiting)
+        return dict(
+            bus=self.name,
+            utilization=self.utilization(),
+            queued=self.queued(),
+            jobs={PRIORITY_NAMES.get(p, p): n for p, n in jobs.items()},
+            mean_wait={
+                PRIORITY_NAMES.get(p, p): waiting[p] / n if n else 0.0
+                for p, n in jobs.items()
+            },
+        )
+
+
+BUS_SCHEDULERS = dict()
+_bus_schedulers_lock = threading.Lock()
+# off, until it has run on all the hardware
+bus_scheduling = False
+
+
+def bus_scheduler(name):
+    """the scheduler of the bus 'name', created when first used"""
+    with _bus_schedulers_lock:
+        if name not in BUS_SCHEDULERS:
+            BUS_SCHEDULERS[name] = BusScheduler(name)
+        return BUS_SCHEDULERS[name]
+
+
+def bus_statistics():
+    """statistics of all bus schedulers"""
+    with _bus_schedulers_lock:
+        schedulers = list(BUS_SCHEDULERS.values())
+    return {scheduler.name: scheduler.statistics() for scheduler in schedulers}
+
+
+class LatencyHistogram(object):
+    """histogram of durations, on logarithmically spaced buckets
+
+    per_decade buckets per decade between lowest and highest [s],
+    percentiles are the upper edges of the buckets they fall in
+    (so they are accurate to a factor of 10**(1/per_decade)),
+    but never larger than the largest duration seen
+    """
+
+    def __init__(self, lowest=1e-5, highest=100.0, per_decade=10):
+        decades = int(round(math.log10(highest / lowest)))
+        self.edges = [
+            lowest * 10 ** (i / per_decade) for i in range(decades * per_decade + 1)
+        ]
+        self.buckets = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.buckets[bisect_left(self.edges, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+    def percentile(self, p):
+        """the duration below which p percent of the durations are"""
+        if not self.count:
+            return math.nan
+        rank = p / 100 * self.count
+        cumulative = 0
+        for index, n in enumerate(self.buckets):
+            cumulative += n
+            if cumulative >= rank and n:
+                edge = self.edges[index] if index < len(self.edges) else self.max
+                return min(edge, self.max)
+        return self.max
+
+
+def command_key(command):
+    """the command without its arguments, to collect statistics per command
+
+    'KRDG? 0' -> 'KRDG?', 'CURR 1.0e-03' -> 'CURR', '$T4.200' -> '$T',
+    Oxford read commands keep their number: 'R1' -> 'R1'
+    """
+    header = command.strip().split(" ")[0]
+    if re.match(r"^\$?R\d+$", header):
+        return header
+    return re.split(r"[-+\d.,]", header, maxsplit=1)[0] or header
+
+
+class IOStatistics(object):
+    """per-command counters and latency histograms of one instrument
+
+    per command (see command_key): number of transactions, timeouts,
+    other errors, bad replies, retries, and histograms of the duration
+    of the transactions and of the time spent waiting for the
+    communication lock
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = dict()
+
+    def _entry(self, command):
+        key = command_key(command)
+        if key not in self.commands:
+            self.commands[key] = dict(
+                timeouts=0,
+                errors=0,
+                bad_replies=0,
+                retries=0,
+                latency=LatencyHistogram(),
+                lock_wait=LatencyHistogram(),
+            )
+        return self.commands[key]
+
+    def transaction(self, command, duration, lock_wait=None, timeout=False, error=False):
+        """register a transaction, and whether it failed"""
+        with self._lock:
+            entry = self._entry(command)
+            entry["latency"].add(duration)
+            if lock_wait is not None:
+                entry["lock_wait"].add(lock_wait)
+            if timeout:
+                entry["timeouts"] += 1
+            elif error:
+                entry["errors"] += 1
+
+    def bad_reply(self, command):
+        with self._lock:
+            self._entry(command)["bad_replies"] += 1
+
+    def retry(self, command):
+        with self._lock:
+            self._entry(command)["retries"] += 1
+
+    def reset(self):
+        with self._lock:
+            self.commands = dict()
+
+    def summary(self):
+        """dict command: counters, and mean/p50/p95/p99/max of the latency
+        and mean/p95 of the lock waiting time, in seconds"""
+        with self._lock:
+            return {
+                key: dict(
+                    count=entry["latency"].count,
+                    timeouts=entry["timeouts"],
+                    errors=entry["errors"],
+                    bad_replies=entry["bad_replies"],
+                    retries=entry["retries"],
+                    mean=entry["latency"].mean(),
+                    p50=entry["latency"].percentile(50),
+                    p95=entry["latency"].percentile(95),
+                    p99=entry["latency"].percentile(99),
+                    max=entry["latency"].max,
+                    lock_wait_mean=entry["lock_wait"].mean(),
+                    lock_wait_p95=entry["lock_wait"].percentile(95),
+                )
+                for key, entry in self.commands.items()
+            }
+
+
+DRIVERS = weakref.WeakSet()
+
+
+def io_statistics():
+    """I/O statistics of all drivers, dict resource name: dict command: statistics"""
+    statistics = dict()
+    for driver in list(DRIVERS):
+        statistics.setdefault(driver._resource_name, dict()).update(
+            driver.io_statistics()
+        )
+    return statistics
+
+
+def reset_io_statistics():
+    """reset the I/O statistics of all drivers"""
+    for driver in list(DRIVERS):
+        driver.reset_io_statistics()
+
+
+class AdaptivePacing(object):
+    """Learns the minimal safe delay between two transactions with a device
+
+    After every 'patience' successful transactions in a row, the delay is
+    decreased by the factor 'decrease'. Upon a failure (timeout or garbled reply),
+    the delay is increased by the factor 'increase', and the delay at which the
+    failure occurred (times 'margin') is remembered as a floor, below which the
+    delay does not decrease anymore. The floor itself is slowly forgotten
+    (factor 'forget' per decrease step), so a single failure does not
+    slow down the communication forever.
+    """
+
+    def __init__(
+        self,
+        delay,
+        delay_min=0.0,
+        delay_max=1.0,
+        decrease=0.9,
+        increase=1.5,
+        patience=10,
+        margin=1.1,
+        forget=0.95,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.delay_min = delay_min
+        self.delay_max = delay_max
+        self.decrease = decrease
+        self.increase = increase
+        self.patience = patience
+        self.margin = margin
+        self.forget = forget
+
+        self.floor = delay_min
+        self.streak = 0
+        self.transactions = 0
+        self.timeouts = 0
+        self.bad_replies = 0
+
+    def success(self):
+        """register a successful transaction"""
+        self.transactions += 1
+        self.streak += 1
+        if self.streak >= self.patience:
+            self.streak = 0
+            self.floor = max(self.floor * self.forget, self.delay_min)
+            self.delay = max(self.delay * self.decrease, self.floor)
+
+    def failure(self, timeout=False):
+        """register a failed transaction, a timeout or a garbled reply"""
+        self.transactions += 1
+        if timeout:
+            self.timeouts += 1
+        else:
+            self.bad_replies += 1
+        self.streak = 0
+        # at least 1 ms, in case the delay went down to zero
+        self.floor = min(max(self.floor, self.delay * self.margin, 1e-3), self.delay_max)
+        self.delay = min(max(self.delay * self.increase, self.floor), self.delay_max)
+
+    def statistics(self):
+        """current state of the pacing"""
+        return dict(
+            delay=self.delay,
+            floor=self.floor,
+            transactions=self.transactions,
+            timeouts=self.timeouts,
+            bad_replies=self.bad_replies,
+        )
+
+
 class AbstractVISADriver(object):
     """Abstract VISA Device Driver
 
-    visalib: 'ni' or 'ks' (national instruments/keysight)
+    visalib: 'ni', 'ks' or 'sim' (national instruments/keysight/simulated)
+        if the simulated backend is in use (use_simulated_backend()),
+        every driver is simulated regardless of visalib
+    bus: name of the bus the instrument is on, default: from InstrumentAddress
+        all transactions go through the BusScheduler of this bus,
+        if bus scheduling is enabled (use_bus_scheduling())
+        bus_timeout_margin: seconds a transaction may wait for the bus
+        on top of the timeout of the resource, before it fails
+
+    write_cached() skips writing a setting which was already written
+    with the same value, unless this was more than write_cache_refresh
+    seconds ago (None: never write again)
     """
 
-    def __init__(self, InstrumentAddress, visalib="ni", **kwargs):
+    write_cache_refresh = 60.0  # seconds
+    bus_timeout_margin = 10.0  # seconds
+
+    def __init__(self, InstrumentAddress, visalib="ni", bus=None, **kwargs):
         super(AbstractVISADriver, self).__init__(**kwargs)
 
         self._comLock = threading.Lock()
         self.delay = 0
         self.delay_force = 0
+        self._pacing = None
+        self._resource_name = InstrumentAddress
+        self._statistics = IOStatistics()
+        self._last_command = ""
+        self._write_cache = dict()
+        self._write_cache_statistics = dict(writes=0, suppressed=0)
+        DRIVERS.add(self)
+        self._bus = (
+            bus_scheduler(bus or bus_name(InstrumentAddress))
+            if bus_scheduling
+            else None
+        )
+
+        if simulation or visalib.strip() == "sim":
+            if SIMULATED_RESOURCE_MANAGER is None:
+                use_simulated_backend()
+            self._visa_resource = SIMULATED_RESOURCE_MANAGER.open_resource(
+                InstrumentAddress
+            )
+            return
 
         if visalib.strip() == "ni" and not ni:
             raise NameError("The VISA library was not found!")
@@ -84,42 +626,216 @@ class AbstractVISADriver(object):
     def res_close(self):
         self._visa_resource.close()
 
+    def enable_adaptive_pacing(self, **kwargs):
+        """replace the fixed delay after each transaction by an adaptive one
+
+        the pacing starts at the current self.delay,
+        kwargs are passed to AdaptivePacing
+        """
+        self._pacing = AdaptivePacing(delay=self.delay, **kwargs)
+
+    def disable_adaptive_pacing(self):
+        """go back to the fixed delay self.delay"""
+        self._pacing = None
+
+    def pacing_statistics(self):
+        """the delay currently used after each transaction,
+        and the statistics of the adaptive pacing, if enabled"""
+        if self._pacing is None:
+            return dict(delay=self.delay, adaptive=False)
+        return dict(adaptive=True, **self._pacing.statistics())
+
+    def report_bad_reply(self, command=None):
+        """register a garbled reply, to be called by the instrument classes
+
+        command: the command which got the reply, default: the last one sent
+        """
+        self._statistics.bad_reply(self._last_command if command is None else command)
+        if self._pacing is not None:
+            self._pacing.failure()
+
+    def report_retry(self, command=None):
+        """register the retry of a command, to be called by the instrument classes"""
+        self._statistics.retry(self._last_command if command is None else command)
+
+    def io_statistics(self):
+        """per-command counters and latencies, see IOStatistics.summary()"""
+        return self._statistics.summary()
+
+    def reset_io_statistics(self):
+        self._statistics.reset()
+
+    def _measured(self, command, lock_wait, function, *args):
+        """execute one transaction, register its duration and outcome
+
+        lock_wait: time spent waiting for the communication lock, if any
+        """
+        if args:
+            self._last_command = command
+        start = time.monotonic()
+        try:
+            answer = self._transaction(function, *args)
+        except VisaIOError as e_visa:
+            self._statistics.transaction(
+                command,
+                time.monotonic() - start,
+                lock_wait,
+                timeout=e_visa.error_code == VI_ERROR_TMO,
+                error=e_visa.error_code != VI_ERROR_TMO,
+            )
+            raise
+        self._statistics.transaction(command, time.monotonic() - start, lock_wait)
+        return answer
+
+    def _transaction(self, function, *args):
+        """execute one transaction with the resource, on its bus if scheduled
+
+        the waiting for the pacing delay happens outside of the bus,
+        which can serve other instruments in the meantime
+        the transaction is recorded, if a recording is running
+        """
+        if RECORDER is not None:
+            function, args = RECORDER.wrap(self._resource_name, function, *args), ()
+        return self._on_bus(function, *args)
+
+    def _on_bus(self, function, *args):
+        """execute function on the bus of the resource, if scheduled,
+        without recording it"""
+        if self._bus is None:
+            return function(*args)
+        return self._bus.submit(function, *args, timeout=self._bus_timeout())
+
+    def _bus_timeout(self):
+        """seconds to wait for a transaction on the bus at most"""
+        timeout = getattr(self._visa_resource, "timeout", None)
+        if timeout is None or math.isinf(timeout):
+            return None
+        return timeout / 1e3 + self.bus_timeout_margin
+
+    def _pace(self):
+        """wait the delay required after a transaction"""
+        time.sleep(self.delay if self._pacing is None else self._pacing.delay)
+
     def write(self, command, f=False):
         """
             low-level communication wrapper for visa.write with Communication Lock,
             to prevent multiple writes to serial adapter
         """
         if not f:
+            requested = time.monotonic()
             with self._comLock:
-                self._visa_resource.write(command)
-                time.sleep(self.delay)
+                self._measured(
+                    command,
+                    time.monotonic() - requested,
+                    self._visa_resource.write,
+                    command,
+                )
+                self._pace()
         else:
-            self._visa_resource.write(command)
+            self._measured(command, None, self._visa_resource.write, command)
             time.sleep(self.delay_force)
 
-    def query(self, command):
+    def query(self, command, f=False):
         """Sends commands as strings to the device and receives strings from the device
 
         low-level communication wrapper for visa.query with Communication Lock,
         to prevent multiple writes to serial adapter
+        f: the Communication Lock is already held by the caller (as with write)
         """
+        if f:
+            answer = self._measured(command, None, self._visa_resource.query, command)
+            time.sleep(self.delay_force)
+            return answer
+        requested = time.monotonic()
         with self._comLock:
-            answer = self._visa_resource.query(command)
-            time.sleep(self.delay)
+            try:
+                answer = self._measured(
+                    command,
+                    time.monotonic() - requested,
+                    self._visa_resource.query,
+                    command,
+                )
+            except VisaIOError as e_visa:
+                if self._pacing is not None and e_visa.error_code == VI_ERROR_TMO:
+                    self._pacing.failure(timeout=True)
+                raise
+            if self._pacing is not None:
+                self._pacing.success()
+            self._pace()
         return answer
 
     def read(self):
+        requested = time.monotonic()
         with self._comLock:
-            answer = self._visa_resource.read()
+            answer = self._measured(
+                self._last_command, time.monotonic() - requested, self._visa_resource.read
+            )
             # time.sleep(self.delay)
         return answer
 
+    def write_cached(self, command, key=None):
+        """write a setting, unless it was written with the same value before
+
+        a setting is only cached once the write succeeded, and it is
+        written again anyway after write_cache_refresh seconds, in case it
+        was changed on the instrument in the meantime
+
+        :param command: the command to send, e.g. '$P10'
+        :param key: the setting the command sets, default: the command
+            up to the first digit, sign, decimal point or space, e.g. '$P'
+        :return: True if the command was sent, False if it was suppressed
+        """
+        if key is None:
+            key = re.match(r"[^\d+\-.\s]*", command).group()
+        cached = self._write_cache.get(key)
+        if (
+            cached is not None
+            and cached[0] == command
+            and (
+                self.write_cache_refresh is None
+                or time.monotonic() - cached[1] < self.write_cache_refresh
+            )
+        ):
+            self._write_cache_statistics["suppressed"] += 1
+            return False
+        self.write(command)
+        self._write_cache[key] = (command, time.monotonic())
+        self._write_cache_statistics["writes"] += 1
+        return True
+
+    def invalidate_write_cache(self, *keys):
+        """forget the cached settings for keys (all, if none are given),
+        so that they are written with the next write_cached()"""
+        if not keys:
+            self._write_cache = dict()
+        for key in keys:
+            self._write_cache.pop(key, None)
+
+    def write_cache_statistics(self):
+        """number of writes sent and suppressed by write_cached()"""
+        return dict(self._write_cache_statistics)
+
 
 class AbstractSerialDeviceDriver(AbstractVISADriver):
     """Abstract Device driver class
+
+    Bad replies (empty, or not echoing the command, as it happens with a
+    noisy serial line, or when a late reply is still in the input buffer)
+    are handled by query_checked(): the input buffer is flushed and the
+    query is repeated after a backoff delay, which grows exponentially
+    (retry_backoff * retry_factor**n, at most retry_backoff_max),
+    for at most retry_attempts attempts in total.
     """
 
-    timeouterror = VisaIOError(-1073807339)
+    timeouterror = VisaIOError(VI_ERROR_TMO)
+
+    retry_attempts = 4
+    retry_backoff = 0.02  # seconds
+    retry_factor = 2
+    retry_backoff_max = 0.5  # seconds
+    # timeout of the reads draining the input buffer,
+    # for resources which cannot be flushed
+    flush_timeout = 20  # milliseconds
 
     def __init__(
         self,
@@ -143,12 +859,125 @@ class AbstractSerialDeviceDriver(AbstractVISADriver):
 
         self.delay = 0.1
         self.delay_force = 0.1
+        self._retry_statistics = dict(queries=0, retries=0, recovered=0, failed=0)
+        # cleared if the resource turns out not to support viFlush
+        self._flush_supported = True
+
+    def query_checked(self, command, expected, parse=None, f=False):
+        """query, verifying that the reply starts with 'expected'
+
+        a reply which is empty, does not start with 'expected', or cannot be
+        parsed, is a bad reply: the input buffer is flushed, and after the
+        backoff delay the query is repeated, at most retry_attempts times
+        in total. Timeouts are not retried, but raised right away.
+
+        :param command: command to send
+        :param expected: the expected start of the reply, e.g. 'R'
+        :param parse: function converting the reply, e.g. float,
+            a ValueError marks a bad reply
+        :param f: the Communication Lock is already held by the caller
+        :return: the (parsed) reply
+        """
+        self._retry_statistics["queries"] += 1
+        delay = self.retry_backoff
+        value = None
+        for attempt in range(self.retry_attempts):
+            if attempt:
+                self.report_retry(command)
+                self._retry_statistics["retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * self.retry_factor, self.retry_backoff_max)
+            value = self.query(command, f=f)
+            if value and value.startswith(expected):
+                try:
+                    parsed = value if parse is None else parse(value)
+                except ValueError:
+                    pass
+                else:
+                    if attempt:
+                        self._retry_statistics["recovered"] += 1
+                    return parsed
+            self.report_bad_reply(command)
+            self.flush_input(f=f)
+        self._retry_statistics["failed"] += 1
+        raise AssertionError(
+            "{}: no valid reply to {} after {} attempts, last reply: {}".format(
+                type(self).__name__, command, self.retry_attempts, repr(value)
+            )
+        )
+
+    def retry_statistics(self):
+        """number of checked queries, retries, queries which succeeded
+        after a retry, and queries which failed after all attempts"""
+        return dict(self._retry_statistics)
+
+    def flush_input(self, f=False):
+        """discard whatever is waiting in the input buffer
+
+        the VISA read buffer and the serial receive buffer are discarded
+        in place (viFlush), which takes no time at all. Resources which
+        cannot be flushed are drained: what bytes_in_buffer reports is
+        read, and only if that is not available either, replies are read
+        with a short timeout (flush_timeout) until nothing is left
+        f: the Communication Lock is already held by the caller (as with write)
+        """
+        if f:
+            self._flush_input()
+        else:
+            with self._comLock:
+                self._flush_input()
+
+    def _flush_input(self):
+        start = time.monotonic()
+        # on the bus, as any other transaction, returns whether
+        # the input still needs to be drained
+        if not self._on_bus(self._discard_input):
+            self._drain_input()
+        self._statistics.transaction("<flush>", time.monotonic() - start)
+
+    def _discard_input(self):
+        """flush the input buffers, or read what is waiting in them
+
+        returns False if neither is possible
+        """
+        if self._flush_supported:
+            try:
+                self._visa_resource.flush(
+                    vconst.VI_READ_BUF_DISCARD | vconst.VI_IO_IN_BUF_DISCARD
+                )
+                return True
+            except (AttributeError, NotImplementedError, VisaIOError):
+                self._flush_supported = False
+        try:
+            waiting = self._visa_resource.bytes_in_buffer
+        except (AttributeError, VisaIOError):
+            return False
+        if waiting:
+            self._visa_resource.read_bytes(waiting)
+        return True
+
+    def _drain_input(self):
+        """read with a short timeout, until nothing is left"""
+        timeout = self._visa_resource.timeout
+        self._visa_resource.timeout = self.flush_timeout
+        try:
+            # a few replies at most can pile up
+            for __ in range(10):
+                self._measured(self._last_command, None, self._visa_resource.read)
+        except VisaIOError as e_visa:
+            if e_visa.error_code != VI_ERROR_TMO:
+                raise
+        finally:
+            self._visa_resource.timeout = timeout
 
     def clear_buffers(self):
+        """discard stale replies, e.g. after a timeout
+
+        a reply arriving only after this, is caught by query_checked()
+        """
         # self._visa_resource.timeout = 5
         try:
-            # with self._comLock:
-            self.read()
+            self.flush_input()
         except VisaIOError as e_visa:
             if (
                 isinstance(e_visa, type(self.timeouterror))
@@ -176,6 +1005,26 @@ class AbstractGPIBDeviceDriver(AbstractVISADriver):
         """
         return super().query(command).strip().split(",")
 
+    def query_batch(self, commands):
+        """Sends several queries in one transaction and splits the answer per query
+
+        The queries are joined by ';', the device answers
+        with the single answers joined by ';' as well.
+
+        :param commands: queries to be sent
+        :type commands: list of str
+
+        :return: list of answers, each split on ',' as in query()
+        """
+        answer = super().query(";".join(commands)).strip().split(";")
+        if len(answer) != len(commands):
+            raise AssertionError(
+                "GPIB: query_batch: got {} answers for {} queries: {}".format(
+                    len(answer), len(commands), answer
+                )
+            )
+        return [single.strip().split(",") for single in answer]
+
     def go(self, command):
         """Sends commands as strings to the device
 
@@ -8,15 +8,18 @@ import time
 import pickle
 import os
 import sqlite3
+import json
+from collections import deque
 
 # import pandas as pd
 import numpy as np
-from numpy.polynomial.polynomial import polyfit as nppolyfit
 from copy import deepcopy
 import math
 
 
 from util import AbstractLoopThread
+from util import RingBuffer
+from util import RollingStatistics
 from util import AbstractEventhandlingThread
 from util import Window_ui
 from util import convert_time
@@ -66,6 +69,22 @@ def sql_buildDictTableString(dictname):
     return string
 
 
+def sql_buildInsertString(tablename, keys):
+    """build a parameterized INSERT statement for one row with all keys as columns"""
+    return """INSERT INTO {table} ({columns}) VALUES ({placeholders})""".format(
+        table=tablename, columns=",".join(keys), placeholders=",".join("?" * len(keys))
+    )
+
+
+def sql_rowValues(dictname, keys):
+    """values of one row, in the order of keys, NaN and None stored as NULL"""
+    values = []
+    for key in keys:
+        var, bools = testing_NaN(dictname[key])
+        values.append(None if bools else var)
+    return values
+
+
 def change_to_correct_types(tablename, dictname):
     sql = []
     if not dictname:
@@ -98,6 +117,102 @@ def change_to_correct_types(tablename, dictname):
     return sql
 
 
+def json_default(obj):
+    """convert what json cannot handle itself (e.g. numpy scalars)"""
+    try:
+        return obj.item()
+    except AttributeError:
+        return str(obj)
+
+
+class Spool(object):
+    """append-only file holding logging data which could not be written to the database
+
+    one json document (data dict) per line. The number of bytes already
+    drained into the database is kept in '<path>.offset', so draining
+    continues where it stopped, also after a restart.
+    Once everything is drained, both files are removed.
+    The spool is bounded by max_bytes, further data is dropped.
+    """
+
+    def __init__(self, path, max_bytes=100e6, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.offsetpath = path + ".offset"
+        self.max_bytes = max_bytes
+        self.dropped = 0
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def offset(self):
+        try:
+            with open(self.offsetpath, "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def pending(self):
+        """whether there is data to be drained"""
+        return self.size() > self.offset()
+
+    def append(self, entries):
+        """append entries to the spool, return the number of entries dropped"""
+        size = self.size()
+        dropped = 0
+        with open(self.path, "a") as f:
+            for entry in entries:
+                line = json.dumps(entry, default=json_default) + "\n"
+                if size + len(line) > self.max_bytes:
+                    dropped += 1
+                    continue
+                f.write(line)
+                size += len(line)
+        self.dropped += dropped
+        return dropped
+
+    def read(self, n):
+        """read up to n entries from the current offset
+
+        returns the entries and the offset after them,
+        to be handed to consume() once they are stored
+        """
+        offset = self.offset()
+        entries = []
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                while len(entries) < n:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        # end of file, or a line which is not completely written
+                        break
+                    offset += len(line)
+                    try:
+                        entries.append(json.loads(line.decode()))
+                    except ValueError:
+                        # corrupted line, skip it
+                        pass
+        except OSError:
+            pass
+        return entries, offset
+
+    def consume(self, offset):
+        """mark everything up to offset as drained"""
+        if offset >= self.size():
+            for path in (self.path, self.offsetpath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        else:
+            with open(self.offsetpath, "w") as f:
+                f.write(str(offset))
+
+
 class Logger_configuration(Window_ui):
     """docstring for Logger_configuration"""
 
@@ -213,11 +328,20 @@ class Logger_configuration(Window_ui):
 
 class main_Logger(AbstractLoopThread):
     """This is a the logging worker thread
+
+    data is queued and committed to the database in groups, when
+    group_rows entries are queued or group_time seconds have passed.
+    If the database cannot be written, the queued data goes to
+    an on-disk spool, which is drained (spool_drain_rows entries at a time)
+    once the database can be written again.
     """
 
     sig_configuring = pyqtSignal(bool)
     sig_log = pyqtSignal()
 
+    # log on a fixed grid of timestamps
+    schedule_mode = "fixed"
+
     def __init__(self, mainthread, **kwargs):
         super().__init__(**kwargs)
         self.mainthread = mainthread
@@ -232,7 +356,16 @@ class main_Logger(AbstractLoopThread):
         self.conf_done_layer2 = False
 
         self.not_yet_initialised = False
-        self.local_list = []
+        self.queue = deque()
+        self.group_rows = 10
+        self.group_time = 10  # seconds
+        self.spool_drain_rows = 100
+        self.last_commit = time.monotonic()
+        # set with the database, in update_conf
+        self.spool = None
+        self.conn = None
+        self.dbname = None
+        self.schema = dict()
 
     def running(self):
         """perpetual logging function, which is asking for logging data"""
@@ -257,35 +390,85 @@ class main_Logger(AbstractLoopThread):
         """
         self.conf = conf
         self.interval = self.conf["general"]["interval"]
+        self.group_rows = self.conf["general"].get("group_rows", self.group_rows)
+        self.group_time = self.conf["general"].get("group_time", self.group_time)
+        # one spool per database, so that it is drained into the right one
+        spool_location = self.conf["general"].get(
+            "spool_location", self.conf["general"]["logfile_location"] + ".spool.jsonl"
+        )
+        if self.spool is None or self.spool.path != spool_location:
+            self.spool = Spool(spool_location)
         self.configuration_done = True
         self.conf_done_layer2 = False
 
     def connectdb(self, dbname):
-        """connect to the sqlite database"""
+        """connect to the sqlite database, keeping the connection open
+
+        the database is put into WAL mode, so that readers
+        (e.g. plotting from the database) do not block the logging
+        """
+        if self.conn is not None and dbname == self.dbname:
+            return True
+        self.disconnectdb()
         try:
-            self.conn = sqlite3.connect(dbname)
+            # the queue is flushed from the main thread when the logger
+            # is stopped, once its thread has finished
+            self.conn = sqlite3.connect(dbname, check_same_thread=False)
+            self.conn.execute("""PRAGMA journal_mode=WAL""")
+            self.conn.execute("""PRAGMA synchronous=NORMAL""")
+            self.mycursor = self.conn.cursor()
+            self.dbname = dbname
             return True
-        except sqlite3.connect.Error as err:
+        except sqlite3.Error as err:
+            # close a connection which was opened, but could not be set up
+            self.disconnectdb()
             self.sig_assertion.emit(
                 "Logger: Couldn't establish connection: {}".format(err)
             )
             return False
 
+    def disconnectdb(self):
+        """close the connection to the database, if there is one"""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = None
+        self.dbname = None
+        self.schema = dict()
+
+    def readschema(self, tablename):
+        """the (lowercase) column names of a table, from the schema cache
+
+        the cache is filled from the database once per table and connection
+        """
+        if tablename not in self.schema:
+            self.mycursor.execute("""PRAGMA table_info({})""".format(tablename))
+            self.schema[tablename] = {
+                column[1].lower() for column in self.mycursor.fetchall()
+            }
+        return self.schema[tablename]
+
     def createtable(self, tablename, dictname):
         """create the sql table if it does not exist,
             with all columns named after the keys in the dictionary
-        """
 
-        sql = "CREATE TABLE IF NOT EXISTS {} ".format(tablename)
-        sql += sql_buildDictTableString(dictname)
-        # print(sql)
-        try:
+            only keys which are not yet columns (according to the
+            schema cache) lead to DDL statements
+        """
+        columns = self.readschema(tablename)
+        if not columns:
+            sql = "CREATE TABLE IF NOT EXISTS {} ".format(tablename)
+            sql += sql_buildDictTableString(dictname)
+            # print(sql)
             self.mycursor.execute(sql)
-        except OperationalError as err:
-            # print(err)
-            pass
+            columns.update(["id"] + [key.lower() for key in dictname.keys()])
+            return
 
         for key in dictname.keys():
+            if key.lower() in columns:
+                continue
             try:
                 sql = """ALTER TABLE  {} ADD COLUMN {} {}""".format(
                     tablename, key, typeof(dictname[key])
@@ -293,43 +476,35 @@ class main_Logger(AbstractLoopThread):
                 # print(sql)
                 self.mycursor.execute(sql)
             except OperationalError as err:
-                # print(err)
-                pass  # Logger: probably the column already exists, no problem.
+                if "duplicate column" not in err.args[0]:
+                    raise
+                # Logger: the column already exists, no problem.
+            columns.add(key.lower())
 
     def updatetable(self, tablename, dictname):
-        """insert a new row into the database table with all data
-            a table-updating scheme was chosen to loop through all key-value pairs,
-            instead of an approach where the sql command-string is built in the loop
-            thus:
-                - insert a new row into the database table with the time
-                - loop through the dict
-                    - update the newly made row with the key-value pair of the dict in the loop
-        """
-        # print('ichi update')
-        if not dictname:
-            # print('no column like this!!!')
-            raise AssertionError("Logger: dict does not yet exist")
-        sql = """INSERT INTO {} ({}) VALUES ({})""".format(
-            tablename, "timeseconds", dictname["timeseconds"]
-        )
-        self.mycursor.execute(sql)
+        """insert a new row into the database table with all data"""
+        self.inserttable(tablename, [dictname])
 
-        try:
-            for key in dictname:
-                var, bools = testing_NaN(dictname[key])
-                if not bools:
-                    sql = """UPDATE {table} SET {column}={value} WHERE {sec}={sec_now}""".format(
-                        table=tablename,
-                        column=key,
-                        value=SQLFormatting(var),
-                        sec="""timeseconds""",
-                        sec_now=dictname["timeseconds"],
-                    )
-                    self.mycursor.execute(sql)
-        except OperationalError as err:
-            print(err)
-            # do not know whether this will work
-            raise AssertionError(err.args[0])
+    def inserttable(self, tablename, rows):
+        """insert rows (list of dicts) into the database table
+
+            each row is inserted with one parameterized INSERT
+            into all columns named in the dict,
+            rows with the same keys are inserted together (executemany)
+        """
+        rows = [dictname for dictname in rows if dictname]
+        if not rows:
+            raise AssertionError("Logger: dict does not yet exist")
+        groups = dict()
+        for dictname in rows:
+            groups.setdefault(tuple(dictname.keys()), []).append(dictname)
+        # sqlite errors (e.g. a locked database) are passed on,
+        # so that the whole transaction is rolled back and spooled
+        for keys, group in groups.items():
+            self.mycursor.executemany(
+                sql_buildInsertString(tablename, keys),
+                [sql_rowValues(dictname, keys) for dictname in group],
+            )
 
     def printtable(self, tablename, dictname, date1, date2):
         """ print the data of one table between two dates
@@ -385,70 +560,119 @@ class main_Logger(AbstractLoopThread):
                 # print(self.mycursor.fetchall()[-5:])
             self.mycursor.execute(command)
 
-    def storing_to_database(self, data, names):
-        """store data to the database"""
+    def storing_to_database(self, entries, names):
+        """store data (list of data dicts) to the database
+
+        sqlite errors are not caught here, but in write_entries
+        """
         for name in names:
             try:
+                rows = [data[name] for data in entries if name in data]
+                if not rows:
+                    raise KeyError(name)
                 # self.correcting_database_types(name, data)
 
-                self.createtable(name, data[name])
+                for row in {tuple(row.keys()): row for row in rows}.values():
+                    self.createtable(name, row)
 
                 # inserting in the measured values:
-                self.updatetable(name, data[name])
+                self.inserttable(name, rows)
 
             except AssertionError as assertion:
                 self.sig_assertion.emit(assertion.args[0])
             except KeyError as key:
                 self.sig_assertion.emit(key.args[0])
 
+    names = [
+        "ITC",
+        "ILM",
+        "IPS",
+        "LakeShore350",
+        "Keithley2182_1",
+        "Keithley2182_2",
+        "Keithley2182_3",
+        "Keithley6220_1",
+        "Keithley6220_2",
+        "SR830",
+    ]
+
     @pyqtSlot(dict)
     def store_data(self, data):
         """storing logging data
             what data should be logged is set in self.conf
             or will be set there eventually at any rate
+
+            the data is queued, and written once a group is complete
         """
-        self.operror = False
         if self.not_yet_initialised:
             return
-
-        names = [
-            "ITC",
-            "ILM",
-            "IPS",
-            "LakeShore350",
-            "Keithley2182_1",
-            "Keithley2182_2",
-            "Keithley2182_3",
-            "Keithley6220_1",
-            "Keithley6220_2",
-            "SR830",
-        ]
-
-        self.connected = self.connectdb(self.conf["general"]["logfile_location"])
-        if not self.connected:
-            self.sig_assertion.emit("no connection, storing locally")
-            self.local_list.append(data)
-            return
-
+        self.queue.append(data)
+        if (
+            len(self.queue) >= self.group_rows
+            or time.monotonic() - self.last_commit >= self.group_time
+        ):
+            self.flush()
+
+    def write_entries(self, entries):
+        """write entries in one transaction, return whether it worked"""
+        if not self.connectdb(self.conf["general"]["logfile_location"]):
+            return False
         try:
             with self.conn:
-                self.mycursor = self.conn.cursor()
-                if len(self.local_list) > 0:
-                    for entry in self.local_list:
-                        self.storing_to_database(entry, names)
-                    self.local_list = []
-
-                self.storing_to_database(data, names)
+                self.storing_to_database(entries, self.names)
+            return True
         except OperationalError as e:
-            self.operror = True
-            self.local_list.append(data)
+            # the transaction was rolled back, including new columns
+            self.schema = dict()
             self.sig_assertion.emit(e.args[0])
         except sqlite3.Error as er:
-            if not self.operror:
-                self.local_list.append(data)
+            # reconnect next time
+            self.disconnectdb()
             self.sig_assertion.emit(er.args[0])
-            print(er)
-        # data.update(timedict)
+        return False
+
+    def flush(self):
+        """commit the queued data, spool it if the database cannot be written
+
+        a pending spool is drained first (a part of it per call),
+        while it is not empty, the queued data is appended to it,
+        so that the data arrives in the database in chronological order
+        """
+        self.last_commit = time.monotonic()
+        entries = list(self.queue)
+        self.queue.clear()
+        if self.spool.pending():
+            spooled, offset = self.spool.read(self.spool_drain_rows)
+            if not spooled or self.write_entries(spooled):
+                self.spool.consume(offset)
+        if not entries:
+            return
+        if self.spool.pending():
+            self.spool_entries(entries)
+        elif not self.write_entries(entries):
+            self.sig_assertion.emit("Logger: database not writeable, spooling to disk")
+            self.spool_entries(entries)
+
+    def spool_entries(self, entries):
+        """write entries to the spool file"""
+        try:
+            dropped = self.spool.append(entries)
+        except OSError as e:
+            dropped = len(entries)
+            self.sig_assertion.emit("Logger: spooling failed: {}".format(e))
+        if dropped:
+            self.sig_assertion.emit(
+                "Logger: spool full, dropped {} entries".format(dropped)
+            )
+
+    def close(self):
+        """write the data still queued, when the logger is stopped
+
+        only what cannot be written is spooled, for the next run
+        """
+        if self.configuration_done:
+            self.flush()
+        self.disconnectdb()
 
 
 class live_Logger(AbstractLoopThread):
@@ -463,23 +687,14 @@ class live_Logger(AbstractLoopThread):
         self.dataLock = mainthread.dataLock
         self.dataLock_live = mainthread.dataLock_live
 
+        # calculated from the RollingStatistics of a value
         self.calculations = {
-            "ar_mean": lambda time, value: np.nanmean(value),
-            # 'stddev': lambda time, value: np.nanstd(value),
-            # 'stderr': lambda time, value: np.nanstd(value) / np.sqrt(len(value)),
-            # 'stddev_rel': lambda time, value: np.nanstd(value) / np.nanmean(value),
-            # 'stderr_rel': lambda time, value: np.nanstd(value) / (np.nanmean(value) * np.sqrt(len(value))),
-            # 'test': lambda time, value: print(time),
-            "slope": lambda time, value: nppolyfit(time, value, deg=1, full=True),
-            # 'slope_of_mean': lambda time, value: nppolyfit(time, value, deg=1)[1] * 60
-        }
-        self.slopes = {
-            "slope": lambda value, mean: value[0][1] * 60,  # minutes,
-            # minutes,
-            "slope_rel": lambda value, mean: value[0][1] / mean * 60,
-            "slope_residuals": lambda value, mean: value[1][0][0] * 60
-            if len(value[1][0]) > 0
-            else np.nan,
+            "ar_mean": lambda stats: stats.mean(),
+            # 'stddev': lambda stats: np.sqrt(stats.variance()),
+            # 'stddev_rel': lambda stats: np.sqrt(stats.variance()) / stats.mean(),
+            "slope": lambda stats: stats.slope() * 60,  # minutes
+            "slope_rel": lambda stats: stats.slope() / stats.mean() * 60,  # minutes
+            "slope_residuals": lambda stats: stats.residuals() * 60,
         }
         self.noCalc = [
             "time",
@@ -530,7 +745,7 @@ class live_Logger(AbstractLoopThread):
     def running(self):
         """
             go through all stored values for every instrument,
-            and append them to the list which will be plotted
+            and append them to the ring buffers which will be plotted
         """
         try:
             # print("live logger trying to log")
@@ -538,147 +753,89 @@ class live_Logger(AbstractLoopThread):
                 with self.dataLock:
                     # print(self.data_live)
                     for instr in self.data:
-                        timedict = dict(
-                            logging_timeseconds=time.time() - self.startingtime,
-                            # logging_ReadableTime=convert_time(
-                            # time.time()),
-                            # logging_SearchableTime=convert_time_searchable(time.time())
+                        self.data_live[instr]["logging_timeseconds"].append(
+                            time.time() - self.startingtime
                         )
-                        dic = deepcopy(self.data[instr])
-                        dic.update(timedict)
-
-                        # print(times[0])
-                        for varkey in dic:
-                            # print(instr, varkey)
-                            self.data_live[instr][varkey].append(dic[varkey])
-                        if self.time_init:
-                            times = [
-                                float(x)
-                                for x in self.data_live[instr]["logging_timeseconds"]
-                            ]
-                        else:
-                            times = [0]
-                for instr in self.data_live:
-                    for varkey in self.data_live[instr]:
-                        for calc in self.calculations:
-                            if all([x not in varkey for x in self.noCalc]):
-                                if self.time_init:
-                                    self.calculations_perform(
-                                        instr, varkey, calc, times
-                                    )
-                        if self.count > self.length_list:
-                            self.counting = False
-                            self.data_live[instr][varkey].pop(0)
+                        for varkey, value in self.data[instr].items():
+                            if varkey != "logging_timeseconds":
+                                self.data_live[instr][varkey].append(value)
+                for instr in self.statistics:
+                    time_now = self.data_live[instr]["logging_timeseconds"][-1]
+                    for varkey, stats in self.statistics[instr].items():
+                        values = self.data_live[instr][varkey]
+                        if values.numeric():
+                            stats.update(time_now, values[-1])
+                            if self.time_init:
+                                self.calculations_perform(instr, varkey, stats)
 
         except AssertionError as assertion:
             self.sig_assertion.emit(assertion.args[0])
         except KeyError as key:
             self.sig_assertion.emit("live logger" + key.args[0])
         self.time_init = True
-        if self.counting:
-            self.count += 1
 
-    def calculations_perform(self, instr, varkey, calc, times):
+    def calculations_perform(self, instr, varkey, stats):
         """
-            perform one specified calculation on all corresponding datasets
+            append all calculations for one value, from its statistics
 
             return: None
         """
-        if calc == "slope":
-            fit = self.calculations[calc](times, self.data_live[instr][varkey])
-            for name, calc_slope in zip(self.slopes.keys(), self.slopes.values()):
-                self.data_live[instr][
-                    "{key}_calc_{c}".format(key=varkey, c=name)
-                ].append(
-                    calc_slope(
-                        fit,
-                        self.data_live[instr][
-                            "{key}_calc_{c}".format(key=varkey, c="ar_mean")
-                        ][-1],
-                    )
-                )
-        elif calc == "slope_of_mean":
-            times_spec = deepcopy(times)
-            while len(times_spec) > len(
-                self.data_live[instr]["{key}_calc_{c}".format(key=varkey, c="ar_mean")]
-            ):
-                times_spec.pop(0)
-            fit = self.data_live[instr][
-                "{key}_calc_{c}".format(key=varkey, c=calc)
-            ].append(
-                self.calculations[calc](
-                    times_spec,
-                    self.data_live[instr][
-                        "{key}_calc_{c}".format(key=varkey, c="ar_mean")
-                    ],
-                )
-            )
-        else:
-            try:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for calc, function in self.calculations.items():
                 self.data_live[instr][
                     "{key}_calc_{c}".format(key=varkey, c=calc)
-                ].append(self.calculations[calc](times, self.data_live[instr][varkey]))
-
-            except TypeError:
-                # raise AssertionError(e_type.args[0])
-                # print('TYPE CALC')
-                pass
-            except ValueError as e_val:
-                raise AssertionError(e_val.args[0])
+                ].append(function(stats))
 
     def pre_init(self):
         self.initialised = False
 
+    def capacity(self):
+        """number of values kept per variable: the length_list values
+        the calculations run over, plus the newest one"""
+        return self.length_list + 2
+
     def initialisation(self):
         """
            copy the current data-dict,
            update for logging times,
-           insert empty lists in all values
+           insert empty ring buffers in all values
         """
         self.startingtime = time.time()
         timedict = dict(logging_timeseconds=0,)
         self.time_init = False
-        self.count = 0
-        self.counting = True
         with self.dataLock:
             with self.dataLock_live:
-                self.mainthread.data_live = deepcopy(self.data)
+                self.mainthread.data_live = dict()
                 self.data_live = self.mainthread.data_live
+                self.statistics = dict()
                 for instrument in self.data:
                     dic = self.data[instrument]
                     dic.update(timedict)
-                    self.data_live[instrument].update(timedict)
+                    self.data_live[instrument] = dict()
+                    self.statistics[instrument] = dict()
                     for variablekey in dic:
-                        self.data_live[instrument][variablekey] = []
+                        self.data_live[instrument][variablekey] = RingBuffer(
+                            self.capacity()
+                        )
                         if all([x not in variablekey for x in self.noCalc]):
+                            self.statistics[instrument][
+                                variablekey
+                            ] = RollingStatistics(self.capacity())
                             for calc in self.calculations:
                                 self.data_live[instrument][
                                     "{key}_calc_{c}".format(key=variablekey, c=calc)
-                                ] = []
-                            for calc in self.slopes:
-                                self.data_live[instrument][
-                                    "{key}_calc_{c}".format(key=variablekey, c=calc)
-                                ] = []
+                                ] = RingBuffer(self.capacity())
         self.initialised = True
 
     def setLength(self, length):
         """set the number of measurements the calculation should be conducted over"""
-
-        if self.length_list > length:
-            with self.dataLock_live:
-                for instr in self.data_live:
-                    for varkey in self.data_live[instr]:
-                        self.data_live[instr][varkey] = self.data_live[instr][varkey][
-                            (self.length_list - length) :
-                        ]
-        elif self.length_list < length:
-            with self.dataLock_live:
-                for instr in self.data_live:
-                    for varkey in self.data_live[instr]:
-                        self.data_live[instr][varkey] = [np.nan] * (
-                            length - self.length_list
-                        ) + self.data_live[instr][varkey]
         self.length_list = length
+        with self.dataLock_live:
+            for instr in self.data_live:
+                for varkey in self.data_live[instr]:
+                    self.data_live[instr][varkey].resize(self.capacity())
+                for stats in self.statistics[instr].values():
+                    stats.resize(self.capacity())
 
     def update_conf(self, conf):
         """
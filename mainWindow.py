@@ -38,6 +38,7 @@ from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtCore import QTimer
 from PyQt5.QtCore import QSettings
+from PyQt5.QtCore import Qt
 
 # from PyQt5.QtWidgets import QtAlignRight
 from PyQt5.uic import loadUi
@@ -53,6 +54,7 @@ import sqlite3
 
 from pyvisa.errors import VisaIOError
 
+import drivers
 import Oxford
 import LakeShore
 import Keithley
@@ -166,6 +168,7 @@ class mainWindow(QtWidgets.QMainWindow):
         self.initialize_window_Keithley()
         self.initialize_window_LockIn()
         self.initialize_window_Errors()
+        self.initialize_window_Performance()
         self.show_data()
         self.window_SystemsOnline.checkactionLogging_LIVE.toggled["bool"].connect(
             self.run_logger_live
@@ -1169,12 +1172,12 @@ class mainWindow(QtWidgets.QMainWindow):
                 )
 
                 self.IPS_window.spinSetFieldSetPoint.valueChanged.connect(
-                    lambda value: self.threads["control_IPS"][0].gettoset_FieldSetPoint(
+                    lambda value: self.threads["control_IPS"][0].gettoset_FieldSetpoint(
                         value
                     )
                 )
                 self.IPS_window.spinSetFieldSetPoint.editingFinished.connect(
-                    lambda: self.threads["control_IPS"][0].setFieldSetPoint()
+                    lambda: self.threads["control_IPS"][0].setFieldSetpoint()
                 )
 
                 self.IPS_window.spinSetFieldSweepRate.valueChanged.connect(
@@ -2035,7 +2038,10 @@ class mainWindow(QtWidgets.QMainWindow):
             self.logging_running_logger = True
 
         else:
+            logger = self.threads["logger"][0]
             self.stopping_thread("logger")
+            # write what was not yet committed
+            logger.close()
             self.logging_running_logger = False
 
     @pyqtSlot()
@@ -2249,8 +2255,143 @@ class mainWindow(QtWidgets.QMainWindow):
         else:
             self.Errors_window.close()
 
+    def initialize_window_Performance(self):
+        """initialize the Performance window, showing the I/O statistics
+        of all instruments and buses"""
+        self.Performance_window = Window_ui(
+            ui_file=".\\configurations\\Performance.ui"
+        )
+        self.Performance_window.sig_closing.connect(
+            lambda: self.action_show_Performance.setChecked(False)
+        )
+        self.Performance_window.sig_closing.connect(
+            lambda: self.Performance_timer.stop()
+        )
+        self.Performance_window.pushRefresh.clicked.connect(self.update_Performance)
+        self.Performance_window.pushReset.clicked.connect(
+            lambda: drivers.reset_io_statistics()
+        )
+        self.Performance_window.pushReset.clicked.connect(self.update_Performance)
+        self.Performance_timer = QTimer()
+        self.Performance_timer.timeout.connect(self.update_Performance)
+
+        self.action_show_Performance.triggered["bool"].connect(self.show_Performance)
+
+    @pyqtSlot(bool)
+    def show_Performance(self, boolean):
+        """display/close the Performance window"""
+        if boolean:
+            self.update_Performance()
+            self.Performance_window.show()
+            self.Performance_timer.start(2000)
+        else:
+            self.Performance_timer.stop()
+            self.Performance_window.close()
+
+    @pyqtSlot()
+    def update_Performance(self):
+        """fill the tables of the Performance window with the current statistics"""
+        if not self.Performance_window.checkAutoRefresh.isChecked() and isinstance(
+            self.sender(), QTimer
+        ):
+            return
+
+        def fill(table, header, rows):
+            table.setSortingEnabled(False)
+            table.setColumnCount(len(header))
+            table.setHorizontalHeaderLabels(header)
+            table.setRowCount(len(rows))
+            for row, values in enumerate(rows):
+                for column, value in enumerate(values):
+                    item = QtWidgets.QTableWidgetItem()
+                    if isinstance(value, (int, float)):
+                        # numbers as data, so that they are sorted as numbers
+                        item.setData(Qt.EditRole, round(value, 2))
+                    else:
+                        item.setText(str(value))
+                    table.setItem(row, column, item)
+            table.resizeColumnsToContents()
+            table.setSortingEnabled(True)
+
+        ms = 1e3
+        rows = [
+            [
+                resource,
+                command,
+                st["count"],
+                st["mean"] * ms,
+                st["p50"] * ms,
+                st["p95"] * ms,
+                st["p99"] * ms,
+                st["max"] * ms,
+                st["timeouts"],
+                st["errors"],
+                st["bad_replies"],
+                st["retries"],
+                st["lock_wait_mean"] * ms,
+                st["lock_wait_p95"] * ms,
+            ]
+            for resource, commands in sorted(drivers.io_statistics().items())
+            for command, st in sorted(commands.items())
+        ]
+        fill(
+            self.Performance_window.tableCommands,
+            [
+                "instrument",
+                "command",
+                "count",
+                "mean",
+                "p50",
+                "p95",
+                "p99",
+                "max",
+                "timeouts",
+                "errors",
+                "bad replies",
+                "retries",
+                "lock wait mean",
+                "lock wait p95",
+            ],
+            rows,
+        )
+        rows = [
+            [
+                bus,
+                "{:.1f} %".format(st["utilization"] * 100),
+                st["queued"],
+            ]
+            + [st["jobs"].get(p, 0) for p in drivers.PRIORITY_NAMES.values()]
+            + [st["mean_wait"].get(p, 0.0) * ms for p in drivers.PRIORITY_NAMES.values()]
+            for bus, st in sorted(drivers.bus_statistics().items())
+        ]
+        fill(
+            self.Performance_window.tableBuses,
+            ["bus", "utilization", "queued"]
+            + ["{} jobs".format(p) for p in drivers.PRIORITY_NAMES.values()]
+            + ["{} wait".format(p) for p in drivers.PRIORITY_NAMES.values()],
+            rows,
+        )
+
 
 if __name__ == "__main__":
+    if "--simulate" in sys.argv:
+        # run against simulated instruments instead of hardware
+        drivers.use_simulated_backend()
+        sys.argv.remove("--simulate")
+    if "--replay" in sys.argv:
+        # run against the instruments recorded in a trace file
+        index = sys.argv.index("--replay")
+        drivers.use_replay_backend(sys.argv[index + 1])
+        del sys.argv[index : index + 2]
+    if "--record" in sys.argv:
+        # record the VISA traffic to a trace file
+        index = sys.argv.index("--record")
+        drivers.start_recording(sys.argv[index + 1])
+        del sys.argv[index : index + 2]
+    if "--bus-scheduling" in sys.argv:
+        # schedule the transactions per bus, see drivers.BusScheduler
+        drivers.use_bus_scheduling()
+        sys.argv.remove("--bus-scheduling")
     app = QtWidgets.QApplication(sys.argv)
     form = mainWindow(app=app)
     form.show()
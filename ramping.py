@@ -0,0 +1,319 @@
+"""Module containing a software temperature ramp, streaming setpoints to the controllers
+
+Instead of programming the sweep table of the ITC (at most 16 steps of at
+most 24 hours), or the setpoint ramp of the LakeShore, the setpoint is
+calculated from a profile on a fixed-rate timer, and sent whenever it
+changed by the resolution of the controller. Ramps can be arbitrarily long,
+and cost a single write every now and then. Both controllers can follow the
+same profile, each with its own offset (e.g. the VTI some Kelvin below the
+sample), so that their ramps stay synchronized.
+
+Usage:
+    profile = RampProfile(start=300)
+    profile.linear(to=10, rate=0.5)      # K/min
+    profile.hold(30)                     # minutes
+    profile.logarithmic(to=2, duration=120)
+
+    ramp = SetpointRamp(profile, interval=1)
+    ramp.add_target(*itc_target(ITC_Updater), offset=-5, minimum=4.3)
+    ramp.add_target(*lakeshore_target(LakeShore350_Updater))
+    # run it in a thread as any AbstractLoopThread, then
+    ramp.start()
+    ramp.pause(), ramp.resume(), ramp.stop()
+
+Classes:
+    RampProfile: piecewise linear and logarithmic temperature profile
+    SetpointRamp: a thread-class, inheriting from AbstractLoopThread,
+        streaming the setpoints of a profile to the controllers
+
+Author(s):
+    bklebel (Benjamin Klebel)
+"""
+import time
+from copy import deepcopy
+from bisect import bisect_right
+
+import numpy as np
+from PyQt5.QtCore import pyqtSlot
+
+from util import AbstractLoopThread
+from util import ExceptionHandling
+from drivers import bus_priority
+from drivers import PRIORITY_COMMAND
+
+
+class RampProfile(object):
+    """temperature as a function of time, made of segments
+
+    Each segment starts where the previous one ended (at start, for the
+    first one), and either changes the temperature linearly, or
+    logarithmically (at a constant rate in log(T), i.e. the same time
+    for each decade), or holds it. Times are given in minutes, as with
+    the sweeps of the controllers, setpoint() takes seconds.
+
+    Args:
+        start: temperature at the start of the profile [K]
+    """
+
+    def __init__(self, start):
+        self.start = float(start)
+        # per segment: start time [s], duration [s], start and end temperature, kind
+        self.segments = []
+        self._starts = []
+
+    @property
+    def duration(self):
+        """duration of the whole profile [s]"""
+        if not self.segments:
+            return 0.0
+        t0, duration, __, __, __ = self.segments[-1]
+        return t0 + duration
+
+    @property
+    def end(self):
+        """temperature at the end of the profile [K]"""
+        return self.segments[-1][3] if self.segments else self.start
+
+    def _append(self, duration, to, kind):
+        if duration < 0:
+            raise AssertionError("RampProfile: a segment cannot take negative time")
+        self._starts.append(self.duration)
+        self.segments.append(
+            (self.duration, float(duration), self.end, float(to), kind)
+        )
+        return self
+
+    def linear(self, to, rate=None, duration=None):
+        """ramp linearly to a temperature, with a rate [K/min] or in a duration [min]"""
+        if duration is None:
+            if not rate:
+                raise AssertionError("RampProfile: linear: rate or duration needed")
+            duration = abs(to - self.end) / abs(rate)
+        return self._append(duration * 60, to, "linear")
+
+    def logarithmic(self, to, duration):
+        """ramp logarithmically to a temperature, in a duration [min]"""
+        if to <= 0 or self.end <= 0:
+            raise AssertionError(
+                "RampProfile: logarithmic: temperatures need to be positive"
+            )
+        return self._append(duration * 60, to, "log")
+
+    def hold(self, duration):
+        """keep the temperature for a duration [min]"""
+        return self._append(duration * 60, self.end, "linear")
+
+    def piecewise(self, temperatures, rates):
+        """linear ramps through temperatures, with the respective rates [K/min]"""
+        for to, rate in zip(temperatures, rates):
+            self.linear(to, rate=rate)
+        return self
+
+    def logspaced(self, to, steps, rate, dwell=0):
+        """linear ramps through steps logarithmically spaced temperatures,
+        with a rate [K/min], holding each for dwell [min]"""
+        for temperature in np.geomspace(self.end, to, steps + 1)[1:]:
+            self.linear(temperature, rate=rate)
+            if dwell:
+                self.hold(dwell)
+        return self
+
+    def setpoint(self, t):
+        """the temperature at time t [s] after the start of the profile"""
+        if not self.segments or t <= 0:
+            return self.start
+        n = bisect_right(self._starts, t) - 1
+        t0, duration, start, end, kind = self.segments[n]
+        if duration <= 0 or t >= t0 + duration:
+            return end
+        fraction = (t - t0) / duration
+        if kind == "log":
+            return start * (end / start) ** fraction
+        return start + fraction * (end - start)
+
+
+def itc_target(updater):
+    """target function of an ITC_Updater, for SetpointRamp.add_target
+
+    the sweep of the ITC is stopped, as it would override the setpoint
+    returns the target function, and the resolution of the setpoint
+    """
+
+    def send(temperature):
+        updater.set_temperature = temperature
+        updater.ITC.setTemperature(temperature)
+
+    updater.ITC.SweepStop()
+    return send, 0.001
+
+
+def lakeshore_target(updater, output=1):
+    """target function of a LakeShore350_Updater, for SetpointRamp.add_target
+
+    the setpoint ramp of the LakeShore is switched off,
+    as it would delay every setpoint
+    returns the target function, and the resolution of the setpoint
+    """
+
+    def send(temperature):
+        updater.Temp_K_value = temperature
+        updater.LakeShore350.ControlSetpointCommand(output, temperature)
+
+    updater.Ramp_status_internal = 0
+    updater.LakeShore350.ControlSetpointRampParameterCommand(
+        output, 0, updater.Ramp_Rate_value
+    )
+    updater.poll_invalidate("ControlSetpointRampParameterQuery")
+    return send, 0.01
+
+
+class SetpointRamp(AbstractLoopThread):
+    """software ramp, streaming the setpoints of a RampProfile
+
+    Every interval seconds (on a fixed grid), the setpoint at the elapsed
+    time (without the time spent paused) is calculated. For each target,
+    it is shifted by the target's offset, limited to its minimum, and
+    rounded to its resolution - and sent if it differs from the last value
+    sent. The setpoints are sent with PRIORITY_COMMAND.
+    While the ramp is not running (before start(), paused, stopped or
+    finished), the runs return right away, without any communication.
+    While running, the state (see status()) is emitted with sig_Infodata.
+    """
+
+    schedule_mode = "fixed"
+    overrun_policy = "skip"
+
+    def __init__(self, profile, interval=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.__name__ = "SetpointRamp"
+        self.profile = profile
+        self.interval = interval
+        self.targets = dict()
+        self.state = "idle"
+        self._started_at = None
+        self._paused_at = None
+        self._paused_total = 0.0
+        self.setpoint = profile.start
+
+    def add_target(
+        self, function, resolution=0.001, offset=0.0, minimum=None, name=None
+    ):
+        """add a controller following the profile
+
+        :param function: called with the setpoint [K] to be sent
+        :param resolution: setpoints are rounded to this [K]
+        :param offset: added to the setpoint of the profile [K]
+        :param minimum: lowest setpoint to be sent [K]
+        :param name: name of the target, default: the next number
+        """
+        name = str(len(self.targets)) if name is None else name
+        self.targets[name] = dict(
+            function=function,
+            resolution=resolution,
+            offset=offset,
+            minimum=minimum,
+            sent=None,
+        )
+        return name
+
+    def elapsed(self):
+        """time since the start of the ramp, without the time paused [s]"""
+        if self._started_at is None:
+            return 0.0
+        now = self._paused_at if self._paused_at is not None else time.monotonic()
+        return now - self._started_at - self._paused_total
+
+    def target_setpoint(self, name, setpoint):
+        """the setpoint for a target, from the setpoint of the profile"""
+        target = self.targets[name]
+        value = setpoint + target["offset"]
+        if target["minimum"] is not None:
+            value = max(value, target["minimum"])
+        return round(round(value / target["resolution"]) * target["resolution"], 6)
+
+    @ExceptionHandling
+    def send(self, name, value):
+        """send a setpoint to a target
+
+        it only counts as sent if this worked, otherwise
+        it is sent again with the next run
+        """
+        self.targets[name]["function"](value)
+        self.targets[name]["sent"] = value
+
+    @ExceptionHandling
+    def running(self):
+        """send the current setpoints, if they changed"""
+        if self.state != "running":
+            return
+        elapsed = self.elapsed()
+        self.setpoint = self.profile.setpoint(elapsed)
+        with bus_priority(PRIORITY_COMMAND):
+            for name, target in self.targets.items():
+                value = self.target_setpoint(name, self.setpoint)
+                if value != target["sent"]:
+                    self.send(name, value)
+        # finished only once the final setpoints went through,
+        # until then they are retried with every run
+        end = self.profile.setpoint(self.profile.duration)
+        if elapsed >= self.profile.duration and all(
+            target["sent"] == self.target_setpoint(name, end)
+            for name, target in self.targets.items()
+        ):
+            self.state = "finished"
+            self._paused_at = time.monotonic()
+        self.sig_Infodata.emit(deepcopy(self.status()))
+
+    def status(self):
+        """state, elapsed time, progress and setpoints of the ramp"""
+        duration = self.profile.duration
+        return dict(
+            state=self.state,
+            elapsed_s=self.elapsed(),
+            progress=min(self.elapsed() / duration, 1.0) if duration else 1.0,
+            setpoint_K=self.setpoint,
+            **{
+                "setpoint_{}_K".format(name): target["sent"]
+                for name, target in self.targets.items()
+            }
+        )
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def start(self):
+        """start the ramp from the beginning of the profile"""
+        self._started_at = time.monotonic()
+        self._paused_at = None
+        self._paused_total = 0.0
+        for target in self.targets.values():
+            target["sent"] = None
+        self.state = "running"
+        self._deadline = None
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def pause(self):
+        """keep the current setpoints, until resume()"""
+        if self.state != "running":
+            return
+        self._paused_at = time.monotonic()
+        self.state = "paused"
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def resume(self):
+        """continue a paused ramp, where it was paused"""
+        if self.state != "paused":
+            return
+        self._paused_total += time.monotonic() - self._paused_at
+        self._paused_at = None
+        self.state = "running"
+        self._deadline = None
+
+    @pyqtSlot()
+    @ExceptionHandling
+    def stop(self):
+        """stop the ramp, the setpoints stay where they are"""
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+        self.state = "stopped"
@@ -0,0 +1,362 @@
+"""Module containing a recorder for the VISA traffic, and a backend replaying it
+
+The recorder logs every write, query and read of the drivers in drivers.py,
+with its (monotonic) start time, its duration, the reply, and the VISA
+error code if it failed (e.g. a timeout), to a compact binary trace file.
+The replay backend serves such a trace back to the drivers, each
+transaction taking its recorded duration (or less), so that problems of
+a real session (timeouts, garbled replies, slow instruments) can be
+reproduced offline, and changes can be benchmarked against recorded
+sessions. The gaps between the transactions are not reproduced, they
+are set by the drivers running against the replay.
+
+Usage:
+    import drivers
+    drivers.start_recording('session.trace')    # record all drivers
+    ...
+    drivers.stop_recording()
+
+    drivers.use_replay_backend('session.trace', speed=10)
+    # all drivers created afterwards talk to the recorded instruments
+
+Trace file format (little endian):
+    header: b'VISATRACE1', start time (time.time(), double)
+    records: op (uchar), resource id (ushort), start time relative
+        to the header start time (double), duration (float),
+        VISA error code (int, 0 for success), length of command (ushort),
+        length of reply (uint), command (utf-8), reply (utf-8)
+    op is one of b'n' (new resource, the command is its name),
+        b'w' (write), b'q' (query), b'r' (read, the command is the
+        command last sent to the resource, by a write or a query)
+
+Classes:
+    TrafficRecorder: writes the trace file
+    ReplayResourceManager: drop-in replacement for a visa.ResourceManager
+    ReplayResource: drop-in replacement for a pyvisa resource,
+        serving the recorded replies
+
+Author(s):
+    bklebel (Benjamin Klebel)
+"""
+import threading
+import struct
+import time
+from collections import namedtuple
+
+from pyvisa.errors import VisaIOError
+
+
+VI_ERROR_TMO = -1073807339
+VI_ERROR_RSRC_NFOUND = -1073807343
+
+MAGIC = b"VISATRACE1"
+_header = struct.Struct("<10sd")
+_record = struct.Struct("<BHdfiHI")
+
+TraceRecord = namedtuple(
+    "TraceRecord", "resource op time duration error_code command reply"
+)
+
+
+class TrafficRecorder(object):
+    """records the VISA traffic of the drivers to a binary trace file
+
+    Args:
+        path: the trace file, overwritten if it exists
+        flush_every: number of records after which the file is flushed
+    """
+
+    def __init__(self, path, flush_every=100, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._ids = dict()
+        self._last_written = dict()
+        self._unflushed = 0
+        self.records = 0
+        self._start = time.monotonic()
+        self._file = open(path, "wb")
+        self._file.write(_header.pack(MAGIC, time.time()))
+
+    def _write(self, op, resource_id, start, duration, error_code, command, reply):
+        command = command.encode("utf-8")
+        reply = reply.encode("utf-8")
+        self._file.write(
+            _record.pack(
+                ord(op),
+                resource_id,
+                start,
+                duration,
+                error_code,
+                len(command),
+                len(reply),
+            )
+        )
+        self._file.write(command)
+        self._file.write(reply)
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self._file.flush()
+            self._unflushed = 0
+
+    def _resource_id(self, resource_name):
+        if resource_name not in self._ids:
+            self._ids[resource_name] = len(self._ids)
+            self._write("n", self._ids[resource_name], 0.0, 0.0, 0, resource_name, "")
+        return self._ids[resource_name]
+
+    def record(self, resource_name, op, command, start, duration, reply="", error_code=0):
+        """store one transaction
+
+        op: 'w', 'q' or 'r'
+        start: time.monotonic() at the start of the transaction
+        """
+        with self._lock:
+            if self._file.closed:
+                return
+            if op in ("w", "q"):
+                self._last_written[resource_name] = command
+            elif op == "r":
+                command = self._last_written.get(resource_name, "")
+            self._write(
+                op,
+                self._resource_id(resource_name),
+                start - self._start,
+                duration,
+                error_code,
+                command,
+                reply,
+            )
+            self.records += 1
+
+    def wrap(self, resource_name, function, *args):
+        """a function performing function(*args) and recording it,
+
+        function is the write, query or read method of a resource
+        """
+        op = dict(write="w", query="q", read="r")[function.__name__]
+        command = args[0] if args else ""
+
+        def recorded():
+            start = time.monotonic()
+            try:
+                answer = function(*args)
+            except VisaIOError as e_visa:
+                self.record(
+                    resource_name,
+                    op,
+                    command,
+                    start,
+                    time.monotonic() - start,
+                    error_code=e_visa.error_code,
+                )
+                raise
+            reply = answer if op != "w" else ""
+            self.record(resource_name, op, command, start, time.monotonic() - start, reply)
+            return answer
+
+        return recorded
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_trace(path):
+    """read a trace file
+
+    returns the start time (time.time()) of the recording,
+    and the list of TraceRecords
+    """
+    records = []
+    names = dict()
+    with open(path, "rb") as f:
+        magic, started = _header.unpack(f.read(_header.size))
+        if magic != MAGIC:
+            raise AssertionError("recording: {} is not a VISA trace file".format(path))
+        while True:
+            chunk = f.read(_record.size)
+            if len(chunk) < _record.size:
+                # the end, or a record cut short by a crash
+                break
+            op, resource_id, start, duration, error_code, n_command, n_reply = _record.unpack(
+                chunk
+            )
+            command = f.read(n_command).decode("utf-8")
+            reply = f.read(n_reply).decode("utf-8")
+            if op == ord("n"):
+                names[resource_id] = command
+                continue
+            records.append(
+                TraceRecord(
+                    names[resource_id], chr(op), start, duration, error_code, command, reply
+                )
+            )
+    return started, records
+
+
+def summarize(path):
+    """number of transactions, errors, mean and max duration per resource and op"""
+    summary = dict()
+    for record in read_trace(path)[1]:
+        entry = summary.setdefault(record.resource, dict()).setdefault(
+            record.op, dict(transactions=0, errors=0, total=0.0, max=0.0)
+        )
+        entry["transactions"] += 1
+        entry["errors"] += 1 if record.error_code else 0
+        entry["total"] += record.duration
+        entry["max"] = max(entry["max"], record.duration)
+    for ops in summary.values():
+        for entry in ops.values():
+            entry["mean"] = entry.pop("total") / entry["transactions"]
+    return summary
+
+
+class ReplayResource(object):
+    """drop-in replacement for a pyvisa resource, serving recorded replies
+
+    The recorded transactions are served per command: a query of a
+    command gets the reply (or the error) recorded for the next not yet
+    replayed query of this command, so the replay is deterministic,
+    regardless of the order the commands come in.
+    Each transaction takes its recorded duration, divided by speed
+    (speed=0: no waiting at all).
+    When all recorded transactions of a command are replayed, they start
+    over (loop=True), or the command times out.
+
+    Args:
+        resource_name: name of the resource
+        records: the TraceRecords of this resource
+        speed: replay speed, relative to the recorded one
+        loop: start over when the recorded transactions of a command are used up
+    """
+
+    def __init__(self, resource_name, records, speed=1.0, loop=True, **kwargs):
+        super().__init__(**kwargs)
+        self.resource_name = resource_name
+        self.speed = speed
+        self.loop = loop
+        self.timeout = 2000  # ms
+        self.read_termination = None
+        self.write_termination = None
+        self.baud_rate = 9600
+        self.data_bits = 8
+        self.stop_bits = None
+        self.parity = None
+        self.query_delay = 0.0
+
+        self._transactions = dict()
+        for record in records:
+            self._transactions.setdefault((record.op, record.command), []).append(
+                record
+            )
+        self._cursors = {key: 0 for key in self._transactions}
+        self._last_written = ""
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _next(self, op, command):
+        key = (op, command)
+        if key not in self._transactions:
+            return None
+        transactions = self._transactions[key]
+        cursor = self._cursors[key]
+        if cursor >= len(transactions):
+            if not self.loop:
+                raise VisaIOError(VI_ERROR_TMO)
+            cursor = 0
+        self._cursors[key] = cursor + 1
+        return transactions[cursor]
+
+    def _serve(self, record):
+        if self.speed > 0:
+            time.sleep(record.duration / self.speed)
+        if record.error_code:
+            raise VisaIOError(record.error_code)
+        return record.reply
+
+    def close(self):
+        self.closed = True
+
+    def clear(self):
+        pass
+
+    def flush(self, mask):
+        """nothing to discard, the replies are served per command"""
+        pass
+
+    def write(self, command):
+        """send a command, as recorded"""
+        with self._lock:
+            self._last_written = command
+            record = self._next("w", command)
+        if record is not None:
+            self._serve(record)
+        return len(command)
+
+    def read(self):
+        """read the reply recorded for the last command sent"""
+        with self._lock:
+            record = self._next("r", self._last_written)
+        if record is None:
+            if self.speed > 0:
+                time.sleep(self.timeout / 1e3 / self.speed)
+            raise VisaIOError(VI_ERROR_TMO)
+        return self._serve(record)
+
+    def query(self, command):
+        """write a command and read the reply, as recorded"""
+        with self._lock:
+            self._last_written = command
+            record = self._next("q", command)
+        if record is None:
+            self.write(command)
+            return self.read()
+        return self._serve(record)
+
+    # pymeasure adapter interface, used by the SR830 updater
+    def ask(self, command):
+        return self.query(command)
+
+    def values(self, command, separator=",", cast=float, preprocess_reply=None):
+        reply = self.query(command).strip()
+        if preprocess_reply is not None:
+            reply = preprocess_reply(reply)
+        return [cast(v) for v in reply.split(separator) if v.strip()]
+
+
+class ReplayResourceManager(object):
+    """drop-in replacement for visa.ResourceManager,
+    which opens ReplayResources for the resources in a trace file
+
+    Args:
+        path: the trace file
+        speed: replay speed, relative to the recorded one (0: no waiting)
+        loop: start over when the recorded transactions of a command are used up
+    """
+
+    def __init__(self, path, speed=1.0, loop=True):
+        super().__init__()
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.started, records = read_trace(path)
+        self.records = dict()
+        for record in records:
+            self.records.setdefault(record.resource, []).append(record)
+        self.resources = dict()
+
+    def list_resources(self, query="?*::INSTR"):
+        return tuple(self.records)
+
+    def open_resource(self, resource_name, **kwargs):
+        """open a ReplayResource serving the transactions recorded for resource_name"""
+        if resource_name not in self.records:
+            raise VisaIOError(VI_ERROR_RSRC_NFOUND)
+        resource = ReplayResource(
+            resource_name, self.records[resource_name], speed=self.speed, loop=self.loop
+        )
+        self.resources[resource_name] = resource
+        return resource
@@ -0,0 +1,1102 @@
+"""Module containing a simulated VISA backend for all supported instruments
+
+The simulated backend stands in for the National Instruments / Keysight VISA
+libraries, so that the drivers in drivers.py, the updater threads, the loggers
+and the plotting can be run (and benchmarked) without any hardware attached.
+Every simulated instrument answers its real command set, e.g.
+    ITC 503, ILM 211, IPS 120-10:   'R1', 'X', '$T4.2', ...
+    LakeShore 350:                  'KRDG? 0', 'SETP 1,4.20', ...
+    Keithley 2182 / 6221:           ':READ?', 'CURR 1e-3', ...
+    SR830:                          'OUTP?1', 'FREQ?', ...
+
+The timing of the communication can be configured per command (prefix):
+latency, jitter, and the injection of timeouts and garbled replies.
+
+Usage:
+    import drivers
+    drivers.use_simulated_backend()   # all drivers created afterwards are simulated
+
+    or, for a single driver:
+        itc503(InstrumentAddress='ASRL6::INSTR', visalib='sim')
+
+Classes:
+    SimulatedResourceManager: drop-in replacement for a visa.ResourceManager
+    SimulatedResource: drop-in replacement for a pyvisa resource,
+        applies latency, jitter and error injection
+    SimulatedInstrument: base class for the instrument models
+    SimulatedITC503, SimulatedILM211, SimulatedIPS120,
+    SimulatedLakeShore350, SimulatedKeithley2182,
+    SimulatedKeithley6221, SimulatedSR830: instrument models
+
+Author(s):
+    bklebel (Benjamin Klebel)
+"""
+import threading
+import random
+import time
+import math
+
+from pyvisa.errors import VisaIOError
+
+
+VI_ERROR_TMO = -1073807339
+VI_ERROR_RSRC_NFOUND = -1073807343
+
+
+class SimulatedInstrument(object):
+    """base class for the simulated instruments
+
+    handle(command) receives one command (without termination)
+    and returns the reply as a string, or None if the instrument
+    does not reply to this command
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.RLock()
+        self._last_update = time.monotonic()
+
+    def handle(self, command):
+        """process a command, return the reply or None"""
+        with self._lock:
+            self._advance()
+            return self._handle(command)
+
+    def _advance(self):
+        """move the simulated physics forward to the current time"""
+        now = time.monotonic()
+        dt = now - self._last_update
+        self._last_update = now
+        if dt > 0:
+            self.evolve(dt)
+
+    def evolve(self, dt):
+        """change the instrument state over the time dt (seconds)"""
+        pass
+
+    def _handle(self, command):
+        raise NotImplementedError
+
+
+def _relax(value, target, dt, tau):
+    """exponential relaxation of value towards target with time constant tau"""
+    return target + (value - target) * math.exp(-dt / tau)
+
+
+def _approach(value, target, step):
+    """linear approach of value towards target, by at most step"""
+    if abs(target - value) <= step:
+        return target
+    return value + math.copysign(step, target - value)
+
+
+class SimulatedOxfordInstrument(SimulatedInstrument):
+    """common behaviour of the Oxford Instruments serial protocol
+
+    commands prefixed with '$' are not answered,
+    all other commands are answered by echoing the command letter,
+    'R' and 'X' (and possibly more) are answered with data,
+    unknown commands are answered with '?<command>'
+    """
+
+    version = "OXFORD INSTRUMENTS SIMULATED"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.control_state = 0
+
+    def _handle(self, command):
+        silent = command.startswith("$")
+        if silent:
+            command = command[1:]
+        if not command:
+            return None
+        letter = command[0]
+        argument = command[1:]
+        try:
+            reply = self._command(letter, argument)
+        except (ValueError, IndexError, KeyError):
+            reply = "?{}".format(command)
+        if silent:
+            return None
+        return reply
+
+    def _command(self, letter, argument):
+        if letter == "V":
+            return self.version
+        if letter == "C":
+            self.control_state = int(argument)
+            return "C"
+        if letter == "R":
+            return "R{}".format(self.readValue(int(argument)))
+        if letter == "X":
+            return self.status()
+        return self.set_value(letter, argument)
+
+    def readValue(self, variable):
+        raise KeyError(variable)
+
+    def status(self):
+        raise KeyError("X")
+
+    def set_value(self, letter, argument):
+        raise KeyError(letter)
+
+
+class SimulatedITC503(SimulatedOxfordInstrument):
+    """simulated Oxford Instruments ITC 503 temperature controller
+
+    The three sensors follow the (possibly sweeping) set point
+    with individual time constants, the sweep table is fully simulated.
+    """
+
+    version = "ITC503 Version 1.1 (c) OXFORD 1997 - SIMULATED"
+
+    def __init__(self, temperature=4.2, **kwargs):
+        super().__init__(**kwargs)
+        self.set_temperature = temperature
+        self.sensors = [temperature, temperature + 0.3, temperature + 1.5]
+        self.tau = [30.0, 45.0, 90.0]
+        self.prop = 40
+        self.integral = 11
+        self.derivative = 0
+        self.heater_sensor = 1
+        self.heater_output = 0.0
+        self.gas_output = 20.0
+        self.auto_manual = 3
+        self.autopid = 0
+        self.sweep_table = {
+            step: dict(set_point=0.0, sweep_time=0.0, hold_time=0.0)
+            for step in range(1, 17)
+        }
+        self.pointer_x = 0
+        self.pointer_y = 0
+        self.sweep_step = 0
+        self.sweep_elapsed = 0.0
+        self.sweep_start_temperature = temperature
+
+    def evolve(self, dt):
+        if self.sweep_step:
+            self._evolve_sweep(dt)
+        self.sensors = [
+            _relax(T, self.set_temperature + offset, dt, tau)
+            for T, tau, offset in zip(self.sensors, self.tau, [0, 0.3, 1.5])
+        ]
+        error = self.set_temperature - self.sensors[self.heater_sensor - 1]
+        if self.auto_manual in (1, 3):
+            self.heater_output = min(max(50 * error + 10, 0), 99.9)
+
+    def _evolve_sweep(self, dt):
+        """walk through the sweep table"""
+        self.sweep_elapsed += dt
+        while self.sweep_step:
+            entry = self.sweep_table[self.sweep_step]
+            sweep_s = entry["sweep_time"] * 60
+            hold_s = entry["hold_time"] * 60
+            if self.sweep_elapsed < sweep_s:
+                fraction = self.sweep_elapsed / sweep_s
+                self.set_temperature = self.sweep_start_temperature + fraction * (
+                    entry["set_point"] - self.sweep_start_temperature
+                )
+                return
+            self.set_temperature = entry["set_point"]
+            if self.sweep_elapsed < sweep_s + hold_s:
+                return
+            self.sweep_elapsed -= sweep_s + hold_s
+            self.sweep_start_temperature = entry["set_point"]
+            self.sweep_step = self.sweep_step + 1 if self.sweep_step < 16 else 0
+
+    def readValue(self, variable):
+        sensor = self.sensors[self.heater_sensor - 1]
+        values = {
+            0: "{:.3f}".format(self.set_temperature),
+            1: "{:.3f}".format(self.sensors[0]),
+            2: "{:.3f}".format(self.sensors[1]),
+            3: "{:.3f}".format(self.sensors[2]),
+            4: "{:+.3f}".format(self.set_temperature - sensor),
+            5: "{:.1f}".format(self.heater_output),
+            6: "{:.1f}".format(self.heater_output * 0.4),
+            7: "{:.1f}".format(self.gas_output),
+            8: "{:.1f}".format(self.prop),
+            9: "{:.1f}".format(self.integral),
+            10: "{:.1f}".format(self.derivative),
+        }
+        return values[variable]
+
+    def status(self):
+        if self.sweep_step:
+            sweep = 2 * self.sweep_step - 1
+        else:
+            sweep = 0
+        return "X0A{a}C{c}S{s:02d}H{h}L{l}".format(
+            a=self.auto_manual,
+            c=self.control_state,
+            s=sweep,
+            h=self.heater_sensor,
+            l=self.autopid,
+        )
+
+    def set_value(self, letter, argument):
+        if letter == "T":
+            self.set_temperature = float(argument)
+        elif letter == "P":
+            self.prop = float(argument)
+        elif letter == "I":
+            self.integral = float(argument)
+        elif letter == "D":
+            self.derivative = float(argument)
+        elif letter == "H":
+            self.heater_sensor = int(argument)
+        elif letter == "O":
+            self.heater_output = float(argument) / 10
+        elif letter == "G":
+            self.gas_output = float(argument) / 10
+        elif letter == "A":
+            self.auto_manual = int(argument)
+        elif letter == "L":
+            self.autopid = int(argument)
+        elif letter == "M":
+            pass
+        elif letter == "x":
+            self.pointer_x = int(argument)
+        elif letter == "y":
+            self.pointer_y = int(argument)
+        elif letter == "s":
+            key = {1: "set_point", 2: "sweep_time", 3: "hold_time"}[self.pointer_y]
+            self.sweep_table[self.pointer_x][key] = float(argument)
+        elif letter == "r":
+            key = {1: "set_point", 2: "sweep_time", 3: "hold_time"}[self.pointer_y]
+            return "r{}".format(self.sweep_table[self.pointer_x][key])
+        elif letter == "S":
+            step = int(argument)
+            if step in (0, 31):
+                self.sweep_step = 0
+            else:
+                self.sweep_step = (step + 1) // 2
+                self.sweep_elapsed = 0.0
+                self.sweep_start_temperature = self.set_temperature
+        else:
+            raise KeyError(letter)
+        return letter
+
+
+class SimulatedILM211(SimulatedOxfordInstrument):
+    """simulated Oxford Instruments ILM 211 level meter
+
+    channel 1: helium, slowly boiling off
+    channel 2: nitrogen
+    """
+
+    version = "ILM200 Version 1.08 (c) OXFORD 1994 - SIMULATED"
+
+    def __init__(self, level_helium=72.3, level_nitrogen=55.0, **kwargs):
+        super().__init__(**kwargs)
+        self.levels = [level_helium, level_nitrogen, 0.0]
+        # percent per second
+        self.boiloff = [1e-4, 2e-4, 0.0]
+        self.fast = [False, False, False]
+
+    def evolve(self, dt):
+        self.levels = [
+            max(level - rate * dt, 0) for level, rate in zip(self.levels, self.boiloff)
+        ]
+
+    def readValue(self, variable):
+        values = {
+            1: self.levels[0],
+            2: self.levels[1],
+            3: self.levels[2],
+            6: 0.12,
+            7: 0.0,
+            10: 0.0,
+        }
+        # reported in units of 0.1 %
+        return "{:d}".format(int(values[variable] * 10))
+
+    def status(self):
+        channel_status = [0x20 if fast else 0x40 for fast in self.fast]
+        return "X210S{:02X}{:02X}{:02X}R{:02d}".format(
+            *channel_status, self.control_state
+        )
+
+    def set_value(self, letter, argument):
+        if letter == "S":
+            self.fast[int(argument) - 1] = False
+        elif letter == "T":
+            self.fast[int(argument) - 1] = True
+        elif letter in ("F", "M"):
+            pass
+        else:
+            raise KeyError(letter)
+        return letter
+
+
+class SimulatedIPS120(SimulatedOxfordInstrument):
+    """simulated Oxford Instruments IPS 120-10 magnet power supply
+
+    The output field follows the set point (activity 'To set point')
+    or zero (activity 'To zero') with the set sweep rate,
+    the magnet only follows the output while the switch heater is on.
+    """
+
+    version = "IPS120-10  Version 3.07  (c) OXFORD 1996 - SIMULATED"
+
+    def __init__(self, amps_per_tesla=10.0, heater_switch_time=20.0, **kwargs):
+        super().__init__(**kwargs)
+        self.amps_per_tesla = amps_per_tesla
+        self.heater_switch_time = heater_switch_time
+        self.field_output = 0.0
+        self.field_setpoint = 0.0
+        self.field_rate = 0.1  # Tesla/min
+        self.persistent_field = 0.0
+        self.activity = 0
+        self.switch_heater = 0  # 0: off at zero, 1: on, 2: off at field
+        self.heater_timer = 0.0
+        self.display_tesla = True
+        self.sweeping = False
+        self.inductance = 5.0  # Henry
+
+    def evolve(self, dt):
+        self.heater_timer = max(self.heater_timer - dt, 0)
+        before = self.field_output
+        if self.activity == 1:
+            target = self.field_setpoint
+        elif self.activity == 2:
+            target = 0.0
+        else:
+            target = self.field_output
+        self.field_output = _approach(
+            self.field_output, target, self.field_rate / 60 * dt
+        )
+        self.sweeping = self.field_output != before
+        if self.switch_heater == 1 and self.heater_timer == 0:
+            self.persistent_field = self.field_output
+
+    def magnet_field(self):
+        """the field actually in the magnet"""
+        if self.switch_heater == 1 and self.heater_timer == 0:
+            return self.field_output
+        return self.persistent_field
+
+    def readValue(self, variable):
+        ratio = self.amps_per_tesla
+        voltage = 0.0
+        if self.sweeping:
+            voltage = self.inductance * self.field_rate * ratio / 60
+        values = {
+            0: self.field_output * ratio,
+            1: voltage,
+            2: self.magnet_field() * ratio,
+            4: self.field_output * ratio,
+            5: self.field_setpoint * ratio,
+            6: self.field_rate * ratio,
+            7: self.field_output,
+            8: self.field_setpoint,
+            9: self.field_rate,
+            10: 12.5,
+            11: 0.0,
+            12: 0.0,
+            13: 0.0,
+            14: 0.0,
+            15: 5.0,
+            16: self.persistent_field * ratio,
+            17: 0.0,
+            18: self.persistent_field,
+            19: 0.0,
+            20: 0.0,
+            21: -100.0,
+            22: 100.0,
+        }
+        return "{:+.4f}".format(values[variable])
+
+    def status(self):
+        if self.switch_heater == 1 and self.heater_timer > 0:
+            heater = 1
+        else:
+            heater = self.switch_heater
+        activity = {0: 0, 1: 1, 2: 2, 3: 4}[self.activity]
+        return "X00A{a}C{c}H{h}M{m1}{m2}P00".format(
+            a=activity,
+            c=self.control_state,
+            h=heater,
+            m1=1 if self.display_tesla else 0,
+            m2=1 if self.sweeping else 0,
+        )
+
+    def set_value(self, letter, argument):
+        if letter == "A":
+            self.activity = int(argument)
+        elif letter == "H":
+            state = int(argument)
+            if state in (1, 2):
+                if self.switch_heater != 1:
+                    self.heater_timer = self.heater_switch_time
+                self.switch_heater = 1
+            else:
+                if self.switch_heater == 1:
+                    self.persistent_field = self.magnet_field()
+                self.switch_heater = 2 if abs(self.persistent_field) > 1e-6 else 0
+        elif letter == "J":
+            self.field_setpoint = float(argument)
+        elif letter == "T":
+            self.field_rate = float(argument)
+        elif letter == "I":
+            self.field_setpoint = float(argument) / self.amps_per_tesla
+        elif letter == "S":
+            self.field_rate = float(argument) / self.amps_per_tesla
+        elif letter == "M":
+            self.display_tesla = int(argument) in (1, 3, 5, 7, 9)
+        elif letter in ("Q", "F"):
+            pass
+        else:
+            raise KeyError(letter)
+        return letter
+
+
+class SimulatedSCPIInstrument(SimulatedInstrument):
+    """common behaviour of GPIB instruments
+
+    several commands can be sent at once, separated by ';',
+    the replies to the queries among them are joined by ';'
+    """
+
+    def _handle(self, command):
+        replies = []
+        for part in command.split(";"):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                reply = self.command(part)
+            except (ValueError, IndexError, KeyError):
+                reply = None
+            if reply is not None:
+                replies.append(reply)
+        if not replies:
+            return None
+        return ";".join(replies)
+
+    def command(self, command):
+        raise NotImplementedError
+
+
+class SimulatedLakeShore350(SimulatedSCPIInstrument):
+    """simulated LakeShore 350 temperature controller
+
+    the four inputs follow the (ramping) control set point of output 1,
+    sensor units are those of a simple Cernox-like R(T) curve
+    """
+
+    def __init__(self, temperature=4.2, **kwargs):
+        super().__init__(**kwargs)
+        self.setpoint = {1: temperature, 2: 0.0}
+        self.target = {1: temperature, 2: 0.0}
+        self.ramp = {1: [0, 0.0], 2: [0, 0.0]}
+        self.pid = {1: [50.0, 20.0, 0.0], 2: [50.0, 20.0, 0.0]}
+        self.heater_range = {1: 3, 2: 0}
+        self.outmode = {1: [1, 1, 1], 2: [0, 2, 0]}
+        self.heater_setup = {1: [2, 2, 1.0, 2], 2: [1, 0, 0.0, 1]}
+        self.limits = {key: 400.0 for key in "ABCD"}
+        self.temperatures = [temperature + offset for offset in [0.0, 0.05, 0.2, 1.0]]
+        self.tau = [20.0, 25.0, 40.0, 120.0]
+        self.heater_output = 0.0
+
+    def evolve(self, dt):
+        for output in (1, 2):
+            on, rate = self.ramp[output]
+            if on and rate > 0:
+                self.setpoint[output] = _approach(
+                    self.setpoint[output], self.target[output], rate / 60 * dt
+                )
+            else:
+                self.setpoint[output] = self.target[output]
+        control = self.outmode[1][1] - 1
+        self.temperatures = [
+            _relax(T, self.setpoint[1] + offset, dt, tau)
+            for T, tau, offset in zip(self.temperatures, self.tau, [0, 0.05, 0.2, 1.0])
+        ]
+        if 0 <= control < 4 and self.heater_range[1]:
+            error = self.setpoint[1] - self.temperatures[control]
+            self.heater_output = min(max(self.pid[1][0] * error + 5, 0), 100)
+        else:
+            self.heater_output = 0.0
+
+    @staticmethod
+    def _resistance(temperature):
+        return 1e3 * math.exp(2.0 / math.sqrt(max(temperature, 0.1)))
+
+    def _inputs(self, argument, values, fmt):
+        if argument.strip() in ("0", ""):
+            return ",".join(fmt.format(v) for v in values)
+        return fmt.format(values["ABCD".index(argument.strip())])
+
+    def command(self, command):
+        name, __, argument = command.partition(" ")
+        name = name.upper()
+        args = [a.strip() for a in argument.split(",")] if argument else []
+        if name == "*IDN?":
+            return "LSCI,MODEL350,SIMULATED,1.0"
+        if name == "*OPC?":
+            return "1"
+        if name in ("*CLS", "*RST", "*OPC", "*ESE", "*SRE"):
+            return None
+        if name == "KRDG?":
+            return self._inputs(argument, self.temperatures, "{:+.4f}")
+        if name == "CRDG?":
+            return self._inputs(
+                argument, [T - 273.15 for T in self.temperatures], "{:+.4f}"
+            )
+        if name == "SRDG?":
+            return self._inputs(
+                argument, [self._resistance(T) for T in self.temperatures], "{:+.3f}"
+            )
+        if name == "SETP?":
+            return "{:+.4f}".format(self.setpoint[int(args[0])])
+        if name == "SETP":
+            output = int(args[0])
+            self.target[output] = float(args[1])
+            if not self.ramp[output][0]:
+                self.setpoint[output] = self.target[output]
+            return None
+        if name == "RAMP?":
+            on, rate = self.ramp[int(args[0])]
+            return "{:d},{:+.4f}".format(on, rate)
+        if name == "RAMP":
+            self.ramp[int(args[0])] = [int(args[1]), float(args[2])]
+            return None
+        if name == "RAMPST?":
+            output = int(args[0])
+            return "1" if self.setpoint[output] != self.target[output] else "0"
+        if name == "PID?":
+            return ",".join("{:+.1f}".format(v) for v in self.pid[int(args[0])])
+        if name == "PID":
+            self.pid[int(args[0])] = [float(a) for a in args[1:4]]
+            return None
+        if name == "RANGE?":
+            return "{:d}".format(self.heater_range[int(args[0])])
+        if name == "RANGE":
+            self.heater_range[int(args[0])] = int(args[1])
+            return None
+        if name == "HTR?":
+            return "{:+.3f}".format(self.heater_output if int(args[0]) == 1 else 0.0)
+        if name == "OUTMODE?":
+            return ",".join("{:d}".format(v) for v in self.outmode[int(args[0])])
+        if name == "OUTMODE":
+            self.outmode[int(args[0])] = [int(a) for a in args[1:4]]
+            return None
+        if name == "HTRSET?":
+            return ",".join(str(v) for v in self.heater_setup[int(args[0])])
+        if name == "HTRSET":
+            self.heater_setup[int(args[0])] = args[1:5]
+            return None
+        if name == "TLIMIT?":
+            return "{:+.4f}".format(self.limits[args[0]])
+        if name == "TLIMIT":
+            self.limits[args[0]] = float(args[1])
+            return None
+        if name.endswith("?"):
+            raise KeyError(name)
+        # all other configuration commands are accepted silently
+        return None
+
+
+def _scpi_normalise(command):
+    """uppercase, strip leading colon, separate header from argument"""
+    header, __, argument = command.strip().partition(" ")
+    return header.lstrip(":").upper(), argument.strip()
+
+
+def _scpi_match(header, *long_forms):
+    """check whether a SCPI header matches any of the given long forms,
+    accepting the short (uppercase part) and the long spelling of each node
+
+    long forms are given like 'SENSe:VOLTage:DC:NPLCycles'
+    """
+    nodes = header.split(":")
+    for form in long_forms:
+        form_nodes = form.split(":")
+        if len(nodes) != len(form_nodes):
+            continue
+        for node, form_node in zip(nodes, form_nodes):
+            short = "".join(c for c in form_node if c.isupper() or c == "?")
+            if node not in (short, form_node.upper()):
+                break
+        else:
+            return True
+    return False
+
+
+class SimulatedKeithley6221(SimulatedSCPIInstrument):
+    """simulated Keithley 6221 current source
+
+    if a simulated 2182 is linked as 'nanovoltmeter' (RS-232 and trigger link),
+    the Delta and Differential Conductance modes fill the buffer
+    with readings of that nanovoltmeter
+    """
+
+    def __init__(self, nanovoltmeter=None, **kwargs):
+        super().__init__(**kwargs)
+        self.current = 0.0
+        self.output = False
+        self.compliance = 10.0
+        self.nanovoltmeter = nanovoltmeter
+        self.delta = dict(HIGH=1e-3, LOW=-1e-3, DEL=0.002, COUN=10)
+        self.dcon = dict(STAR=0.0, STEP=1e-4, STOP=1e-3, DELT=1e-5, DEL=0.002)
+        self.armed = None
+        self.buffer = []
+
+    def output_current(self):
+        """the current which is actually sourced"""
+        return self.current if self.output else 0.0
+
+    def _voltage_at(self, current):
+        previous = self.current, self.output
+        self.current, self.output = current, True
+        try:
+            return self.nanovoltmeter.voltage()
+        finally:
+            self.current, self.output = previous
+
+    def _run(self):
+        """take all readings of the armed mode at once"""
+        if self.armed == "DELT":
+            high, low = self.delta["HIGH"], self.delta["LOW"]
+            levels = [high, low] * (int(self.delta["COUN"]) + 1)
+            voltages = [self._voltage_at(level) for level in levels]
+            for idx in range(int(self.delta["COUN"])):
+                v1, v2, v3 = voltages[2 * idx : 2 * idx + 3]
+                self.buffer.append((v1 - 2 * v2 + v3) / 4)
+        elif self.armed == "DCON":
+            count = int(
+                round(abs(self.dcon["STOP"] - self.dcon["STAR"]) / abs(self.dcon["STEP"]))
+            )
+            step = math.copysign(self.dcon["STEP"], self.dcon["STOP"] - self.dcon["STAR"])
+            for idx in range(count + 1):
+                current = self.dcon["STAR"] + idx * step
+                self.buffer.append(
+                    (
+                        self._voltage_at(current + self.dcon["DELT"])
+                        - self._voltage_at(current - self.dcon["DELT"])
+                    )
+                    / 2
+                )
+        self.armed = None
+
+    def command(self, command):
+        header, argument = _scpi_normalise(command)
+        if header == "*IDN?":
+            return "KEITHLEY INSTRUMENTS INC.,MODEL 6221,SIMULATED,A01"
+        if header == "*RST":
+            self.current = 0.0
+            self.output = False
+            self.armed = None
+            return None
+        if _scpi_match(header, "SOURce:CURRent", "CURRent", "SOURce:CURRent:AMPLitude"):
+            self.current = float(argument)
+            return None
+        if _scpi_match(header, "SOURce:CURRent?", "CURRent?"):
+            return "{:+.6E}".format(self.current)
+        if _scpi_match(header, "SOURce:CURRent:COMPliance"):
+            self.compliance = float(argument)
+            return None
+        if _scpi_match(header, "OUTPut:STATe", "OUTPut"):
+            self.output = argument.upper() in ("ON", "1")
+            return None
+        if _scpi_match(header, "OUTPut:STATe?", "OUTPut?"):
+            return "1" if self.output else "0"
+        if _scpi_match(header, "SOURce:CLEar:IMMediate", "SOURce:CLEar"):
+            self.output = False
+            self.current = 0.0
+            return None
+        if _scpi_match(header, "SOURce:DELTa:NVPResent?"):
+            return "1" if self.nanovoltmeter is not None else "0"
+        for mode, parameters in (("DELT", self.delta), ("DCON", self.dcon)):
+            if _scpi_match(header, "SOURce:{}:ARM".format(mode)):
+                if self.nanovoltmeter is not None:
+                    self.armed = mode
+                return None
+            if _scpi_match(header, "SOURce:{}:ARM?".format(mode)):
+                return "1" if self.armed == mode else "0"
+            for key in parameters:
+                if _scpi_match(header, "SOURce:{}:{}".format(mode, key)):
+                    parameters[key] = float(argument)
+                    return None
+        if _scpi_match(header, "INITiate:IMMediate", "INITiate"):
+            self._run()
+            return None
+        if _scpi_match(header, "SOURce:SWEep:ABORt"):
+            self.armed = None
+            return None
+        if _scpi_match(header, "TRACe:CLEar"):
+            self.buffer = []
+            return None
+        if _scpi_match(header, "TRACe:POINts:ACTual?"):
+            return "{:d}".format(len(self.buffer))
+        if _scpi_match(header, "TRACe:DATA?"):
+            return ",".join("{:+.8E}".format(v) for v in self.buffer)
+        if header.endswith("?"):
+            raise KeyError(header)
+        return None
+
+
+class SimulatedKeithley2182(SimulatedSCPIInstrument):
+    """simulated Keithley 2182 nanovoltmeter
+
+    measures the voltage drop over a sample of resistance 'resistance',
+    which is fed by the (optional) linked simulated Keithley 6221,
+    plus a thermal offset and noise which decreases with the integration time
+
+    with the buffer fed by the sensor (TRAC:FEED:CONT NEXT), an
+    initiated acquisition fills the buffer with 'sample count' readings
+    """
+
+    def __init__(self, source=None, resistance=1.0, offset=1e-7, noise=5e-8, **kwargs):
+        super().__init__(**kwargs)
+        self.source = source
+        self.resistance = resistance
+        self.offset = offset
+        self.noise = noise
+        self.nplc = 1.0
+        self.continuous = True
+        self.random = random.Random()
+        self.sample_count = 1
+        self.feed_next = False
+        self.buffer = []
+        self.measurement_event = 0
+
+    def voltage(self):
+        """one reading of the voltage"""
+        current = self.source.output_current() if self.source is not None else 0.0
+        noise = self.random.gauss(0, self.noise / math.sqrt(self.nplc))
+        return current * self.resistance + self.offset + noise
+
+    def _readings(self):
+        return ",".join(
+            "{:+.8E}".format(self.voltage()) for __ in range(self.sample_count)
+        )
+
+    def command(self, command):
+        header, argument = _scpi_normalise(command)
+        if header == "*IDN?":
+            return "KEITHLEY INSTRUMENTS INC.,MODEL 2182A,SIMULATED,C01"
+        if header == "*RST":
+            self.nplc = 5.0
+            self.continuous = True
+            self.sample_count = 1
+            self.feed_next = False
+            return None
+        if _scpi_match(header, "READ?", "FETCh?", "MEASure?", "MEASure:VOLTage?"):
+            return self._readings()
+        if _scpi_match(header, "SENSe:VOLTage:DC:NPLCycles", "SENSe:VOLTage:NPLCycles"):
+            self.nplc = float(argument)
+            return None
+        if _scpi_match(header, "INITiate:CONTinuous"):
+            self.continuous = argument.upper() in ("ON", "1")
+            return None
+        if _scpi_match(header, "SAMPle:COUNt"):
+            self.sample_count = int(argument)
+            return None
+        if _scpi_match(header, "TRACe:FEED:CONTrol"):
+            self.feed_next = argument.upper().startswith("NEXT")
+            return None
+        if _scpi_match(header, "TRACe:CLEar"):
+            self.buffer = []
+            return None
+        if _scpi_match(header, "INITiate:IMMediate", "INITiate"):
+            if self.feed_next:
+                self.buffer = [self.voltage() for __ in range(self.sample_count)]
+                self.measurement_event |= 512
+                self.feed_next = False
+            return None
+        if _scpi_match(header, "STATus:MEASurement:EVENt?", "STATus:MEASurement?"):
+            event, self.measurement_event = self.measurement_event, 0
+            return "{:d}".format(event)
+        if _scpi_match(header, "TRACe:DATA?"):
+            return ",".join("{:+.8E}".format(v) for v in self.buffer)
+        if header.endswith("?"):
+            raise KeyError(header)
+        return None
+
+
+class SimulatedSR830(SimulatedInstrument):
+    """simulated Stanford Research SR830 Lock-In Amplifier
+
+    measures a sample of resistance 'resistance' fed through a
+    series resistance 'series_resistance' by the sine output
+    """
+
+    def __init__(self, resistance=10.0, series_resistance=1e5, **kwargs):
+        super().__init__(**kwargs)
+        self.resistance = resistance
+        self.series_resistance = series_resistance
+        self.frequency = 11.0
+        self.sine_voltage = 1.0
+        self.phase = 0.0
+        self.random = random.Random()
+
+    def _handle(self, command):
+        replies = []
+        for part in command.split(";"):
+            reply = self._single(part.strip().upper())
+            if reply is not None:
+                replies.append(reply)
+        return ";".join(replies) if replies else None
+
+    def _single(self, command):
+        current = self.sine_voltage / (self.series_resistance + 50)
+        x = current * self.resistance + self.random.gauss(0, 1e-9)
+        y = self.random.gauss(0, 1e-9)
+        outputs = {1: x, 2: y, 3: math.hypot(x, y), 4: math.degrees(math.atan2(y, x))}
+        if command.startswith("*IDN?"):
+            return "Stanford_Research_Systems,SR830,SIMULATED,ver1.07"
+        if command.startswith("OUTP?"):
+            return "{:.6e}".format(outputs[int(command[5:].strip())])
+        if command.startswith("FREQ?"):
+            return "{:.4f}".format(self.frequency)
+        if command.startswith("FREQ"):
+            self.frequency = float(command[4:])
+            return None
+        if command.startswith("SLVL?"):
+            return "{:.3f}".format(self.sine_voltage)
+        if command.startswith("SLVL"):
+            self.sine_voltage = float(command[4:])
+            return None
+        if command.startswith("PHAS?"):
+            return "{:.2f}".format(self.phase)
+        if command.startswith("PHAS"):
+            self.phase = float(command[4:])
+            return None
+        return None
+
+
+class SimulatedResource(object):
+    """drop-in replacement for a pyvisa resource, connected to a simulated instrument
+
+    The timing of each transfer consists of a latency plus a random jitter,
+    and may be configured per command prefix (see configure()).
+    Timeouts and garbled replies can be injected with a given probability:
+        - an injected timeout loses the reply for the current read, it arrives
+          late and stays in the output buffer (as it happens with the
+          Oxford Instruments serial devices)
+        - a garbled reply has its first characters mangled
+
+    Args:
+        instrument: the SimulatedInstrument to talk to
+        latency: default time [s] a reply takes to arrive
+        jitter: default standard deviation [s] of the latency
+        timeout_probability: default probability for a query to time out
+        garble_probability: default probability for a reply to be garbled
+        seed: seed for the random number generator, for reproducible runs
+    """
+
+    def __init__(
+        self,
+        instrument,
+        resource_name="",
+        latency=0.0,
+        jitter=0.0,
+        timeout_probability=0.0,
+        garble_probability=0.0,
+        seed=None,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.instrument = instrument
+        self.resource_name = resource_name
+        self.timeout = 2000  # ms
+        self.read_termination = None
+        self.write_termination = None
+        self.baud_rate = 9600
+        self.data_bits = 8
+        self.stop_bits = None
+        self.parity = None
+        self.query_delay = 0.0
+
+        self.profiles = dict()
+        self.configure(
+            "",
+            latency=latency,
+            jitter=jitter,
+            timeout_probability=timeout_probability,
+            garble_probability=garble_probability,
+        )
+        self.random = random.Random(seed)
+        self._output = []
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def configure(
+        self,
+        prefix,
+        latency=None,
+        jitter=None,
+        timeout_probability=None,
+        garble_probability=None,
+    ):
+        """set the timing and error injection for all commands starting with prefix
+
+        the longest matching prefix is used, the empty prefix is the default
+        """
+        profile = self.profiles.setdefault(prefix, dict())
+        for key, value in (
+            ("latency", latency),
+            ("jitter", jitter),
+            ("timeout_probability", timeout_probability),
+            ("garble_probability", garble_probability),
+        ):
+            if value is not None:
+                profile[key] = value
+
+    def _profile(self, command):
+        """gather the settings for a command, from the longest prefix down"""
+        profile = dict(
+            latency=0.0, jitter=0.0, timeout_probability=0.0, garble_probability=0.0
+        )
+        for prefix in sorted(self.profiles, key=len):
+            if command.startswith(prefix):
+                profile.update(self.profiles[prefix])
+        return profile
+
+    def _delay(self, profile):
+        delay = profile["latency"]
+        if profile["jitter"]:
+            delay += abs(self.random.gauss(0, profile["jitter"]))
+        if delay > 0:
+            time.sleep(delay)
+
+    def _raise_timeout(self):
+        time.sleep(self.timeout / 1e3)
+        raise VisaIOError(VI_ERROR_TMO)
+
+    def _garble(self, reply):
+        if not reply:
+            return reply
+        n = self.random.randint(1, min(3, len(reply)))
+        mangled = "".join(self.random.choice("?#\x00\xff") for __ in range(n))
+        return mangled + reply[n:]
+
+    def close(self):
+        self.closed = True
+
+    def clear(self):
+        """device clear: empty the output buffer"""
+        with self._lock:
+            self._output = []
+
+    @property
+    def bytes_in_buffer(self):
+        """number of bytes waiting to be read"""
+        with self._lock:
+            return sum(len(reply) for reply, __ in self._output)
+
+    def read_bytes(self, count):
+        """read count bytes, i.e. the waiting replies they add up to"""
+        with self._lock:
+            data = ""
+            while self._output and len(data) < count:
+                data += self._output.pop(0)[0]
+            return data.encode()
+
+    def flush(self, mask):
+        """discard the replies waiting to be read, whatever the mask"""
+        with self._lock:
+            self._output = []
+
+    def write(self, command):
+        """send a command to the simulated instrument"""
+        with self._lock:
+            profile = self._profile(command)
+            self._delay(profile)
+            reply = self.instrument.handle(command)
+            if reply is not None:
+                if self.random.random() < profile["garble_probability"]:
+                    reply = self._garble(reply)
+                self._output.append((reply, profile))
+        return len(command)
+
+    def read(self):
+        """read one reply from the output buffer of the simulated instrument"""
+        with self._lock:
+            if not self._output:
+                self._raise_timeout()
+            reply, profile = self._output[0]
+            if self.random.random() < profile["timeout_probability"]:
+                self._raise_timeout()
+            self._output.pop(0)
+            return reply
+
+    def query(self, command):
+        """write a command and read the reply"""
+        self.write(command)
+        if self.query_delay:
+            time.sleep(self.query_delay)
+        return self.read()
+
+    # pymeasure adapter interface, used by the SR830 updater
+    def ask(self, command):
+        return self.query(command)
+
+    def values(self, command, separator=",", cast=float, preprocess_reply=None):
+        reply = self.ask(command).strip()
+        if preprocess_reply is not None:
+            reply = preprocess_reply(reply)
+        return [cast(value) for value in reply.split(separator)]
+
+
+class SimulatedResourceManager(object):
+    """drop-in replacement for visa.ResourceManager,
+    which opens SimulatedResources for registered instruments
+
+    Args:
+        instruments: dict mapping resource names to SimulatedInstruments
+        resource_options: dict of keyword arguments for all SimulatedResources
+            (latency, jitter, timeout_probability, garble_probability, seed)
+    """
+
+    def __init__(self, instruments=None, **resource_options):
+        super().__init__()
+        self.instruments = dict() if instruments is None else dict(instruments)
+        self.resource_options = resource_options
+        self.resources = dict()
+
+    def register(self, resource_name, instrument):
+        """add a simulated instrument at the given resource name"""
+        self.instruments[resource_name] = instrument
+
+    def list_resources(self, query="?*::INSTR"):
+        return tuple(self.instruments)
+
+    def open_resource(self, resource_name, **kwargs):
+        """open a SimulatedResource to the instrument at resource_name"""
+        if resource_name not in self.instruments:
+            raise VisaIOError(VI_ERROR_RSRC_NFOUND)
+        options = dict(self.resource_options)
+        options.update(kwargs)
+        resource = SimulatedResource(
+            self.instruments[resource_name], resource_name=resource_name, **options
+        )
+        self.resources[resource_name] = resource
+        return resource
+
+
+def default_instruments():
+    """instruments as set up at the cryostat, at the addresses used in mainWindow
+
+    the nanovoltmeters 1 and 2 measure the samples driven by current sources 1 and 2
+    """
+    current_1 = SimulatedKeithley6221()
+    current_2 = SimulatedKeithley6221()
+    current_1.nanovoltmeter = SimulatedKeithley2182(source=current_1, resistance=12.3)
+    current_2.nanovoltmeter = SimulatedKeithley2182(source=current_2, resistance=45.6)
+    return {
+        "ASRL6::INSTR": SimulatedITC503(),
+        "ASRL5::INSTR": SimulatedILM211(),
+        "ASRL4::INSTR": SimulatedIPS120(),
+        "GPIB0::1::INSTR": SimulatedLakeShore350(),
+        "GPIB0::2::INSTR": current_1.nanovoltmeter,
+        "GPIB0::3::INSTR": current_2.nanovoltmeter,
+        "GPIB0::4::INSTR": SimulatedKeithley2182(),
+        "GPIB0::5::INSTR": current_1,
+        "GPIB0::6::INSTR": current_2,
+        "GPIB::9": SimulatedSR830(),
+    }
@@ -3,6 +3,15 @@ Utility module for the Cryostat-GUI
 
 
 Classes:
+    RingBuffer: a fixed-capacity ring buffer on a preallocated numpy array,
+        used for the live data
+
+    RollingStatistics: mean, variance and slope over a sliding window,
+        updated in O(1) per value
+
+    GainSchedule: PID values as a function of the temperature,
+        with hysteresis and optional interpolation
+
     AbstractThread: a class which sets up QT's QThread instance, as well as the assertion signal
 
     AbstractLoopThread: a thread-class, inheriting from AbstractThread,
@@ -29,6 +38,7 @@ import matplotlib.gridspec as gridspec
 
 import functools
 import inspect
+from bisect import bisect_right
 import time
 import numpy as np
 import json
@@ -39,11 +49,16 @@ import os
 from copy import deepcopy
 from datetime import datetime
 from visa import VisaIOError
+from drivers import bus_name
+from drivers import bus_priority
+from drivers import PRIORITY_POLL
 from threading import Lock
+from threading import Event
 
 from PyQt5.QtCore import QObject
 from PyQt5.QtCore import QThread
 from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import pyqtSlot
 from PyQt5 import QtWidgets
@@ -217,6 +232,277 @@ def readPID_fromFile(filename):
     return list_T, listPID
 
 
+class GainSchedule(object):
+    """PID values as a function of the temperature, e.g. from a PID configuration
+
+    Row k of the table holds the PID values for temperatures up to
+    temperatures[k] (above the last one, the last row applies), the row
+    is found by bisection. With interpolate, the values are interpolated
+    linearly between the temperatures of neighbouring rows instead.
+    The hysteresis keeps the values from chattering while the temperature
+    sits on a row boundary: the row only changes once the temperature
+    left its range by more than the hysteresis, interpolated values are
+    only recalculated once the temperature moved by more than the
+    hysteresis. New values are only taken as current with commit(), so
+    that values which could not be written are returned again.
+
+    Args:
+        temperatures: upper temperature limits of the rows, ascending
+        pids: for each row, a dict with the p, i, d values
+        interpolate: interpolate linearly between the rows
+        hysteresis: width of the hysteresis band [K]
+        decimals: number of digits the values are rounded to
+    """
+
+    def __init__(self, temperatures, pids, interpolate=False, hysteresis=0.0, decimals=1):
+        self.temperatures = [float(t) for t in temperatures]
+        if not self.temperatures or len(pids) != len(self.temperatures):
+            raise AssertionError(
+                "GainSchedule: one set of PID values per temperature needed"
+            )
+        if any(a >= b for a, b in zip(self.temperatures, self.temperatures[1:])):
+            raise AssertionError("GainSchedule: temperatures must be ascending")
+        self.values = np.array([[pid["p"], pid["i"], pid["d"]] for pid in pids])
+        self.interpolate = interpolate
+        self.hysteresis = hysteresis
+        self.decimals = decimals
+        self.reset()
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """schedule from a PID configuration file, see readPID_fromFile"""
+        return cls(*readPID_fromFile(filename), **kwargs)
+
+    def reset(self):
+        """forget the current values, the next update() returns them anew"""
+        self.row = None
+        self.anchor = None
+        self.current = None
+        self._pending = None
+
+    def row_for(self, temperature):
+        """index of the row applying to temperature"""
+        return min(
+            bisect_right(self.temperatures, temperature), len(self.temperatures) - 1
+        )
+
+    def lookup(self, temperature):
+        """PID values for temperature, regardless of the hysteresis"""
+        if self.interpolate:
+            values = [
+                np.interp(temperature, self.temperatures, column)
+                for column in self.values.T
+            ]
+        else:
+            values = self.values[self.row_for(temperature)]
+        return dict(zip("pid", (round(float(v), self.decimals) for v in values)))
+
+    def _in_band(self, temperature):
+        """whether temperature is within the hysteresis band of the current values"""
+        if self.interpolate:
+            return abs(temperature - self.anchor) <= self.hysteresis
+        lower = self.temperatures[self.row - 1] if self.row > 0 else -np.inf
+        upper = (
+            self.temperatures[self.row]
+            if self.row < len(self.temperatures) - 1
+            else np.inf
+        )
+        return lower - self.hysteresis <= temperature < upper + self.hysteresis
+
+    def update(self, temperature):
+        """PID values for temperature, if they changed since the last commit()
+
+        the values only become the current ones with commit(),
+        once they were written to the instrument - until then,
+        they are returned again with every update
+
+        :return: dict with p, i, d values, or None if nothing changed
+        """
+        if temperature is None or np.isnan(temperature):
+            return None
+        if self.current is not None and self._in_band(temperature):
+            return None
+        values = self.lookup(temperature)
+        if values == self.current:
+            # back within the range of the current values
+            self.row = self.row_for(temperature)
+            self.anchor = temperature
+            return None
+        self._pending = (self.row_for(temperature), temperature, values)
+        return dict(values)
+
+    def commit(self, values):
+        """the values returned by update() were written to the instrument"""
+        if self._pending is None or self._pending[2] != values:
+            return
+        self.row, self.anchor, self.current = self._pending
+        self._pending = None
+
+
+class RingBuffer(object):
+    """fixed-capacity ring buffer on a preallocated numpy array
+
+    Every value is stored twice, at i and i + capacity, so that the
+    values in order of their appending are always one contiguous slice
+    of the array: view() returns them without copying, append() is O(1).
+    Values which cannot be converted to float switch the buffer to
+    dtype object, None is stored as NaN.
+    """
+
+    def __init__(self, capacity, dtype=float):
+        self.capacity = int(capacity)
+        self._data = np.full(2 * self.capacity, np.nan, dtype=dtype)
+        self._start = 0
+        self._length = 0
+
+    def append(self, value):
+        """append a value, dropping the oldest one if the buffer is full"""
+        if self._data.dtype != object:
+            try:
+                value = np.nan if value is None else float(value)
+            except (TypeError, ValueError):
+                self._data = self._data.astype(object)
+        end = self._start + self._length
+        if end >= self.capacity:
+            end -= self.capacity
+        self._data[end] = value
+        self._data[end + self.capacity] = value
+        if self._length < self.capacity:
+            self._length += 1
+        else:
+            self._start = self._start + 1 if self._start + 1 < self.capacity else 0
+
+    def view(self):
+        """the values, oldest first, as a (read-only) view on the buffer"""
+        view = self._data[self._start : self._start + self._length]
+        view.flags.writeable = False
+        return view
+
+    def resize(self, capacity):
+        """change the capacity, keeping the newest values"""
+        values = self.view()[-int(capacity) :] if capacity else []
+        self.__init__(capacity, dtype=self._data.dtype)
+        for value in values:
+            self.append(value)
+
+    def numeric(self):
+        """whether all values are numbers (or NaN)"""
+        return self._data.dtype != object
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None):
+        return np.array(self.view(), dtype=dtype)
+
+    def __repr__(self):
+        return "RingBuffer({}, {})".format(self.capacity, list(self.view()))
+
+
+class RollingStatistics(object):
+    """mean, variance and least-squares slope of y(t) over a sliding window
+
+    The window holds the last 'capacity' (t, y) pairs. The means and
+    co-moments are updated Welford-style when a pair enters or leaves the
+    window, which is O(1) per pair. Pairs containing NaN occupy the window,
+    but are excluded from all statistics (as np.nanmean does).
+    To keep rounding errors from accumulating, all sums are recomputed
+    from the window every 'capacity' updates.
+    """
+
+    def __init__(self, capacity):
+        self.times = RingBuffer(capacity)
+        self.values = RingBuffer(capacity)
+        self._clear()
+
+    def _clear(self):
+        self.n = 0
+        self.mean_t = 0.0
+        self.mean_y = 0.0
+        self.c_tt = 0.0
+        self.c_ty = 0.0
+        self.c_yy = 0.0
+        self._updates = 0
+
+    def _add(self, t, y):
+        self.n += 1
+        dt = t - self.mean_t
+        dy = y - self.mean_y
+        self.mean_t += dt / self.n
+        self.mean_y += dy / self.n
+        self.c_tt += dt * (t - self.mean_t)
+        self.c_ty += dt * (y - self.mean_y)
+        self.c_yy += dy * (y - self.mean_y)
+
+    def _remove(self, t, y):
+        if self.n <= 1:
+            self._clear()
+            return
+        mean_t = self.mean_t - (t - self.mean_t) / (self.n - 1)
+        mean_y = self.mean_y - (y - self.mean_y) / (self.n - 1)
+        self.c_tt -= (t - mean_t) * (t - self.mean_t)
+        self.c_ty -= (t - mean_t) * (y - self.mean_y)
+        self.c_yy -= (y - mean_y) * (y - self.mean_y)
+        self.mean_t = mean_t
+        self.mean_y = mean_y
+        self.n -= 1
+
+    def _recompute(self):
+        self._clear()
+        for t, y in zip(self.times.view(), self.values.view()):
+            if not (np.isnan(t) or np.isnan(y)):
+                self._add(t, y)
+
+    def update(self, t, y):
+        """add the pair (t, y) to the window, dropping the oldest one if it is full"""
+        t = np.nan if t is None else float(t)
+        y = np.nan if y is None else float(y)
+        if len(self.values) == self.values.capacity:
+            t_old, y_old = self.times[0], self.values[0]
+            if not (np.isnan(t_old) or np.isnan(y_old)):
+                self._remove(t_old, y_old)
+        self.times.append(t)
+        self.values.append(y)
+        self._updates += 1
+        if self._updates >= self.values.capacity:
+            self._recompute()
+        elif not (np.isnan(t) or np.isnan(y)):
+            self._add(t, y)
+
+    def resize(self, capacity):
+        """change the window length, keeping the newest pairs"""
+        self.times.resize(capacity)
+        self.values.resize(capacity)
+        self._recompute()
+
+    def mean(self):
+        """arithmetic mean of y"""
+        return self.mean_y if self.n > 0 else np.nan
+
+    def variance(self):
+        """(population) variance of y"""
+        return max(self.c_yy, 0.0) / self.n if self.n > 0 else np.nan
+
+    def slope(self):
+        """slope of the least-squares straight line through y(t)"""
+        if self.n < 2 or self.c_tt <= 0:
+            return np.nan
+        return self.c_ty / self.c_tt
+
+    def residuals(self):
+        """sum of squared residuals of the least-squares straight line,
+        NaN if there are not more than two pairs (the line fits exactly)"""
+        if self.n < 3 or self.c_tt <= 0:
+            return np.nan
+        return max(self.c_yy - self.c_ty ** 2 / self.c_tt, 0.0)
+
+
 class dummy:
     """dummy context manager doing nothing at all"""
 
@@ -255,6 +541,73 @@ class loops_off:
             thread.lock.release()
 
 
+def instrument_buses(worker):
+    """names of the buses ('GPIB0', 'ASRL6', ...) of the instruments driven by worker
+
+    every attribute of the worker holding a VISA resource (a driver)
+    counts as an instrument
+    """
+    buses = set()
+    for value in vars(worker).values():
+        resource = getattr(value, "_visa_resource", None)
+        name = getattr(resource, "resource_name", None)
+        if isinstance(name, str) and name:
+            buses.add(bus_name(name))
+    return buses
+
+
+class loops_paused:
+    """Context manager pausing only the loops of the threads a measurement uses
+
+    The measurement declares the threads (by their names in threads)
+    and/or the buses ('GPIB0', 'ASRL5', ...) it touches. Only the loops
+    of these threads, and of all threads driving an instrument on one
+    of these buses, are paused, all other threads keep running.
+    The global threads["Lock"] is only held while looking up the threads.
+    The loop locks are acquired in a fixed order, so that measurements
+    pausing overlapping sets of threads cannot deadlock.
+    """
+
+    def __init__(self, threads, threadnames=(), buses=()):
+        self._threads = threads
+        self.threadnames = list(threadnames)
+        self.buses = {bus_name(bus) for bus in buses}
+        self._locks = []
+
+    def _workers(self):
+        with self._threads["Lock"]:
+            missing = [name for name in self.threadnames if name not in self._threads]
+            if missing:
+                raise AssertionError(
+                    "loops_paused: no running threads named {}".format(missing)
+                )
+            workers = [self._threads[name][0] for name in self.threadnames]
+            if self.buses:
+                workers += [
+                    self._threads[name][0]
+                    for name in self._threads
+                    if name != "Lock"
+                    and instrument_buses(self._threads[name][0]) & self.buses
+                ]
+        return workers
+
+    def __enter__(self, *args, **kwargs):
+        locks = {
+            id(worker.lock): worker.lock
+            for worker in self._workers()
+            if hasattr(worker, "lock")
+        }
+        self._locks = [locks[key] for key in sorted(locks)]
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        for lock in reversed(self._locks):
+            lock.release()
+        self._locks = []
+
+
 # class controls_software_disabled:
 #     """Context manager for disabling all controls in GUI"""
 
@@ -325,14 +678,112 @@ class AbstractThread(QObject):
 
 
 class AbstractLoopThread(AbstractThread):
-    """Abstract thread class to be used with instruments """
+    """Abstract thread class to be used with instruments
+
+    Polling schedule:
+        values which hardly change need not be read in every loop cycle.
+        polling_schedule assigns a tier to a key (a value, or a group of values
+        read together), polling_tiers the minimal time between two reads
+        of a key in this tier. Keys not in polling_schedule are 'fast'.
+        In running(), poll(key, function, *args) only calls function if the key
+        is due, otherwise it returns the last value read.
+
+    Scheduling:
+        schedule_mode 'delay': running() is started 'interval' seconds
+            after the previous run returned, the period is interval plus
+            the duration of running(), and drifts.
+        schedule_mode 'fixed': running() is started on a fixed grid of
+            deadlines, 'interval' seconds apart (aligned to multiples of
+            interval in wall clock time if align_to_clock), independent of
+            the duration of running().
+            If a run ends after the next deadline (an overrun), the
+            overrun_policy decides:
+                'skip': the missed deadlines are skipped, the next run
+                    starts at the next deadline still ahead
+                'catchup': the missed runs are started immediately, one after
+                    the other, but at most max_catchup of them, the rest
+                    is skipped
+        schedule_statistics() returns the numbers of runs, overruns and
+        skipped deadlines, and the largest lateness of a run.
+
+    Pausing:
+        setting self.loop to False pauses the loop, the thread waits
+        (without polling) until it is set to True again.
+
+    The bus transactions of running() have the (lowest) priority
+    PRIORITY_POLL, see drivers.BusScheduler.
+    """
+
+    polling_tiers = dict(fast=0, medium=5, slow=60)  # seconds
+    polling_schedule = dict()
+
+    schedule_mode = "delay"
+    overrun_policy = "skip"
+    max_catchup = 3
+    align_to_clock = True
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self._loop_event = Event()
         self.interval = 0.5  # second
         # self.__isRunning = True
         self.loop = True
         self.lock = Lock()
+        self._poll_times = dict()
+        self._poll_values = dict()
+        self._deadline = None
+        self._catchup = 0
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+
+    @property
+    def loop(self):
+        """whether the loop is running, False pauses it"""
+        return self._loop_event.is_set()
+
+    @loop.setter
+    def loop(self, value):
+        if value:
+            if not self._loop_event.is_set():
+                # start a new grid, instead of catching up with the pause
+                self._deadline = None
+            self._loop_event.set()
+        else:
+            self._loop_event.clear()
+
+    def poll_due(self, key):
+        """check whether key needs to be read according to the polling schedule"""
+        if key not in self._poll_times:
+            return True
+        period = self.polling_tiers[self.polling_schedule.get(key, "fast")]
+        return time.monotonic() - self._poll_times[key] >= period
+
+    def poll_done(self, key, value):
+        """store a value which was just read"""
+        self._poll_times[key] = time.monotonic()
+        self._poll_values[key] = value
+
+    def poll_last(self, key):
+        """the last value read for key"""
+        return self._poll_values[key]
+
+    def poll_invalidate(self, *keys):
+        """force the keys to be read in the next cycle,
+        e.g. after the corresponding value was changed"""
+        for key in keys:
+            self._poll_times.pop(key, None)
+
+    def poll(self, key, function, *args, **kwargs):
+        """read the value for key with function(*args, **kwargs), if it is due,
+        otherwise return the last value read
+
+        if the function raises an exception, the key stays due
+        """
+        if self.poll_due(key):
+            self.poll_done(key, function(*args, **kwargs))
+        return self._poll_values[key]
 
     @pyqtSlot()  # int
     # @ExceptionHandling  # this is being done with all functions again, still...
@@ -341,15 +792,66 @@ class AbstractLoopThread(AbstractThread):
         # while self.__isRunning:
         try:
 
-            while not self.loop:
-                time.sleep(0.05)
-            with locking(self.lock):
+            self._loop_event.wait()
+            self._started()
+            with locking(self.lock), bus_priority(PRIORITY_POLL):
                 self.running()
 
         except AssertionError as assertion:
             self.sig_assertion.emit(assertion.args[0])
         finally:
-            QTimer.singleShot(self.interval * 1e3, self.work)
+            QTimer.singleShot(
+                int(round(self._next_delay() * 1e3)), Qt.PreciseTimer, self.work
+            )
+
+    def _started(self):
+        """book-keeping at the start of a run"""
+        self.runs += 1
+        if self._deadline is not None and self.schedule_mode == "fixed":
+            lateness = time.monotonic() - self._deadline
+            self.max_lateness = max(self.max_lateness, lateness)
+
+    def _first_deadline(self, now):
+        """the first deadline of the fixed grid"""
+        if not self.align_to_clock or self.interval <= 0:
+            return now
+        wall = time.time()
+        return now + float(np.ceil(wall / self.interval) * self.interval - wall)
+
+    def _next_delay(self):
+        """the time in seconds until running() needs to be started again"""
+        now = time.monotonic()
+        if self.schedule_mode != "fixed" or self.interval <= 0:
+            self._deadline = None
+            return self.interval
+        if self._deadline is None:
+            self._deadline = self._first_deadline(now)
+            return self._deadline - now
+        self._deadline += self.interval
+        if self._deadline >= now:
+            self._catchup = 0
+            return self._deadline - now
+        # overrun: the next deadline has already passed
+        self.overruns += 1
+        if self.overrun_policy == "catchup" and self._catchup < self.max_catchup:
+            self._catchup += 1
+            return 0
+        missed = int((now - self._deadline) // self.interval) + 1
+        self._deadline += missed * self.interval
+        self.skipped += missed
+        self._catchup = 0
+        return self._deadline - now
+
+    def schedule_statistics(self):
+        """statistics of the (fixed rate) scheduling"""
+        return dict(
+            mode=self.schedule_mode,
+            interval=self.interval,
+            runs=self.runs,
+            overruns=self.overruns,
+            skipped=self.skipped,
+            max_lateness=self.max_lateness,
+        )
 
     def running(self):
         """class method to be overriden """
@@ -357,8 +859,22 @@ class AbstractLoopThread(AbstractThread):
 
     @pyqtSlot(float)
     def setInterval(self, interval):
-        """set the interval between running events in seconds"""
+        """set the interval between running events in seconds
+
+        with a fixed rate, a new grid of deadlines is started
+        """
         self.interval = interval
+        self._deadline = None
+
+    @pyqtSlot(str)
+    def setScheduleMode(self, mode):
+        """choose between 'delay' and 'fixed' rate scheduling"""
+        if mode not in ("delay", "fixed"):
+            raise AssertionError(
+                "schedule mode needs to be 'delay' or 'fixed', not {}".format(mode)
+            )
+        self.schedule_mode = mode
+        self._deadline = None
 
     # @pyqtSlot()
     # def looping(self, loop):
@@ -383,7 +899,7 @@ class AbstractEventhandlingThread(AbstractThread):
         except AssertionError as assertion:
             self.sig_assertion.emit(assertion.args[0])
         finally:
-            QTimer.singleShot(self.interval * 1e3, self.work)
+            QTimer.singleShot(int(self.interval * 1e3), self.work)
 
     def running(self):
         """empty method to keep thread alive (there is surely a better solution) """